@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+"""Compare accuracy and speed of rasterizing HDUs by their polygons
+(rasterize_chunk) vs their RA/Dec bounding boxes (rasterize_bbox_chunk)."""
+
+# EXAMPLE (from the repository root):
+#   python -m benchmarks.bench_bbox -n 5000 --nside 4096
+
+# Python Standard Library
+import argparse
+import time
+# External Packages
+import numpy as np
+import healpy as hp
+# Local Packages
+from helpers.contrib.exposure_map import (sort_radec_batch, rasterize_chunk,
+                                          rasterize_bbox_chunk)
+from benchmarks.bench_sort_radec import synthetic_corners
+
+
+def compare(nside, ra, dec):
+    """Return dict of timing and accuracy of bbox vs polygon mode."""
+    exptime = np.full((len(ra), 1), 90.0)
+    ra_s, dec_s = sort_radec_batch(ra, dec)
+    vecs = hp.ang2vec(ra_s.ravel(), dec_s.ravel(), lonlat=True).reshape(
+        -1, 4, 3)
+    t0 = time.perf_counter()
+    ppix, psums = rasterize_chunk(nside, vecs, exptime)
+    polygon_sec = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    bpix, bsums = rasterize_bbox_chunk(nside, ra, dec, exptime)
+    bbox_sec = time.perf_counter() - t0
+
+    both = np.union1d(ppix, bpix)
+    pmap = np.zeros(len(both))
+    bmap = np.zeros(len(both))
+    pmap[np.searchsorted(both, ppix)] = psums[0]
+    bmap[np.searchsorted(both, bpix)] = bsums[0]
+    return(dict(polygon_sec=polygon_sec, bbox_sec=bbox_sec,
+                extra=bsums.sum() / psums.sum() - 1,
+                differ=np.mean(pmap != bmap),
+                missed=np.sum((pmap > 0) & (bmap == 0)) / len(ppix)))
+
+##############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare polygon and bounding box rasterization',
+        epilog='EXAMPLE: "%(prog)s -n 5000 --nside 4096"'
+        )
+    parser.add_argument('-n', '--nhdus', type=int, default=5000,
+                        help='Number of (synthetic) HDUs')
+    parser.add_argument('--nside', type=int, default=4096,
+                        help='HEALPix NSIDE of the map')
+    parser.add_argument('--rotations', type=float, nargs='+',
+                        default=[0, 0.5, 2, 10, 45],
+                        help='Maximum rotations (degrees) of the HDUs')
+    args = parser.parse_args()
+
+    print(f'{args.nhdus:,} HDUs (0.30 x 0.15 deg), nside={args.nside} '
+          f'({hp.nside2resol(args.nside, arcmin=True):.2f} arcmin)')
+    print(f'{"rotation":>9} {"polygon":>9} {"bbox":>9} {"speedup":>8} '
+          f'{"+exposure":>10} {"pix differ":>10} {"missed":>8}')
+    for rotation in args.rotations:
+        ra, dec = synthetic_corners(args.nhdus, max_rotation=rotation)
+        r = compare(args.nside, ra, dec)
+        print(f'{rotation:8.1f}° {r["polygon_sec"]:8.2f}s {r["bbox_sec"]:8.3f}s '
+              f'{r["polygon_sec"]/r["bbox_sec"]:7.0f}x '
+              f'{100*r["extra"]:9.1f}% {100*r["differ"]:9.1f}% '
+              f'{100*r["missed"]:7.2f}%')
+
+if __name__ == '__main__':
+    main()
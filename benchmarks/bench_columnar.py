@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+"""Compare memory and time of search() + DataFrame vs search_columns()."""
+
+# EXAMPLE (from the repository root):
+#   python -m benchmarks.bench_columnar -n 1000000
+
+# Python Standard Library
+import argparse
+import multiprocessing
+import time
+import tracemalloc
+# External Packages
+import pandas as pd
+# Local Packages
+import helpers.api
+from tests.stub_archive import StubArchive
+
+
+OUTFIELDS = ["fitsfile", "hdu_idx", "CENRA1", "CENDEC1", "FWHM", "AVSKY",
+             "fitsfile__exposure", "fitsfile__ifilter"]
+METADATA = {
+    'core_hdu_fields': [dict(Field='fitsfile', Type='str'),
+                        dict(Field='hdu_idx', Type='int')],
+    'core_file_fields': [dict(Field='exposure', Type='float'),
+                         dict(Field='ifilter', Type='str')],
+    'aux_hdu_fields/decam/instcal': [dict(Field=f, Type='float')
+                                     for f in OUTFIELDS[2:6]]}
+JSPEC = {"outfields": OUTFIELDS,
+         "search": [["instrument", "decam"], ["proc_type", "instcal"]]}
+
+def serve(nrows, queue):
+    rows = [dict(fitsfile=f'{n//60:032x}', hdu_idx=n%60,
+                 CENRA1=n*1e-4, CENDEC1=-30+n*1e-5, FWHM=3.5, AVSKY=120.0,
+                 fitsfile__exposure=90.0, fitsfile__ifilter='r DECam',
+                 instrument='decam', proc_type='instcal')
+            for n in range(nrows)]
+    with StubArchive(rows=rows, metadata=METADATA) as stub:
+        queue.put(stub.url)
+        queue.get()  # wait until told to stop
+
+def rows_then_frame(hapi, nrows):
+    info, rows = hapi.search(JSPEC, limit=nrows)
+    return(pd.DataFrame(rows))
+
+def columns(hapi, nrows):
+    info, df = hapi.search_columns(JSPEC, limit=nrows, frame=True)
+    return(df)
+
+def measure(label, func, hapi, nrows):
+    t0 = time.perf_counter()
+    df = func(hapi, nrows)
+    seconds = time.perf_counter() - t0
+    del df
+    tracemalloc.start()
+    df = func(hapi, nrows)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{label:>20}: {seconds:6.2f} sec, '
+          f'peak={peak/2**20:8.1f} MiB, result={size/2**20:8.1f} MiB '
+          f'({len(df):,} rows)')
+
+##############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark columnar search results (local stub server)',
+        epilog='EXAMPLE: "%(prog)s -n 1000000"'
+        )
+    parser.add_argument('-n', '--nrows', type=int, default=1000000,
+                        help='Number of HDU rows in the search result')
+    args = parser.parse_args()
+
+    queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(args.nrows, queue))
+    server.start()
+    try:
+        hapi = helpers.api.FitsHdu(queue.get(), timeout=(5, 600))
+        measure('search + DataFrame', rows_then_frame, hapi, args.nrows)
+        measure('search_columns', columns, hapi, args.nrows)
+    finally:
+        queue.put('stop')
+        server.join()
+
+if __name__ == '__main__':
+    main()
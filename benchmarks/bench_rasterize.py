@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+"""Compare rasterizing HDU polygons into a HEALPix map one HDU at a
+time (as gen_exposure_map used to) vs rasterize() with worker processes."""
+
+# EXAMPLE (from the repository root):
+#   python -m benchmarks.bench_rasterize -n 20000 --processes 1 2 4 8
+
+# Python Standard Library
+import argparse
+import os
+import time
+# External Packages
+import numpy as np
+import healpy as hp
+# Local Packages
+from helpers.contrib.exposure_map import (sort_radec_batch, rasterize,
+                                          accumulate)
+from benchmarks.bench_sort_radec import synthetic_corners
+
+
+def synthetic_hdus(nhdus, seed=0):
+    """Return (vecs, weights) of NHDUS synthetic HDUs."""
+    ra, dec = sort_radec_batch(*synthetic_corners(nhdus, seed=seed))
+    vecs = hp.ang2vec(ra.ravel(), dec.ravel(), lonlat=True).reshape(-1, 4, 3)
+    rng = np.random.default_rng(seed)
+    exptime = rng.choice([30.0, 90.0, 200.0], nhdus)
+    weights = np.column_stack([exptime, rng.uniform(0, 1, nhdus) * exptime])
+    return(vecs, weights)
+
+def loop(nside, vecs, weights):
+    map = np.zeros(hp.nside2npix(nside))
+    tmap = map.copy()
+    for vec, (exptime, teff) in zip(vecs, weights):
+        try:
+            ipix = hp.query_polygon(nside, vec)
+            map[ipix] += exptime
+            tmap[ipix] += teff
+        except Exception:
+            pass
+    return(map, tmap)
+
+def parallel(nside, vecs, weights, processes):
+    map = np.zeros(hp.nside2npix(nside))
+    tmap = map.copy()
+    for pixels, sums in rasterize(nside, vecs, weights, processes=processes):
+        accumulate((map, tmap), pixels, sums)
+    return(map, tmap)
+
+##############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark HEALPix rasterization of HDU polygons',
+        epilog='EXAMPLE: "%(prog)s -n 20000 --processes 1 2 4 8"'
+        )
+    parser.add_argument('-n', '--nhdus', type=int, default=20000,
+                        help='Number of (synthetic) HDUs')
+    parser.add_argument('--nside', type=int, default=4096,
+                        help='HEALPix NSIDE of the map')
+    parser.add_argument('--processes', type=int, nargs='+',
+                        default=[1, os.cpu_count()],
+                        help='Numbers of worker processes to try')
+    args = parser.parse_args()
+
+    vecs, weights = synthetic_hdus(args.nhdus)
+    print(f'{args.nhdus:,} HDUs, nside={args.nside}, '
+          f'{os.cpu_count()} CPUs')
+
+    t0 = time.perf_counter()
+    expected = loop(args.nside, vecs, weights)
+    base = time.perf_counter() - t0
+    print(f'{"loop":>16}: {base:8.2f} sec')
+    for processes in args.processes:
+        t0 = time.perf_counter()
+        maps = parallel(args.nside, vecs, weights, processes)
+        seconds = time.perf_counter() - t0
+        same = all(np.allclose(m, e) for m, e in zip(maps, expected))
+        print(f'{f"{processes} processes":>16}: {seconds:8.2f} sec '
+              f'({base/seconds:5.2f}x) same={same}')
+        del maps
+
+if __name__ == '__main__':
+    main()
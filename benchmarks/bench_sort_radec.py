@@ -0,0 +1,70 @@
+#! /usr/bin/env python
+"""Compare ordering HDU corners one HDU at a time (sort_radec) vs all
+at once (sort_radec_batch)."""
+
+# EXAMPLE (from the repository root):
+#   python -m benchmarks.bench_sort_radec -n 200000
+
+# Python Standard Library
+import argparse
+import time
+# External Packages
+import numpy as np
+# Local Packages
+from helpers.contrib.exposure_map import sort_radec, sort_radec_batch
+
+
+def synthetic_corners(nhdus, seed=0, width=0.30, height=0.15,
+                      max_rotation=180):
+    """Return (ra, dec) as (NHDUS,4) arrays of the corners (in random
+    order) of WIDTH by HEIGHT (degrees) rectangles rotated by up to
+    MAX_ROTATION degrees, scattered over the southern sky, some
+    straddling RA=0/360."""
+    rng = np.random.default_rng(seed)
+    cra = rng.uniform(0, 360, nhdus)
+    cdec = rng.uniform(-70, 30, nhdus)
+    rot = rng.uniform(-1, 1, nhdus) * np.radians(max_rotation)
+    dx = np.array([-1, 1, 1, -1]) * width / 2
+    dy = np.array([-1, -1, 1, 1]) * height / 2
+    x = dx * np.cos(rot)[:,None] - dy * np.sin(rot)[:,None]
+    y = dx * np.sin(rot)[:,None] + dy * np.cos(rot)[:,None]
+    ra = np.mod(cra[:,None] + x / np.cos(np.radians(cdec))[:,None], 360)
+    dec = cdec[:,None] + y
+    shuffle = np.argsort(rng.random((nhdus, 4)), axis=1)
+    return(np.take_along_axis(ra, shuffle, axis=1),
+           np.take_along_axis(dec, shuffle, axis=1))
+
+##############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark ordering of HDU corners',
+        epilog='EXAMPLE: "%(prog)s -n 200000"'
+        )
+    parser.add_argument('-n', '--nhdus', type=int, default=200000,
+                        help='Number of (synthetic) HDUs')
+    args = parser.parse_args()
+
+    ra, dec = synthetic_corners(args.nhdus)
+
+    t0 = time.perf_counter()
+    loop = [sort_radec(ra1, dec1) for ra1, dec1 in zip(ra, dec)]
+    loop_sec = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    bra, bdec = sort_radec_batch(ra, dec)
+    batch_sec = time.perf_counter() - t0
+
+    lra = np.array([r for r, d in loop])
+    wrap = (ra.max(axis=1) - ra.min(axis=1)) > 180
+    same = np.all(lra[~wrap] == bra[~wrap], axis=1)
+    print(f'{args.nhdus:,} HDUs ({wrap.sum():,} straddle RA=0/360)')
+    print(f'{"sort_radec":>18}: {loop_sec:8.3f} sec')
+    print(f'{"sort_radec_batch":>18}: {batch_sec:8.3f} sec '
+          f'({loop_sec/batch_sec:,.0f}x faster)')
+    print(f'Same order for {same.sum():,} of {len(same):,} '
+          f'non-straddling HDUs')
+
+if __name__ == '__main__':
+    main()
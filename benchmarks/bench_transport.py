@@ -0,0 +1,59 @@
+#! /usr/bin/env python
+"""Compare per-request latency of one-shot requests vs a pooled session."""
+
+# EXAMPLE (from the repository root):
+#   python -m benchmarks.bench_transport -n 500
+
+# Python Standard Library
+import argparse
+import time
+import statistics
+# External Packages
+import requests
+# Local Packages
+import helpers.api
+from tests.stub_archive import StubArchive
+
+
+def timeit(func, count):
+    """Return list of per-call latencies (seconds) of COUNT calls to FUNC."""
+    times = []
+    for i in range(count):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return(times)
+
+def report(label, times):
+    ms = [1000 * t for t in times]
+    print(f'{label:>20}: mean={statistics.mean(ms):7.3f} ms '
+          f'median={statistics.median(ms):7.3f} ms '
+          f'p95={sorted(ms)[int(0.95 * len(ms))]:7.3f} ms')
+
+##############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark AdaApi HTTP transport against a local stub',
+        epilog='EXAMPLE: "%(prog)s -n 500"'
+        )
+    parser.add_argument('-n', '--count', type=int, default=200,
+                        help='Number of searches to time per transport')
+    args = parser.parse_args()
+
+    jspec = {"outfields": ["md5sum"], "search": []}
+    rows = [dict(md5sum=f'{i:032x}') for i in range(10)]
+    with StubArchive(rows=rows) as stub:
+        url = f'{stub.url}/api/adv_search/fasearch/?limit=10&format=json'
+        report('requests.post',
+               timeit(lambda: requests.post(url, json=jspec), args.count))
+        print(f'{"":>20}  connections opened: {stub.connections}')
+        stub.server.connections = 0
+        fapi = helpers.api.FitsFile(stub.url, limit=10)
+        report('AdaApi.session',
+               timeit(lambda: fapi.search(jspec), args.count))
+        print(f'{"":>20}  connections opened: {stub.connections}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,436 @@
+"""Asyncio client of the Astro Data Archive (needs aiohttp).
+
+Mirrors FitsFile and FitsHdu of helpers.api, but every method that
+talks to the server is a coroutine (or an async iterator), so many
+requests can run concurrently in one event loop.
+"""
+
+# EXAMPLE:
+#   async def main():
+#       async with AsyncFitsFile(max_concurrency=50) as fapi:
+#           info, rows = await fapi.search(jspec, limit=1000)
+#           await asyncio.gather(*[fapi.retrieve_to(r['md5sum'],
+#                                                   f'/tmp/{r["md5sum"]}')
+#                                  for r in rows])
+#           async for row in fapi.iter_search(jspec, page_size=10000):
+#               ...
+#   asyncio.run(main())
+
+# Python Standard Library
+from pathlib import Path
+from urllib.parse import urlencode
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import os
+import time
+# External Packages
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+# Local Packages
+from helpers.api import (AdaApi, Rec, CHUNK_SIZE, RETRY_STATUS,
+                         check_jspec_fields, check_jspec_terms,
+                         csv_converter, file_md5)
+from helpers.cache import MetadataCache
+
+
+class AsyncAdaApi():
+    """Astro Data Archive (asyncio)
+
+    All requests go through one aiohttp SESSION with a pool of up to
+    POOL_SIZE connections.  At most MAX_CONCURRENCY requests (or
+    downloads) run at once; pass the SESSION and SEMAPHORE of another
+    instance to share its pool and limit, e.g.
+    AsyncFitsHdu(session=fapi.session, semaphore=fapi.semaphore).
+    Failed connections and responses with a status in RETRY_STATUS are
+    retried like helpers.api.make_session does (so a POST is not sent
+    again after a read timeout).  Searches use SEARCH_TIMEOUT instead
+    of TIMEOUT (see helpers.api.AdaApi).  Use as
+    "async with ...:" (or call open() and close()).
+    See helpers.api.AdaApi for the other parameters.
+    """
+    expected_version = AdaApi.expected_version
+
+    def __init__(self,
+                 url='https://astroarchive.noao.edu',  verbose=False,
+                 username=None,  password=None,
+                 session=None, pool_size=100, max_concurrency=100,
+                 semaphore=None, retries=3, backoff=0.5, timeout=(5, 60),
+                 search_timeout=(5, 600), metadata_cache=None,
+                 validate=False):
+        if aiohttp is None:
+            raise Exception('helpers.aioapi needs aiohttp '
+                            '(pip install aiohttp)')
+        self.apiurl = f'{url}/api'
+        self.adsurl = f'{url}/api/adv_search'
+        self.siaurl = f'{url}/api/sia'
+        self.username = username
+        self.password = password
+        self.token = None
+        self.version = None
+        self.verbose = verbose
+        self.dtypes = dict() # dict((type,instrument,proctype)) = field dtypes
+        self.session = session
+        self.own_session = session is None
+        self.pool_size = pool_size
+        self.semaphore = semaphore or asyncio.Semaphore(max_concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = aiohttp.ClientTimeout(sock_connect=timeout[0],
+                                             sock_read=timeout[1])
+        self.search_timeout = aiohttp.ClientTimeout(
+            sock_connect=search_timeout[0], sock_read=search_timeout[1])
+        self.metadata_cache = metadata_cache or MetadataCache()
+        self.validate = validate
+
+    async def open(self):
+        """Create the SESSION (unless one was given) and log in (if a
+        USERNAME was given)."""
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=self.timeout)
+        if self.username is not None and self.token is None:
+            status, self.token = await self.fetch_json(
+                'POST', f'{self.apiurl}/get_token/', ok=None,
+                json=dict(email=self.username, password=self.password))
+            if status != 200:
+                self.token = None
+                raise Exception(f'Credentials given '
+                                f'(username="{self.username}") '
+                                f'could not be authenticated.')
+        return(self)
+
+    async def close(self):
+        """Close the SESSION (if this instance made it)."""
+        if self.own_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return(await self.open())
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def request(self, method, url, **kwargs):
+        """Return the response of METHOD on URL, retried on connection
+        errors and RETRY_STATUS (a POST only if it could not have
+        reached the server).  The caller must release it."""
+        if self.session is None:
+            await self.open()
+        if self.verbose:
+            print(f'{method} "{url}"')
+        for attempt in range(self.retries + 1):
+            try:
+                res = await self.session.request(method, url, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as err:
+                if attempt == self.retries or (
+                        method == 'POST'
+                        and not isinstance(err, aiohttp.ClientConnectorError)):
+                    raise
+            else:
+                if res.status not in RETRY_STATUS or attempt == self.retries:
+                    return(res)
+                retry_after = res.headers.get('Retry-After', '')
+                res.release()
+                if retry_after.isdigit():
+                    await asyncio.sleep(float(retry_after))
+                    continue
+            await asyncio.sleep(self.backoff * 2**attempt)
+
+    async def fetch(self, method, url, ok=(200,), **kwargs):
+        """Return (status, content bytes) of METHOD on URL.  Raise
+        Exception if status is not in OK (None: accept any)."""
+        async with self.semaphore:
+            res = await self.request(method, url, **kwargs)
+            async with res:
+                content = await res.read()
+        if ok is not None and res.status not in ok:
+            raise Exception(f'status={res.status} content={content}')
+        return(res.status, content)
+
+    async def fetch_json(self, method, url, ok=(200,), **kwargs):
+        status, content = await self.fetch(method, url, ok=ok, **kwargs)
+        return(status, json.loads(content))
+
+    async def search(self, jspec, limit=False, format='json', offset=None):
+        """Search Archive for records (per JSPEC) and return (info, rows).
+        See helpers.api.AdaApi.search()."""
+        if self.validate:
+            await self.validate_jspec(jspec)
+        if format == 'csv':
+            dtypes = await self.field_dtypes(jspec)
+        params = dict(limit=None if limit is None else (limit or self.limit),
+                      format=format)
+        if offset:
+            params['offset'] = offset
+        t = 'h' if self.type == Rec.Hdu else 'f'
+        url = f'{self.adsurl}/{t}asearch/?{urlencode(params)}'
+        status, content = await self.fetch('POST', url, json=jspec,
+                                           timeout=self.search_timeout)
+        if format == 'xml':
+            return(content)
+        if format == 'csv':
+            return(self.parse_csv(content, params['limit'], dtypes))
+        result = json.loads(content)
+        return(result[0], result[1:])
+
+    def parse_csv(self, content, limit, dtypes):
+        reader = csv.reader(io.StringIO(content.decode('utf-8'), newline=''))
+        fields = next(reader, [])
+        converters = [csv_converter(dtypes.get(name)) for name in fields]
+        rows = [tuple([convert(text) for convert, text
+                       in zip(converters, row)])
+                for row in reader]
+        info = dict(HEADER=dict(outfields=fields, format='csv'),
+                    RESULTS=dict(COUNT=len(rows),
+                                 MORE=limit is not None and len(rows) >= limit))
+        return(info, rows)
+
+    async def iter_pages(self, jspec, page_size=None, prefetch=True):
+        """Yield (info, rows) for successive pages of (up to) PAGE_SIZE
+        search results until the server reports no MORE results.
+        If PREFETCH, the next page is requested while the caller
+        processes the current one."""
+        page_size = page_size or self.limit
+        offset = 0
+        page = asyncio.ensure_future(self.search(jspec, limit=page_size))
+        try:
+            while True:
+                info, rows = await page
+                more = bool(info['RESULTS']['MORE']) and len(rows) > 0
+                offset += len(rows)
+                if more:
+                    page = self.search(jspec, limit=page_size, offset=offset)
+                    if prefetch:
+                        page = asyncio.ensure_future(page)
+                yield(info, rows)
+                if not more:
+                    break
+        finally:
+            if isinstance(page, asyncio.Future):
+                page.cancel()
+            else:
+                page.close()
+
+    async def iter_search(self, jspec, page_size=None, prefetch=True):
+        """Yield all rows matching JSPEC, a page at a time (see
+        iter_pages)."""
+        async for info, rows in self.iter_pages(jspec, page_size=page_size,
+                                                prefetch=prefetch):
+            for row in rows:
+                yield row
+
+    async def vosearch(self, ra, dec, size, limit=100, format='json'):
+        """Search Archive for records in box of SIZE (degrees) centered
+        at RA, DEC."""
+        t = 'hdu' if self.type == Rec.Hdu else 'img'
+        qstr = urlencode(dict(POS=f'{ra},{dec}',
+                              SIZE=size,
+                              limit=None if limit is None else (limit or self.limit),
+                              format=format))
+        status, content = await self.fetch('GET',
+                                           f'{self.siaurl}/vo{t}?{qstr}',
+                                           timeout=self.search_timeout)
+        if format == 'json':
+            result = json.loads(content)
+            return(result[0], result[1:])
+        return(content)
+
+    async def get_metadata(self, url):
+        """Return the (JSON) response of metadata service URL, from
+        METADATA_CACHE when possible."""
+        value = self.metadata_cache.lookup(url)
+        if value is None:
+            status, value = await self.fetch_json('GET', url)
+            self.metadata_cache.put(url, value)
+        return(value)
+
+    async def get_version(self):
+        return(await self.get_metadata(f'{self.apiurl}/version/'))
+
+    async def check_version(self):
+        """Insure this library in consistent with the API version."""
+        self.version = await self.get_version()
+        return(float(self.version) == self.expected_version)
+
+    async def get_categoricals(self):
+        return(await self.get_metadata(f'{self.adsurl}/cat_lists/'))
+
+    async def get_aux_fields(self, instrument, proctype, rectype=None):
+        t = 'hdu' if (rectype or self.type) == Rec.Hdu else 'file'
+        return(await self.get_metadata(
+            f'{self.adsurl}/aux_{t}_fields/{instrument}/{proctype}/'))
+
+    async def get_core_fields(self, rectype=None):
+        t = 'hdu' if (rectype or self.type) == Rec.Hdu else 'file'
+        return(await self.get_metadata(f'{self.adsurl}/core_{t}_fields/'))
+
+    async def get_fields(self, jspec):
+        """Return list of (prefix, dtypes) of the core (and aux) fields
+        usable in JSPEC; see helpers.api.AdaApi.field_dtypes()."""
+        from helpers.columnar import fields_to_dtypes
+        terms = {t[0].replace('fitsfile__', ''): t[1]
+                 for t in jspec.get('search', []) if len(t) == 2}
+        parts = [('', self.get_core_fields())]
+        if self.type == Rec.Hdu:
+            parts.insert(0, ('fitsfile__',
+                             self.get_core_fields(rectype=Rec.File)))
+        if 'instrument' in terms and 'proc_type' in terms:
+            parts.append(('', self.get_aux_fields(terms['instrument'],
+                                                  terms['proc_type'])))
+        results = await asyncio.gather(*[get for prefix, get in parts],
+                                       return_exceptions=True)
+        return([(prefix, (fields_to_dtypes(result)
+                          if not isinstance(result, Exception) else result))
+                for (prefix, get), result in zip(parts, results)])
+
+    async def field_dtypes(self, jspec):
+        """Return dict(field) = numpy dtype for the fields that can be
+        used in JSPEC (empty for fields whose types are unavailable)."""
+        terms = {t[0].replace('fitsfile__', ''): t[1]
+                 for t in jspec.get('search', []) if len(t) == 2}
+        key = (self.type, terms.get('instrument'), terms.get('proc_type'))
+        if key in self.dtypes:
+            return(self.dtypes[key])
+        dtypes = dict()
+        complete = True
+        for prefix, result in await self.get_fields(jspec):
+            if isinstance(result, Exception):
+                complete = False
+                if self.verbose:
+                    print(f'Could not get field types; {result}')
+                continue
+            dtypes.update({f'{prefix}{k}': v for k,v in result.items()})
+        if complete:
+            self.dtypes[key] = dtypes
+        return(dtypes)
+
+    async def validate_jspec(self, jspec):
+        """See helpers.api.AdaApi.validate_jspec()."""
+        check_jspec_terms(jspec, await self.get_categoricals())
+        names = set()
+        for prefix, result in await self.get_fields(jspec):
+            if isinstance(result, Exception):
+                raise result
+            names.update(f'{prefix}{k}' for k in result)
+        check_jspec_fields(jspec, names)
+        return(True)
+
+
+class AsyncFitsFile(AsyncAdaApi):
+    def __init__(self,
+                 url='https://astroarchive.noao.edu',
+                 verbose=False,
+                 limit=10,
+                 username=None,  password=None,
+                 **kwargs):
+        super().__init__(url=url.rstrip('/'), verbose=verbose,
+                         username=username, password=password, **kwargs)
+        self.type = Rec.File
+        self.limit = limit
+
+    def retrieve_url(self, fileid, hdu=None):
+        qparams = '' if hdu is None else f'?hdu={hdu}'
+        return(f'{self.apiurl}/retrieve/{fileid}/{qparams}')
+
+    def auth_headers(self):
+        return({} if self.token is None else dict(Authorization=self.token))
+
+    async def retrieve(self, fileid, hdu=None):
+        """Return content (bytes) of one FITS file (or HDU) from Archive.
+        For big files use retrieve_to() or iter_retrieve() instead."""
+        status, content = await self.fetch('GET',
+                                           self.retrieve_url(fileid, hdu),
+                                           headers=self.auth_headers())
+        return(content)
+
+    async def open_retrieve(self, fileid, hdu=None, offset=0):
+        """Return the response for content of FILEID starting at byte
+        OFFSET. See helpers.api.FitsFile.open_retrieve()."""
+        headers = self.auth_headers()
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+        res = await self.request('GET', self.retrieve_url(fileid, hdu),
+                                 headers=headers)
+        if res.status in (200, 206) or (offset and res.status == 416):
+            return(res)
+        async with res:
+            raise Exception(f'Could not retrieve {fileid}; '
+                            f'status={res.status} '
+                            f'content={await res.read()}')
+
+    async def iter_retrieve(self, fileid, hdu=None, chunk_size=CHUNK_SIZE):
+        """Yield content of one FITS file (or HDU) as chunks of bytes
+        of (at most) CHUNK_SIZE."""
+        async with self.semaphore:
+            async with await self.open_retrieve(fileid, hdu=hdu) as res:
+                async for chunk in res.content.iter_chunked(chunk_size):
+                    yield chunk
+
+    async def retrieve_to(self, fileid, dest, hdu=None, chunk_size=CHUNK_SIZE,
+                          callback=None, verify=True, resume=True):
+        """Stream one FITS file (or HDU) from Archive into the file at
+        path DEST.  Return the number of bytes downloaded.
+        See helpers.api.FitsFile.retrieve_to().  Hashing and writing
+        run in worker threads so they do not stall the event loop."""
+        md5 = hashlib.md5() if (verify and hdu is None) else None
+        dest = Path(dest).expanduser()
+        if md5 is not None and dest.exists():
+            digest = await asyncio.to_thread(file_md5, dest, chunk_size)
+            if digest.hexdigest() == fileid:
+                return(0)
+        part = dest.with_name(dest.name + '.part')
+        offset = part.stat().st_size if (resume and part.exists()) else 0
+        if offset and md5 is not None:
+            md5 = await asyncio.to_thread(file_md5, part, chunk_size)
+
+        def write(fileobj, chunk, md5):
+            fileobj.write(chunk)
+            if md5 is not None:
+                md5.update(chunk)
+
+        nbytes = 0
+        start = time.monotonic()
+        async with self.semaphore:
+            res = await self.open_retrieve(fileid, hdu=hdu, offset=offset)
+            async with res:
+                if res.status != 416:
+                    if res.status == 200 and md5 is not None:
+                        md5 = hashlib.md5() # server sent the whole file
+                    mode = 'ab' if res.status == 206 else 'wb'
+                    fileobj = await asyncio.to_thread(open, part, mode)
+                    try:
+                        async for chunk in res.content.iter_chunked(chunk_size):
+                            await asyncio.to_thread(write, fileobj, chunk, md5)
+                            nbytes += len(chunk)
+                            if callback is not None:
+                                elapsed = time.monotonic() - start
+                                callback(nbytes, nbytes / elapsed
+                                         if elapsed > 0 else 0.0)
+                    finally:
+                        await asyncio.to_thread(fileobj.close)
+        if md5 is not None and md5.hexdigest() != fileid:
+            part.unlink()
+            raise Exception(f'Retrieved content of {fileid} is corrupt; '
+                            f'md5sum={md5.hexdigest()}')
+        os.replace(part, dest)
+        return(nbytes)
+
+
+class AsyncFitsHdu(AsyncAdaApi):
+    def __init__(self,
+                 url='https://astroarchive.noao.edu',
+                 limit=20,
+                 verbose=False,
+                 username=None,  password=None,
+                 **kwargs):
+        super().__init__(url=url.rstrip('/'), verbose=verbose,
+                         username=username, password=password, **kwargs)
+        self.type = Rec.Hdu
+        self.limit = limit
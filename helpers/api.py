@@ -1,9 +1,25 @@
 # Python Standard Library
 from urllib.parse import urlencode
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+import codecs
+import csv
+import datetime
+import hashlib
+import io
+import json
+import os
+import re
+import time
 from enum import Enum,auto
 from pprint import pformat as pf
 # External Packages
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+# Local Packages
+from helpers.cache import MetadataCache
 
 
 # TODO:
@@ -15,14 +31,9 @@ import requests
 #   ads search, HEADER in response should give full URL for 'endpoint'
 #   Authentication.
 #   VERBOSE mode (for debugging)
-#   Cache categoricals, validate against them, output possibles on error.
 #   Split RESPONSE into: header + rows
 #   Use Keyword arguments almost everywhere
-#   Implement timeout:
-#      https://requests.readthedocs.io/en/master/user/advanced/#timeout
-#   Use Session in AdaApi class
-#   Cache calls to relatively static content:
-#      cat_lists, version, *_*_fields, *adoc,
+#   Cache calls to relatively static content: *adoc
 #
 
 class Rec(Enum):
@@ -41,23 +52,314 @@ class SiaFormat(Enum):
     Votable = auto() # XML
     
 
+# HTTP status codes that are worth retrying (with backoff).
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# Bytes read from the network (and written to disk) at a time when streaming.
+CHUNK_SIZE = 2**20
+# Search field name => key of its allowed values in cat_lists
+CATEGORICAL_FIELDS = dict(instrument='instruments',
+                          telescope='telescopes',
+                          proc_type='proctypes',
+                          prod_type='prodtypes',
+                          obs_mode='obsmodes',
+                          obs_type='obstypes',
+                          site='sites',
+                          survey='surveys')
+
+class PostSafeRetry(Retry):
+    """Retry that never sends a POST (search) again after it may have
+    reached the server without an answer (read timeout, dropped
+    connection): that would repeat a long query on the server."""
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        if (method == 'POST' and error is not None
+            and self._is_read_error(error)):
+            raise error
+        return(super().increment(method=method, url=url, response=response,
+                                 error=error, _pool=_pool,
+                                 _stacktrace=_stacktrace))
+
+def make_session(pool_size=10, retries=3, backoff=0.5):
+    """Create a requests Session with a keep-alive connection pool.
+
+    POOL_SIZE is the max number of connections kept open per host.
+    Failed connections and responses with a status in RETRY_STATUS are
+    retried up to RETRIES times, sleeping BACKOFF*(2**n) seconds
+    between tries (honoring any Retry-After header).  Read errors are
+    retried for GET but not for POST (see PostSafeRetry).
+    """
+    retry = PostSafeRetry(total=retries,
+                          backoff_factor=backoff,
+                          status_forcelist=RETRY_STATUS,
+                          allowed_methods=None,  # retry POST (search) too
+                          raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return(session)
+
+
+# Bytes of a search response parsed at a time when streaming.
+JSON_CHUNK_SIZE = 2**16
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+def iter_json_array(chunks, decoder=None):
+    """Yield elements of a JSON array whose (utf-8) text arrives as
+    CHUNKS of bytes, e.g. res.iter_content() of a streaming response.
+
+    Elements are decoded as soon as all of their text has arrived, so
+    memory use is bounded by the largest element (plus one chunk)
+    rather than the size of the whole array.  When possible, all the
+    complete elements in the buffer are decoded in one call to DECODER.
+    """
+    decoder = decoder or json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf, pos = '', 0
+    batch = False # decode many elements at once?
+
+    def more():
+        # Append more text to BUF (dropping what was consumed).
+        nonlocal buf, pos, batch
+        for chunk in chunks:
+            text = utf8.decode(chunk)
+            if text:
+                buf, pos = buf[pos:] + text, 0
+                batch = True
+                return(True)
+        return(False)
+
+    def skip_to_token():
+        # Skip whitespace; return next character (or '' at the end).
+        nonlocal pos
+        while True:
+            pos = WHITESPACE.match(buf, pos).end()
+            if pos < len(buf) or not more():
+                return(buf[pos:pos+1])
+
+    if skip_to_token() != '[':
+        raise ValueError(f'Expected JSON array, got: {buf[pos:pos+80]!r}')
+    pos += 1
+    if skip_to_token() == ']':
+        return
+    while True:
+        if batch:
+            # Decode everything up to the last comma that follows an
+            # object.  If that comma is inside a string (or nested
+            # value) decoding fails and we go one element at a time.
+            cut = buf.rfind('},', pos)
+            cut = cut + 1 if cut >= 0 else buf.rfind(',', pos)
+            if cut > pos:
+                text = '[' + buf[pos:cut] + ']'
+                try:
+                    elements, end = decoder.raw_decode(text)
+                except json.JSONDecodeError:
+                    end = None
+                if end == len(text):
+                    pos = cut + 1
+                    skip_to_token()
+                    yield from elements
+                    continue
+            batch = False
+        try:
+            element, end = decoder.raw_decode(buf, pos)
+            # A number at the end of BUF may continue in the next chunk.
+            if (buf[pos] not in '{["'
+                and (end == len(buf) or buf[end] not in ' \t\n\r,]')
+                and more()):
+                continue
+        except json.JSONDecodeError:
+            if more():
+                continue
+            raise
+        pos = end
+        yield element
+        token = skip_to_token()
+        if token == ']':
+            return
+        if token != ',':
+            raise ValueError(f'Expected "," or "]" in JSON array, '
+                             f'got: {buf[pos:pos+80]!r}')
+        pos += 1
+        skip_to_token()
+
+
+def csv_value(text):
+    """Return TEXT (one CSV field of unknown type) as an int, float, str
+    or None (if empty).  Only text that reads back the same way as a
+    number is converted, so e.g. "0042" and md5sums stay str."""
+    if text == '':
+        return(None)
+    try:
+        if str(int(text)) == text:
+            return(int(text))
+    except ValueError:
+        pass
+    try:
+        value = float(text)
+        if (text.lstrip('-')[:1].isdigit() and not text.startswith('00')
+            and any(c in text for c in '.eE')):
+            return(value)
+    except ValueError:
+        pass
+    return(text)
+
+def csv_converter(dtype):
+    """Return function converting CSV text to a value of numpy DTYPE
+    (None means type unknown, see csv_value)."""
+    if dtype is None:
+        return(csv_value)
+    kind = dtype.kind
+    def convert(text):
+        if text == '':
+            return(None)
+        try:
+            if kind == 'f':
+                return(float(text))
+            if kind in 'iu':
+                return(int(text))
+        except ValueError:
+            return(csv_value(text))
+        if kind == 'b':
+            return(text.lower() in ('true', 't', '1'))
+        return(text)
+    return(convert)
+
+
+def check_jspec_terms(jspec, categoricals):
+    """Raise Exception if JSPEC is malformed or searches a categorical
+    field for a value not in CATEGORICALS (response of cat_lists)."""
+    if not isinstance(jspec, dict):
+        raise Exception(f'Search spec must be a dict, not: {jspec!r}')
+    unknown = set(jspec) - {'outfields', 'search'}
+    if unknown:
+        raise Exception(f'Unknown search spec keys: {sorted(unknown)}; '
+                        f'possible: ["outfields", "search"]')
+    for term in jspec.get('search', []):
+        if not isinstance(term, (list, tuple)) or len(term) < 2:
+            raise Exception(f'Search term must be [field, value, ...], '
+                            f'not: {term!r}')
+        catname = CATEGORICAL_FIELDS.get(term[0].replace('fitsfile__', ''))
+        if (catname in categoricals and len(term) == 2
+            and term[1] not in categoricals[catname]):
+            raise Exception(f'Bad value {term[1]!r} for {term[0]}; '
+                            f'possible: {categoricals[catname]}')
+
+def check_jspec_fields(jspec, names):
+    """Raise Exception if JSPEC uses fields not in NAMES."""
+    used = list(jspec.get('outfields', []))
+    used += [t[0] for t in jspec.get('search', [])]
+    bad = [name for name in used if name not in names]
+    if bad:
+        raise Exception(f'Unknown fields: {bad} '
+                        f'(aux fields need searching for instrument '
+                        f'and proc_type); possible: {sorted(names)}')
+
+
+def split_range(lo, hi, shards, continuous=None):
+    """Return up to SHARDS (lo, hi) sub-ranges covering the (inclusive)
+    range LO to HI.  LO and HI are numbers, dates or datetimes (or
+    their ISO strings, giving strings).  If CONTINUOUS, neighbouring
+    ranges share their boundary (and dates are split as datetimes);
+    else they are disjoint ranges of ints or dates.  By default, ranges
+    of ints and dates are disjoint and those of floats and datetimes
+    are not."""
+    if isinstance(lo, str):
+        if continuous is None:
+            continuous = len(lo) != 10
+        parse = (parse_datetime if continuous
+                 else datetime.date.fromisoformat)
+        return([(a.isoformat(), b.isoformat()) for a, b
+                in split_range(parse(lo), parse(hi), shards, continuous)])
+    if isinstance(lo, datetime.date) and not isinstance(lo, datetime.datetime):
+        if continuous:
+            return(split_range(datetime.datetime.combine(lo, datetime.time()),
+                               datetime.datetime.combine(hi, datetime.time()),
+                               shards, continuous))
+        return([(datetime.date.fromordinal(a), datetime.date.fromordinal(b))
+                for a, b in split_range(lo.toordinal(), hi.toordinal(),
+                                        shards, False)])
+    if continuous is None:
+        continuous = not (isinstance(lo, int) and isinstance(hi, int))
+    if not continuous:
+        count = hi - lo + 1
+        n = max(1, min(shards, count))
+        starts = [lo + count * i // n for i in range(n)]
+        return(list(zip(starts, [s - 1 for s in starts[1:]] + [hi])))
+    n = shards if hi > lo else 1
+    bounds = [lo + (hi - lo) * i / n for i in range(n)] + [hi]
+    return(list(zip(bounds[:-1], bounds[1:])))
+
+def parse_datetime(text):
+    """Return naive (UTC) datetime of ISO string TEXT, which may have a
+    timezone (e.g. "2019-01-01T06:00:00Z" or "...+01:00")."""
+    value = datetime.datetime.fromisoformat(re.sub(r'[Zz]$', '+00:00',
+                                                   text))
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return(value)
+
+def file_md5(path, chunk_size=CHUNK_SIZE):
+    """Return md5 hash object of the content of the file at PATH."""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fileobj:
+        for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+            md5.update(chunk)
+    return(md5)
+
+
 class AdaApi():
-    """Astro Data Archive"""
+    """Astro Data Archive
+
+    All requests go through one pooled, keep-alive SESSION.  Pass the
+    SESSION of an existing instance to share its connection pool,
+    e.g. FitsHdu(url, session=fapi.session).  Otherwise one is made
+    from POOL_SIZE, RETRIES and BACKOFF (see make_session).
+    TIMEOUT is (connect_seconds, read_seconds) for every request but
+    searches, which use SEARCH_TIMEOUT (by default with a read timeout
+    of 10 minutes, since big queries may run long before the first
+    byte; a timed out search is not sent again).
+    CACHE (a helpers.cache.SearchCache) if given, keeps the results of
+    search() and search_columns() (not streamed ones) between runs.
+    Responses of the metadata services (categoricals, fields, version)
+    are kept in METADATA_CACHE (a helpers.cache.MetadataCache, by
+    default in memory only).  If VALIDATE, search specs are checked
+    against them before being sent (see validate_jspec).
+    """
     expected_version = 5.0
 
     def __init__(self,
                  url='https://astroarchive.noao.edu',  verbose=False,
-                 username=None,  password=None):
+                 username=None,  password=None,
+                 session=None, pool_size=10, retries=3, backoff=0.5,
+                 timeout=(5, 60), search_timeout=(5, 600), cache=None,
+                 metadata_cache=None, validate=False):
         self.apiurl = f'{url}/api'
         self.adsurl = f'{url}/api/adv_search'
         self.siaurl = f'{url}/api/sia'
         self.categoricals = None
+        self.dtypes = dict() # dict((type,instrument,proctype)) = field dtypes
         self.token = None
         self.version = None
         self.verbose = verbose
+        self.timeout = timeout
+        self.search_timeout = search_timeout
+        self.cache = cache
+        self.metadata_cache = metadata_cache or MetadataCache()
+        self.validate = validate
+        if session is None:
+            session = make_session(pool_size=pool_size,
+                                   retries=retries, backoff=backoff)
+        self.session = session
         if username is not None:
-            res = requests.post(f'{apiurl}/get_token/',
-                                json=dict(email=username, password=password))
+            res = self.session.post(f'{self.apiurl}/get_token/',
+                                    json=dict(email=username,
+                                              password=password),
+                                    timeout=self.timeout)
             if res.status_code == 200:
                 self.token = res.json()
             else:
@@ -68,26 +370,47 @@ class AdaApi():
                        f'only be allowed to retrieve PUBLIC files. '
                        f'You can still get any metadata.' )
                 raise Exception(msg)
-            
-    def search(self, jspec, limit=False, format='json'):
-        # VALIDATE params @@@
-        qstr = urlencode(dict(limit=None if limit is None else (limit or self.limit),
-                              format=format))
-        t = 'h' if self.type == Rec.Hdu else 'f'
-        url = f'{self.adsurl}/{t}asearch/?{qstr}'
-        if self.verbose:
-            print(f'Search invoking "{url}" with: {jspec}')
-        res = requests.post(url, json=jspec)
-        if self.verbose:
-            print(f'Search status={res.status_code} res={res.content}')
 
-        if res.status_code != 200:
-            raise Exception(res)
+    def close(self):
+        """Close all pooled connections (shared with other instances
+        using the same session)."""
+        self.session.close()
+
+    def search(self, jspec, limit=False, format='json', offset=None,
+               stream=False):
+        """Search Archive for records (per JSPEC) and return (info, rows).
+
+        For format='json' rows are dicts, for format='csv' (a cheaper
+        encoding for wide results) rows are tuples of values (int,
+        float, str or None) in the order of info['HEADER']['outfields'].
+        For format='xml' the raw content is returned.
 
+        If STREAM (json or csv), rows is an iterator that parses each
+        row as it arrives from the server, so memory use does not depend
+        on the number of rows.  Iterate it to the end (or close() it) to
+        release the connection.
+        """
+        if self.cache is not None and not stream and format != 'xml':
+            key = self.cache_key(jspec, limit, format, offset, 'rows')
+            hit = self.cache.get(key)
+            if hit is not None:
+                return(hit)
+            info, rows = self.search(jspec, limit=limit, format=format,
+                                     offset=offset, stream=True)
+            rows = list(rows)
+            self.cache.put(key, info, rows)
+            return(info, rows)
+        res = self.post_search(jspec, limit=limit, format=format,
+                               offset=offset,
+                               stream=stream or format == 'csv')
         if format == 'csv':
-            return(res.content)
+            info, rows = self.stream_csv(res, limit=self.search_limit(limit),
+                                         dtypes=self.field_dtypes(jspec))
+            return((info, rows) if stream else (info, list(rows)))
         elif format == 'xml':
             return(res.content)
+        elif stream:
+            return(self.stream_json(res))
         else: #'json'
             result = res.json()
             info = result.pop(0)
@@ -96,23 +419,371 @@ class AdaApi():
                 print(f'info={pf(info)} rows={pf(rows)}')
             return(info, rows)
 
-    def vosearch(self, ra, dec, size, limit=100, format='json'):
+    def search_limit(self, limit):
+        """Return the limit sent for search LIMIT: None (no limit) stays
+        None, False (or 0) means the default LIMIT of this instance."""
+        return(None if limit is None else (limit or self.limit))
+
+    def cache_key(self, jspec, limit, format, offset, kind):
+        limit = self.search_limit(limit)
+        return(self.cache.key(self.adsurl, self.type.name, jspec, limit,
+                              format, offset, kind))
+
+    def post_search(self, jspec, limit=False, format='json', offset=None,
+                    stream=False):
+        """Send search JSPEC to the Archive and return the response."""
+        if self.validate:
+            self.validate_jspec(jspec)
+        params = dict(limit=self.search_limit(limit), format=format)
+        if offset:
+            params['offset'] = offset
+        qstr = urlencode(params)
+        t = 'h' if self.type == Rec.Hdu else 'f'
+        url = f'{self.adsurl}/{t}asearch/?{qstr}'
+        if self.verbose:
+            print(f'Search invoking "{url}" with: {jspec}')
+        res = self.session.post(url, json=jspec, timeout=self.search_timeout,
+                                stream=stream)
+        if self.verbose and not stream:
+            print(f'Search status={res.status_code} res={res.content}')
+
+        if res.status_code != 200:
+            raise Exception(res)
+        return(res)
+
+    def stream_csv(self, res, limit=None, dtypes=None, typed=True):
+        """Return (info, rows) from streaming CSV response RES (whose first
+        line names the fields), where rows is an iterator of tuples.
+        When TYPED, values are converted per DTYPES (dict(field) = numpy
+        dtype; see csv_converter), else left as strings.  Like the JSON
+        header, info has HEADER and RESULTS but RESULTS (COUNT, MORE) is
+        only filled in once rows is exhausted; MORE is True when LIMIT
+        rows were returned.
+        """
+        res.raw.decode_content = True # undo any gzip Content-Encoding
+        res.raw.auto_close = False # TextIOWrapper reads past EOF
+        # Not res.encoding: that is ISO-8859-1 for text/csv without charset
+        charset = re.search(r'charset=["\']?([\w.:-]+)',
+                            res.headers.get('Content-Type', ''), re.I)
+        text = io.TextIOWrapper(res.raw,
+                                encoding=charset.group(1) if charset
+                                else 'utf-8',
+                                newline='')
+        reader = csv.reader(text)
+        fields = next(reader, [])
+        info = dict(HEADER=dict(outfields=fields, format='csv'),
+                    RESULTS=dict(COUNT=None, MORE=None))
+        dtypes = dtypes or {}
+        converters = [csv_converter(dtypes.get(name)) for name in fields]
+        def rows():
+            count = 0
+            with res:
+                for row in reader:
+                    count += 1
+                    yield(tuple([convert(text) for convert, text
+                                 in zip(converters, row)])
+                          if typed else row)
+            info['RESULTS'].update(COUNT=count,
+                                   MORE=limit is not None and count >= limit)
+        return(info, rows())
+
+    def stream_json(self, res):
+        """Return (info, rows) from streaming response RES containing a
+        JSON array [info, row, row, ...] where rows is an iterator."""
+        elements = iter_json_array(res.iter_content(JSON_CHUNK_SIZE))
+        try:
+            info = next(elements)
+        except BaseException:
+            res.close()
+            raise
+        def rows():
+            with res:
+                yield from elements
+        return(info, rows())
+
+    def iter_pages(self, jspec, page_size=None, prefetch=False):
+        """Yield (info, rows) for successive pages of (up to) PAGE_SIZE
+        search results until the server reports no MORE results.
+
+        If PREFETCH, the next page is requested in a background thread
+        while the caller processes the current one.  Pages are fetched
+        by offset, so results should not change while paging.
+        """
+        page_size = page_size or self.limit
+        pool = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        fetch = lambda offset: self.search(jspec, limit=page_size,
+                                           offset=offset)
+        try:
+            offset = 0
+            page = fetch(offset)
+            while True:
+                info, rows = page
+                more = bool(info['RESULTS']['MORE']) and len(rows) > 0
+                offset += len(rows)
+                if more and pool is not None:
+                    future = pool.submit(fetch, offset)
+                yield(info, rows)
+                if not more:
+                    break
+                page = fetch(offset) if pool is None else future.result()
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+    def iter_search(self, jspec, page_size=None, prefetch=False):
+        """Yield all rows matching JSPEC (no matter how many) without
+        holding more than a page or two of them in memory.
+        See iter_pages().  Without PREFETCH the rows of each page are
+        parsed as they arrive, so only one row is held at a time."""
+        if prefetch:
+            for info, rows in self.iter_pages(jspec, page_size=page_size,
+                                              prefetch=prefetch):
+                yield from rows
+            return
+        page_size = page_size or self.limit
+        offset = 0
+        while True:
+            info, rows = self.search(jspec, limit=page_size, offset=offset,
+                                     stream=True)
+            count = 0
+            for row in rows:
+                count += 1
+                yield row
+            offset += count
+            if not info['RESULTS']['MORE'] or count == 0:
+                break
+
+    def sharded_search(self, jspec, field, shards=8, workers=4,
+                       shard_limit=None, key=None, max_splits=8,
+                       continuous=None):
+        """Yield all rows matching JSPEC using concurrent searches.
+
+        The range term of JSPEC on FIELD (e.g. ["caldat", "2018-09-01",
+        "2020-09-01"] or ["ra_min", 10.0, 20.0]) is split into SHARDS
+        sub-ranges (see split_range) searched by up to WORKERS threads at
+        a time.  A shard with MORE than SHARD_LIMIT results is split in
+        two and searched again; one that cannot be split (or already was
+        MAX_SPLITS times) is paged through instead.  Rows are yielded as
+        their shards complete.
+
+        Unless CONTINUOUS, shards are disjoint: ranges of int fields
+        (per field_dtypes) and of dates.  Ranges of other numeric fields
+        and of datetimes are CONTINUOUS (pass True for a range of dates
+        on a datetime field such as dateobs); such shards share their
+        boundaries, so rows with FIELD on a shared boundary are yielded
+        once, telling them apart by the values of the fields KEY
+        (required for such shards, e.g. ['md5sum']).
+        """
+        terms = list(jspec.get('search', []))
+        index = next((i for i, t in enumerate(terms)
+                      if t[0] == field and len(t) == 3), None)
+        if index is None:
+            raise Exception(f'No range term on "{field}" in {jspec}')
+        lo, hi = terms[index][1:]
+        shard_limit = shard_limit or self.limit
+        numeric = not isinstance(lo, (str, datetime.date))
+        if continuous is None and numeric:
+            dtype = self.field_dtypes(jspec).get(field)
+            continuous = dtype is None or dtype.kind not in 'iu'
+        halves = split_range(lo, hi, 2, continuous)
+        overlap = len(halves) == 2 and halves[0][1] == halves[1][0]
+        if overlap and key is None:
+            raise Exception(f'Shards of "{field}" share their boundaries; '
+                            f'give KEY to tell their rows apart')
+        outfields = list(jspec.get('outfields', []))
+        extra = overlap and field not in outfields
+        if extra:
+            outfields.append(field)
+        parse = float if numeric else parse_datetime
+
+        def search(lo, hi, splits):
+            # Return rows of one shard or None if it must be split.
+            sub = dict(jspec, outfields=outfields,
+                       search=(terms[:index] + [[field, lo, hi]]
+                               + terms[index+1:]))
+            if (splits >= max_splits
+                or len(split_range(lo, hi, 2, continuous)) < 2):
+                return(list(self.iter_search(sub, page_size=shard_limit)))
+            info, rows = self.search(sub, limit=shard_limit)
+            return(None if info['RESULTS']['MORE'] else rows)
+
+        def on_boundary(row):
+            try:
+                return(parse(row[field]) in boundaries)
+            except (KeyError, TypeError, ValueError):
+                return(True)
+
+        boundaries = set()  # FIELD values shared by two shards
+        seen = set()        # KEY of rows yielded with FIELD on a boundary
+        pending = deque((a, b, 0) for a, b
+                        in split_range(lo, hi, shards, continuous))
+        if overlap:
+            boundaries.update(parse(b) for a, b, splits in list(pending)[:-1])
+        running = dict() # dict(future) = (lo, hi, splits)
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            while pending or running:
+                while pending and len(running) < workers:
+                    shard = pending.popleft()
+                    running[pool.submit(search, *shard)] = shard
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    a, b, splits = running.pop(future)
+                    rows = future.result()
+                    if rows is None:
+                        if self.verbose:
+                            print(f'Splitting shard {field}=[{a}, {b}]')
+                        halves = split_range(a, b, 2, continuous)
+                        if overlap:
+                            boundaries.add(parse(halves[0][1]))
+                        pending.extend((c, d, splits + 1) for c, d in halves)
+                        continue
+                    for row in rows:
+                        if overlap and on_boundary(row):
+                            k = tuple(row.get(f) for f in key)
+                            if k in seen:
+                                continue
+                            seen.add(k)
+                        if extra:
+                            row.pop(field, None)
+                        yield row
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def search_columns(self, jspec, limit=False, offset=None, dtypes=None,
+                       frame=False, format='json'):
+        """Search like search() but return (info, columns) where columns
+        is dict(field) = numpy array (or a pandas DataFrame if FRAME).
+
+        Rows are moved into typed columns in batches as the response is
+        parsed, so the rows never all exist as dicts at once.  DTYPES is
+        dict(field) = numpy dtype; by default types come from the core
+        and aux field services (see field_dtypes).  FORMAT is the
+        encoding used on the wire ('json' or 'csv'); the result is the
+        same for both but csv is cheaper for wide results.
+        """
+        if self.cache is None:
+            info, cols = self._build_columns(jspec, limit, offset, dtypes,
+                                             format)
+        else:
+            key = self.cache_key(jspec, limit, format, offset,
+                                 ['columns', dtypes and
+                                  {k: str(v) for k, v in dtypes.items()}])
+            hit = self.cache.get(key)
+            if hit is None:
+                info, cols = self._build_columns(jspec, limit, offset,
+                                                 dtypes, format)
+                self.cache.put(key, info, cols)
+            else:
+                info, cols = hit
+        if frame:
+            import pandas as pd
+            cols = pd.DataFrame(cols)
+        return(info, cols)
+
+    def _build_columns(self, jspec, limit, offset, dtypes, format):
+        from helpers.columnar import ColumnBuilder
+        if dtypes is None:
+            dtypes = self.field_dtypes(jspec)
+        builder = ColumnBuilder(jspec.get('outfields', ()), dtypes)
+        if format == 'csv':
+            res = self.post_search(jspec, limit=limit, format=format,
+                                   offset=offset, stream=True)
+            info, rows = self.stream_csv(res, limit=self.search_limit(limit),
+                                         typed=False)
+            builder.add_all(rows, fields=info['HEADER']['outfields'])
+        else:
+            info, rows = self.search(jspec, limit=limit, offset=offset,
+                                     stream=True)
+            builder.add_all(rows)
+        return(info, builder.to_numpy())
+
+    def iter_columns(self, jspec, page_size=None, dtypes=None, frame=False,
+                     format='json', prefetch=False, offset=0):
+        """Yield (info, columns) per page of PAGE_SIZE rows of all results
+        matching JSPEC, starting with result number OFFSET.
+        See search_columns() and iter_pages()."""
+        if dtypes is None:
+            dtypes = self.field_dtypes(jspec)
+        page_size = page_size or self.limit
+        pool = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        fetch = lambda offset: self.search_columns(
+            jspec, limit=page_size, offset=offset, dtypes=dtypes,
+            frame=frame, format=format)
+        try:
+            page = fetch(offset)
+            while True:
+                info, cols = page
+                count = (len(cols) if frame
+                         else len(next(iter(cols.values()), [])))
+                more = bool(info['RESULTS']['MORE']) and count > 0
+                offset += count
+                if more and pool is not None:
+                    future = pool.submit(fetch, offset)
+                yield(info, cols)
+                if not more:
+                    break
+                page = fetch(offset) if pool is None else future.result()
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+    def field_dtypes(self, jspec):
+        """Return dict(field) = numpy dtype for the fields that can be
+        used in JSPEC, from the core fields and (if JSPEC searches for a
+        single instrument and proc_type) the aux fields."""
+        from helpers.columnar import fields_to_dtypes
+        terms = {t[0].replace('fitsfile__', ''): t[1]
+                 for t in jspec.get('search', []) if len(t) == 2}
+        key = (self.type, terms.get('instrument'), terms.get('proc_type'))
+        if key in self.dtypes:
+            return(self.dtypes[key])
+        parts = [('', lambda: self.get_core_fields())]
+        if self.type == Rec.Hdu:
+            parts.insert(0, ('fitsfile__',
+                             lambda: self.get_core_fields(rectype=Rec.File)))
+        if 'instrument' in terms and 'proc_type' in terms:
+            parts.append(('', lambda: self.get_aux_fields(
+                terms['instrument'], terms['proc_type'])))
+        dtypes = dict()
+        complete = True
+        for prefix, get_fields in parts:
+            try:
+                dtypes.update({f'{prefix}{k}': v for k,v
+                               in fields_to_dtypes(get_fields()).items()})
+            except Exception as err:
+                # Types only make results more compact; do without them.
+                complete = False
+                if self.verbose:
+                    print(f'Could not get field types; {err}')
+        if complete:
+            self.dtypes[key] = dtypes
+        return(dtypes)
+
+    def vosearch(self, ra, dec, size, limit=100, format='json',
+                 stream=False):
+        """Search Archive for records in box of SIZE (degrees) centered
+        at RA, DEC.  See search() for STREAM."""
         t = 'hdu' if self.type == Rec.Hdu else 'img'
         qstr = urlencode(dict(POS=f'{ra},{dec}',
                               SIZE=size,
-                              limit=None if limit is None else (limit or self.limit),
+                              limit=self.search_limit(limit),
                               format=format))
         url = f'{self.siaurl}/vo{t}?{qstr}'
         if self.verbose:
             print(f'Search invoking "{url}" with: ra={ra}, dec={dec}, size={size}')
-        res = requests.get(url)
-        if self.verbose:
+        stream = stream and format == 'json'
+        res = self.session.get(url, timeout=self.search_timeout,
+                               stream=stream)
+        if self.verbose and not stream:
             print(f'Search status={res.status_code} res={res.content}')
 
         if res.status_code != 200:
             raise Exception(f'status={res.status_code} content={res.content}')
 
-        if format == 'json':
+        if stream:
+            return(self.stream_json(res))
+        elif format == 'json':
             result = res.json()
             info = result.pop(0)
             rows = result
@@ -120,32 +791,139 @@ class AdaApi():
         else:
             return(res.content)
 
+    def vosearch_batch(self, ra, dec, size, limit=100, workers=4,
+                       cell_size=None, min_members=2, margin=None,
+                       radec_fields=('ra_center', 'dec_center')):
+        """Return rows of vosearch() in the boxes of SIZE (degrees; one
+        or one per position) centered at each of the positions RA, DEC
+        (arrays), each row tagged with the index of its position as
+        "target_idx" (rows in several boxes are given once per box).
+
+        Positions in the same HEALPix cell of about CELL_SIZE (default:
+        4 * SIZE) degrees, if at least MIN_MEMBERS, are searched with one
+        box around the cell (widened by MARGIN, if given) and its rows
+        given to the positions whose box their footprint (ra_min, ra_max,
+        dec_min, dec_max) overlaps, as vosearch() would.  Rows without a
+        footprint are given to the positions whose box widened by MARGIN
+        (default: half of cone.FOOTPRINT_SIZE) holds their RADEC_FIELDS,
+        so they may differ from those of vosearch().  If the rows lack
+        both (or the cell has more than LIMIT rows), its positions are
+        searched one at a time.  Searches run in up to WORKERS threads
+        and, if the instance has a CACHE, are kept there.
+        """
+        import numpy as np
+        from helpers import cone
+        ra = np.atleast_1d(np.asarray(ra, dtype=float))
+        dec = np.atleast_1d(np.asarray(dec, dtype=float))
+        size = np.broadcast_to(np.asarray(size, dtype=float), ra.shape)
+        nside = cone.cell_nside(cell_size or 4 * size.max())
+
+        def box(bra, bdec, bsize, key):
+            if self.cache is None:
+                return(self.vosearch(bra, bdec, bsize, limit=limit))
+            ckey = self.cache.key(self.siaurl, self.type.name, key,
+                                  limit, 'json', None, 'vosearch')
+            hit = self.cache.get(ckey)
+            if hit is None:
+                hit = self.vosearch(bra, bdec, bsize, limit=limit)
+                self.cache.put(ckey, *hit)
+            return(hit)
+
+        def target(i):
+            info, rows = box(ra[i], dec[i], size[i],
+                             dict(POS=[ra[i], dec[i]], SIZE=size[i]))
+            return([dict(row, target_idx=int(i)) for row in rows])
+
+        def cell(pixel, members):
+            bra, bdec, bsize = cone.cell_box(nside, pixel,
+                                             size[members].max(),
+                                             margin or 0)
+            info, rows = box(bra, bdec, bsize,
+                             dict(cell=[nside, pixel], SIZE=bsize))
+            matches = None
+            if not info['RESULTS']['MORE']:
+                matches = cone.match_rows(
+                    rows, ra[members], dec[members], size[members],
+                    radec_fields=radec_fields,
+                    margin=(cone.FOOTPRINT_SIZE / 2 if margin is None
+                            else margin))
+            if matches is None:
+                return([row for i in members for row in target(i)])
+            return([dict(rows[r], target_idx=int(members[m]))
+                    for m, r in matches])
+
+        tasks = []
+        for pixel, members in cone.cluster_positions(ra, dec, nside):
+            if len(members) >= min_members:
+                tasks.append((cell, pixel, members))
+            else:
+                tasks += [(target, i) for i in members]
+        if self.verbose:
+            print(f'vosearch_batch: {len(ra)} positions in {len(tasks)} '
+                  f'searches (nside={nside})')
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(lambda task: task[0](*task[1:]), tasks))
+        return(sorted((row for rows in results for row in rows),
+                      key=lambda row: row['target_idx']))
+
+
+    def get_metadata(self, url):
+        """Return the (JSON) response of metadata service URL, from
+        METADATA_CACHE when possible."""
+        def fetch():
+            res = self.session.get(url, timeout=self.timeout)
+            if self.verbose:
+                print(f'url={url}; status={res.status_code}')
+            if res.status_code != 200:
+                raise Exception(f'status={res.status_code} '
+                                f'content={res.content}')
+            return(res.json())
+        return(self.metadata_cache.get(url, fetch))
+
+    def get_version(self):
+        return(self.get_metadata(f'{self.apiurl}/version/'))
 
     def check_version(self):
         """Insure this library in consistent with the API version."""
-        res = requests.get(f"{self.apiurl}​/version​/")
-        return(False)
+        self.version = self.get_version()
+        return(float(self.version) == self.expected_version)
 
     def get_categoricals(self):
-        if self.categoricals is None:
-            url = f'{self.adsurl}/cat_lists/'
-            res = requests.get(url)
-            self.categoricals = res.json()  # dict(catname) = [val1, val2, ...]
+        # dict(catname) = [val1, val2, ...]
+        self.categoricals = self.get_metadata(f'{self.adsurl}/cat_lists/')
         return(self.categoricals)
 
-    def get_aux_fields(self, instrument, proctype):
-        # @@@ VALIDATE instrument, proctype, type
-        t = 'hdu' if self.type == Rec.Hdu else 'file'
-        url = f'{self.adsurl}/aux_{t}_fields/{instrument}/{proctype}/'
-        res = requests.get(url)
-        print(f"url={url}; res={res}; content={res.content}")
-        return(res.json())
+    def get_aux_fields(self, instrument, proctype, rectype=None):
+        t = 'hdu' if (rectype or self.type) == Rec.Hdu else 'file'
+        return(self.get_metadata(
+            f'{self.adsurl}/aux_{t}_fields/{instrument}/{proctype}/'))
 
-    def get_core_fields(self):
-        t = 'hdu' if self.type == Rec.Hdu else 'file'
-        # @@@ VALIDATE instrument, proctype, type
-        res = requests.get(f'{self.adsurl}/core_{t}_fields/')
-        return(res.json())
+    def get_core_fields(self, rectype=None):
+        t = 'hdu' if (rectype or self.type) == Rec.Hdu else 'file'
+        return(self.get_metadata(f'{self.adsurl}/core_{t}_fields/'))
+
+    def field_names(self, jspec):
+        """Return set of the field names that can be used in JSPEC
+        (see field_dtypes)."""
+        from helpers.columnar import fields_to_dtypes
+        terms = {t[0].replace('fitsfile__', ''): t[1]
+                 for t in jspec.get('search', []) if len(t) >= 2}
+        names = set(fields_to_dtypes(self.get_core_fields()))
+        if self.type == Rec.Hdu:
+            names.update(f'fitsfile__{k}' for k in fields_to_dtypes(
+                self.get_core_fields(rectype=Rec.File)))
+        if 'instrument' in terms and 'proc_type' in terms:
+            names.update(fields_to_dtypes(self.get_aux_fields(
+                terms['instrument'], terms['proc_type'])))
+        return(names)
+
+    def validate_jspec(self, jspec):
+        """Raise Exception if JSPEC uses unknown field names or searches
+        a categorical field (e.g. instrument) for a value it never has.
+        The message lists the possible values."""
+        check_jspec_terms(jspec, self.get_categoricals())
+        check_jspec_fields(jspec, self.field_names(jspec))
+        return(True)
 
         
 class FitsFile(AdaApi):
@@ -153,34 +931,142 @@ class FitsFile(AdaApi):
                  url='https://astroarchive.noao.edu',
                  verbose=False,
                  limit=10,
-                 username=None,  password=None):
+                 username=None,  password=None,
+                 **kwargs):
         super().__init__(url=url.rstrip("/"), verbose=verbose,
-                         username=username, password=password)
+                         username=username, password=password, **kwargs)
         self.type = Rec.File
         self.limit = limit
 
     def retrieve(self, fileid, hdu=None):
+        """Return content (bytes) of one FITS file (or HDU) from Archive.
+        For big files use retrieve_to() or iter_retrieve() instead."""
         # VALIDATE params @@@
         
         ## 401 Unauthorized: File is proprietary and logged in user is not authorized.
         ## 403 Forbidden: File is proprietary and user is not logged in.
         ## 404 Not Found: File-ID does not exist in Archive.
-        qparams = '' if hdu is None else f'/?hdu={hdu}'
-        url = f'{self.apiurl}/retrieve/{fileid}/{qparams}'
-        if self.token is None:
-            res = requests.get(url)
-        else:
-            res = requests.get(url, headers=dict(Authorization=self.token))
+        url = self.retrieve_url(fileid, hdu=hdu)
+        res = self.session.get(url, headers=self.auth_headers(),
+                               timeout=self.timeout)
         return res.content
 
+    def retrieve_url(self, fileid, hdu=None):
+        qparams = '' if hdu is None else f'?hdu={hdu}'
+        return(f'{self.apiurl}/retrieve/{fileid}/{qparams}')
+
+    def auth_headers(self):
+        return({} if self.token is None else dict(Authorization=self.token))
+
+    def open_retrieve(self, fileid, hdu=None, offset=0):
+        """Return the (streaming) response for content of FILEID
+        starting at byte OFFSET.  Status is 206 when the server honored
+        the Range request, 200 when it sent the whole file, or 416 when
+        OFFSET is at (or beyond) the end of the file."""
+        url = self.retrieve_url(fileid, hdu=hdu)
+        headers = self.auth_headers()
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+        if self.verbose:
+            print(f'Retrieve invoking "{url}" with: {headers}')
+        res = self.session.get(url, headers=headers,
+                               timeout=self.timeout, stream=True)
+        if res.status_code in (200, 206) or (offset and res.status_code == 416):
+            return(res)
+        with res:
+            raise Exception(f'Could not retrieve {fileid}; '
+                            f'status={res.status_code} '
+                            f'content={res.content}')
+
+    def iter_retrieve(self, fileid, hdu=None, chunk_size=CHUNK_SIZE):
+        """Yield content of one FITS file (or HDU) as chunks of bytes
+        of (at most) CHUNK_SIZE.  Memory use does not depend on file size."""
+        with self.open_retrieve(fileid, hdu=hdu) as res:
+            yield from res.iter_content(chunk_size=chunk_size)
+
+    def retrieve_to(self, fileid, dest, hdu=None, chunk_size=CHUNK_SIZE,
+                    callback=None, verify=True, resume=True):
+        """Stream one FITS file (or HDU) from Archive into DEST.
+
+        DEST is a path or a writable binary file object.  For a path,
+        content is written to "<DEST>.part" which is renamed to DEST
+        only when the download completes (so DEST is never partial).
+        CALLBACK (if given) is called after each chunk as
+        CALLBACK(nbytes, rate) with the total bytes written so far and
+        the average throughput (bytes/second).
+
+        FILEID is the md5sum of the file.  When VERIFY (and no HDU is
+        given) the md5 is computed while streaming and a mismatch
+        raises an exception, and an existing DEST with the right md5
+        is not downloaded again.  When RESUME, a "<DEST>.part" left by
+        an interrupted download is continued with an HTTP Range request.
+        Return the number of bytes downloaded.
+        """
+        md5 = hashlib.md5() if (verify and hdu is None) else None
+        if hasattr(dest, 'write'):
+            with self.open_retrieve(fileid, hdu=hdu) as res:
+                nbytes = self._write_chunks(
+                    res.iter_content(chunk_size=chunk_size),
+                    dest, callback, md5)
+            self._check_md5(fileid, md5)
+            return(nbytes)
+
+        dest = Path(dest).expanduser()
+        if md5 is not None and dest.exists():
+            if file_md5(dest, chunk_size).hexdigest() == fileid:
+                if self.verbose:
+                    print(f'Skipping {fileid}; already in {dest}')
+                return(0)
+        part = dest.with_name(dest.name + '.part')
+        offset = part.stat().st_size if (resume and part.exists()) else 0
+        if offset and md5 is not None:
+            md5 = file_md5(part, chunk_size)
+
+        nbytes = 0
+        with self.open_retrieve(fileid, hdu=hdu, offset=offset) as res:
+            if res.status_code != 416:
+                if res.status_code == 200 and md5 is not None:
+                    md5 = hashlib.md5() # server sent the whole file
+                mode = 'ab' if res.status_code == 206 else 'wb'
+                with open(part, mode) as fileobj:
+                    nbytes = self._write_chunks(
+                        res.iter_content(chunk_size=chunk_size),
+                        fileobj, callback, md5)
+        try:
+            self._check_md5(fileid, md5)
+        except Exception:
+            part.unlink()
+            raise
+        os.replace(part, dest)
+        return(nbytes)
+
+    def _check_md5(self, fileid, md5):
+        if md5 is not None and md5.hexdigest() != fileid:
+            raise Exception(f'Retrieved content of {fileid} is corrupt; '
+                            f'md5sum={md5.hexdigest()}')
+
+    def _write_chunks(self, chunks, fileobj, callback, md5=None):
+        nbytes = 0
+        start = time.monotonic()
+        for chunk in chunks:
+            fileobj.write(chunk)
+            if md5 is not None:
+                md5.update(chunk)
+            nbytes += len(chunk)
+            if callback is not None:
+                elapsed = time.monotonic() - start
+                callback(nbytes, nbytes / elapsed if elapsed > 0 else 0.0)
+        return(nbytes)
+
 class FitsHdu(AdaApi):
     def __init__(self, 
                  url='https://astroarchive.noao.edu',
                  limit=20,
                  verbose=False,
-                 username=None,  password=None):
+                 username=None,  password=None,
+                 **kwargs):
         super().__init__(url=url.rstrip('/'), verbose=verbose,
-                         username=username, password=password)
+                         username=username, password=password, **kwargs)
         self.type = Rec.Hdu
         self.limit = limit
 
@@ -0,0 +1,224 @@
+"""Persistent caches for Astro Data Archive responses."""
+
+# EXAMPLE:
+#   cache = SearchCache('~/.cache/wrap-api/search', ttl=7*86400,
+#                       max_bytes=5e9)
+#   hapi = helpers.api.FitsHdu(cache=cache)
+#   info, rows = hapi.search(jspec)   # from server
+#   info, rows = hapi.search(jspec)   # from cache
+#   print(cache.stats)
+#
+#   meta = MetadataCache('~/.cache/wrap-api/metadata', ttl=86400)
+#   fapi = helpers.api.FitsFile(metadata_cache=meta, validate=True)
+#   hapi = helpers.api.FitsHdu(metadata_cache=meta, validate=True)
+
+# Python Standard Library
+from pathlib import Path, PosixPath
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+def canonical_jspec(jspec):
+    """Return JSPEC as a canonical JSON string.  Search terms are ANDed
+    so their order (and duplicates) do not matter; the order of
+    outfields is kept since it is the order of the result columns."""
+    outfields = list(dict.fromkeys(jspec.get('outfields', [])))
+    terms = sorted(set(json.dumps(t) for t in jspec.get('search', [])))
+    other = {k: v for k, v in jspec.items() if k not in ('outfields', 'search')}
+    return(json.dumps(dict(other, outfields=outfields,
+                           search=[json.loads(t) for t in terms]),
+                      sort_keys=True))
+
+
+class SearchCache():
+    """Search results stored (gzipped, columnar JSON) in DIRECTORY.
+
+    Entries stored more than TTL seconds ago (None: never) are misses.
+    When the total size of the cache exceeds MAX_BYTES the least
+    recently used entries (by file mtime, touched on each hit) are
+    removed.  STATS counts hits, misses, puts and evictions.
+    """
+
+    def __init__(self, directory='~/.cache/wrap-api/search',
+                 ttl=86400, max_bytes=2**30):
+        self.directory = Path(PosixPath(directory).expanduser())
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.stats = dict(hits=0, misses=0, puts=0, evictions=0)
+
+    def key(self, url, rectype, jspec, limit, format, offset=None,
+            kind='rows'):
+        """Return key of search for JSPEC against server URL."""
+        text = json.dumps([url, str(rectype), canonical_jspec(jspec),
+                           limit, format, offset or 0, kind])
+        return(hashlib.sha256(text.encode()).hexdigest())
+
+    def path(self, key):
+        return(self.directory / f'{key}.json.gz')
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def get(self, key):
+        """Return (info, payload) stored under KEY or None."""
+        path = self.path(key)
+        try:
+            with gzip.open(path, 'rt') as fileobj:
+                entry = json.load(fileobj)
+            age = time.time() - entry['created']
+            if self.ttl is not None and age > self.ttl:
+                path.unlink()
+                raise FileNotFoundError(path)
+            os.utime(path) # most recently used
+        except (OSError, ValueError, KeyError):
+            self.count('misses')
+            return(None)
+        self.count('hits')
+        return(entry['info'], decode_payload(entry['payload']))
+
+    def put(self, key, info, payload):
+        """Store (INFO, PAYLOAD) under KEY.  PAYLOAD is a list of rows
+        (dicts or tuples) or a dict of numpy arrays."""
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with gzip.open(os.fdopen(fd, 'wb'), 'wt') as fileobj:
+                json.dump(dict(info=info, payload=encode_payload(payload),
+                               created=time.time()),
+                          fileobj)
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.count('puts')
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until under MAX_BYTES."""
+        if self.max_bytes is None:
+            return
+        entries = []
+        for path in self.directory.glob('*.json.gz'):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            self.count('evictions')
+
+    def clear(self):
+        for path in self.directory.glob('*.json.gz'):
+            path.unlink(missing_ok=True)
+
+
+class MetadataCache():
+    """Responses of the (rarely changing) metadata services, such as
+    cat_lists and the core and aux fields, keyed by their URL (so per
+    server).  They are kept in memory and, if DIRECTORY is given, on
+    disk (so across runs) and fetched again after TTL seconds
+    (None: never).  Thread safe; share one instance among AdaApi
+    instances to share their metadata.
+    """
+
+    def __init__(self, directory=None, ttl=86400):
+        self.directory = None
+        if directory is not None:
+            self.directory = Path(PosixPath(directory).expanduser())
+            self.directory.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.memory = dict() # dict(url) = (time, value)
+        self.lock = threading.Lock()
+        self.stats = dict(hits=0, misses=0)
+
+    def path(self, url):
+        return(self.directory / f'{hashlib.sha256(url.encode()).hexdigest()}.json')
+
+    def fresh(self, stamp):
+        return(self.ttl is None or time.time() - stamp <= self.ttl)
+
+    def get(self, url, fetch):
+        """Return the value of metadata service URL; FETCH() (which must
+        raise on failure) gets it when not cached or too old."""
+        value = self.lookup(url)
+        if value is None:
+            value = fetch()
+            self.put(url, value)
+        return(value)
+
+    def lookup(self, url):
+        """Return the cached value of URL or None if not cached (or too
+        old)."""
+        with self.lock:
+            entry = self.memory.get(url)
+        if entry is None and self.directory is not None:
+            path = self.path(url)
+            try:
+                entry = (path.stat().st_mtime,
+                         json.loads(path.read_text())['value'])
+            except (OSError, ValueError, KeyError):
+                entry = None
+        if entry is None or not self.fresh(entry[0]):
+            return(None)
+        with self.lock:
+            self.memory[url] = entry
+            self.stats['hits'] += 1
+        return(entry[1])
+
+    def put(self, url, value):
+        with self.lock:
+            self.memory[url] = (time.time(), value)
+            self.stats['misses'] += 1
+        if self.directory is not None:
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as fileobj:
+                json.dump(dict(url=url, value=value), fileobj)
+            os.replace(tmp, self.path(url))
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        if self.directory is not None:
+            for path in self.directory.glob('*.json'):
+                path.unlink(missing_ok=True)
+
+
+def encode_payload(payload):
+    """Return JSON-able columnar form of search PAYLOAD."""
+    if isinstance(payload, dict):
+        # dict(field) = numpy array
+        return(dict(kind='numpy',
+                    fields=list(payload),
+                    dtypes=[str(a.dtype) for a in payload.values()],
+                    columns=[a.tolist() for a in payload.values()]))
+    if payload and isinstance(payload[0], dict):
+        fields = list(dict.fromkeys(k for row in payload for k in row))
+        return(dict(kind='dicts', fields=fields,
+                    columns=[[row.get(k) for row in payload]
+                             for k in fields]))
+    return(dict(kind='tuples', rows=[list(row) for row in payload]))
+
+def decode_payload(payload):
+    """Inverse of encode_payload()."""
+    if payload['kind'] == 'numpy':
+        import numpy as np
+        return({name: np.array(values, dtype=dtype) for name, dtype, values
+                in zip(payload['fields'], payload['dtypes'],
+                       payload['columns'])})
+    if payload['kind'] == 'dicts':
+        fields = payload['fields']
+        return([dict(zip(fields, values))
+                for values in zip(*payload['columns'])])
+    return([tuple(row) for row in payload['rows']])
@@ -0,0 +1,176 @@
+"""Build typed NumPy columns directly from search responses."""
+
+# EXAMPLE:
+#   hapi = helpers.api.FitsHdu()
+#   info, cols = hapi.search_columns(jspec, limit=1000000)
+#   cols['CENRA1']   # numpy float64 array
+#   info, df = hapi.search_columns(jspec, limit=1000000, frame=True)
+
+# Python Standard Library
+from itertools import islice
+import re
+# External Packages
+import numpy as np
+
+
+def type_to_dtype(typename):
+    """Return numpy dtype for an Archive field TYPENAME (as given by the
+    *_fields services, e.g. "str", "float", "np.float64", "int").
+    Unknown types give the object dtype."""
+    name = str(typename).lower()
+    if 'float' in name or name in ('double', 'real'):
+        return(np.dtype('float64'))
+    if re.search(r'\bu?int(eger|\d+)?\b', name):
+        return(np.dtype('int64'))
+    if 'bool' in name:
+        return(np.dtype('bool'))
+    return(np.dtype('object'))
+
+def fields_to_dtypes(fields):
+    """Return dict(name) = dtype from the response of get_core_fields() or
+    get_aux_fields() (a list of dicts with "Field" and "Type")."""
+    dtypes = dict()
+    for fld in fields:
+        if isinstance(fld, dict):
+            fld = {k.lower(): v for k,v in fld.items()}
+            name = fld.get('field', fld.get('name'))
+            if name is not None:
+                dtypes[name] = type_to_dtype(fld.get('type'))
+    return(dtypes)
+
+
+class Column():
+    """Growable column of values of one numpy DTYPE, kept as a list of
+    numpy arrays (one per batch of values added with extend)."""
+
+    def __init__(self, dtype):
+        self.dtype = np.dtype(dtype)
+        self.arrays = []
+        self.size = 0
+
+    def convert(self, values):
+        try:
+            return(np.array(values, dtype=self.dtype))
+        except (TypeError, ValueError):
+            pass
+        if self.dtype.kind in 'iu':
+            # Missing ints force float (so NaN can mark them)
+            try:
+                return(np.array(values, dtype='float64'))
+            except (TypeError, ValueError):
+                pass
+        # Server type info was wrong (e.g. "float" field holding str)
+        return(np.array(values, dtype=object))
+
+    def extend(self, values):
+        if len(values) > 0:
+            self.arrays.append(self.convert(values))
+            self.size += len(values)
+
+    def extend_text(self, texts):
+        """Extend with the values given as TEXTS (strings from CSV,
+        where the empty string means no value)."""
+        if len(texts) == 0:
+            return
+        if self.dtype.kind in 'fiu':
+            number = float if self.dtype.kind == 'f' else int
+            try:
+                values = np.fromiter(map(number, texts), dtype=self.dtype,
+                                     count=len(texts))
+            except ValueError:
+                # Missing values (or ints with decimals) force float
+                try:
+                    values = np.fromiter(
+                        (float(t) if t else np.nan for t in texts),
+                        dtype='float64', count=len(texts))
+                except ValueError:
+                    # Server type info was wrong (e.g. "float" field holding str)
+                    values = np.array([t or None for t in texts],
+                                      dtype=object)
+        elif self.dtype.kind == 'b':
+            values = np.isin(np.char.lower(np.array(texts)),
+                             ['true', 't', '1'])
+        else:
+            values = np.array([t or None for t in texts], dtype=object)
+        self.arrays.append(values)
+        self.size += len(texts)
+
+    def __len__(self):
+        return(self.size)
+
+    def to_numpy(self):
+        if not self.arrays:
+            return(np.array([], dtype=self.dtype))
+        if len(self.arrays) == 1:
+            return(self.arrays[0])
+        return(np.concatenate(self.arrays))
+
+
+class ColumnBuilder():
+    """Accumulate search rows into typed columns, a batch at a time.
+
+    Only one batch of rows (dicts) exists at a time; its values are
+    moved into a numpy array per field.  Columns of FIELDS listed in
+    DTYPES (dict(name) = dtype) get that type; all others hold python
+    objects.
+    """
+
+    def __init__(self, fields=(), dtypes=None, batch=2**16):
+        self.dtypes = dict(dtypes or {})
+        self.columns = dict()
+        self.nrows = 0
+        self.batch = batch
+        for name in fields:
+            self.column(name)
+
+    def column(self, name):
+        if name not in self.columns:
+            col = Column(self.dtypes.get(name, object))
+            # Rows seen before this field first appeared lacked it
+            col.extend([None] * self.nrows)
+            self.columns[name] = col
+        return(self.columns[name])
+
+    def add_rows(self, rows):
+        """Add ROWS (a list of dicts) to the columns."""
+        columns = self.columns
+        for row in rows:
+            if len(row) != len(columns) or row.keys() != columns.keys():
+                for name in row:
+                    self.column(name)
+        for name, col in self.columns.items():
+            col.extend([row.get(name) for row in rows])
+        self.nrows += len(rows)
+
+    def add_text_rows(self, fields, rows):
+        """Add ROWS (a list of lists of strings, as read from CSV) whose
+        values are for FIELDS."""
+        for name, texts in zip(fields, zip(*rows)):
+            self.column(name).extend_text(texts)
+        self.nrows += len(rows)
+
+    def add_all(self, rows, fields=None):
+        """Add all of ROWS (any iterable of dicts, such as the streaming
+        rows of a search), BATCH rows at a time.  If FIELDS is given,
+        ROWS are lists of strings (see add_text_rows).
+        Return number added."""
+        rows = iter(rows)
+        count = 0
+        while True:
+            batch = list(islice(rows, self.batch))
+            if not batch:
+                return(count)
+            if fields is None:
+                self.add_rows(batch)
+            else:
+                self.add_text_rows(fields, batch)
+            count += len(batch)
+
+    def to_numpy(self):
+        """Return dict(name) = numpy array."""
+        return({name: col.to_numpy() for name, col in self.columns.items()})
+
+    def to_frame(self):
+        """Return a pandas DataFrame."""
+        import pandas as pd
+        return(pd.DataFrame(self.to_numpy()))
@@ -0,0 +1,99 @@
+"""Group many search positions into fewer, larger vosearch() boxes."""
+
+# EXAMPLE:
+#   nside = cell_nside(0.5)
+#   for pixel, members in cluster_positions(ra, dec, nside):
+#       cra, cdec, qsize = cell_box(nside, pixel, 0.1)
+#       info, rows = fapi.vosearch(cra, cdec, qsize)
+#       matches = match_rows(rows, ra[members], dec[members], 0.1)
+
+# External Packages
+import numpy as np
+import healpy as hp
+
+
+BBOX_FIELDS = ('ra_min', 'ra_max', 'dec_min', 'dec_max')
+# Degrees across the largest footprints (DECam's field of view)
+FOOTPRINT_SIZE = 2.2
+
+
+def cell_nside(cell_size):
+    """Return the HEALPix NSIDE (a power of 2) whose pixels are closest
+    to CELL_SIZE degrees across."""
+    resol = hp.nside2resol(1, arcmin=True) / 60
+    return(2 ** max(0, int(round(np.log2(resol / cell_size)))))
+
+def cluster_positions(ra, dec, nside):
+    """Return list of (pixel, members) of the HEALPix pixels (of NSIDE)
+    holding the positions RA, DEC (degrees); members are the indices of
+    the positions in the pixel."""
+    pixels = hp.ang2pix(nside, ra, dec, lonlat=True)
+    order = np.argsort(pixels, kind='stable')
+    cells, starts = np.unique(pixels[order], return_index=True)
+    return(list(zip(cells.tolist(), np.split(order, starts[1:]))))
+
+def cell_box(nside, pixel, size, margin=0):
+    """Return (ra, dec, size) of a box that holds the boxes of SIZE
+    (degrees) centered anywhere in PIXEL, widened by MARGIN."""
+    ra, dec = hp.pix2ang(nside, pixel, lonlat=True)
+    radius = np.degrees(hp.max_pixrad(nside))
+    # Boxes nearer the pole span more RA than ones at the cell center
+    stretch = (np.cos(np.radians(dec))
+               / np.cos(np.radians(min(89.0, abs(dec) + radius))))
+    size = 2 * (radius + margin) + size * stretch
+    return(float(ra), float(dec), float(min(size, 180.0)))
+
+def in_boxes(ra, dec, bra, bdec, size):
+    """Return (boxes, points) boolean array, True where point RA, DEC is
+    in the box of SIZE (degrees) centered at BRA, BDEC."""
+    dra = (np.asarray(ra)[None, :] - np.asarray(bra)[:, None] + 180) % 360 - 180
+    ddec = np.asarray(dec)[None, :] - np.asarray(bdec)[:, None]
+    half = np.asarray(size, dtype=float)[:, None] / 2
+    cosdec = np.cos(np.radians(np.asarray(bdec)))[:, None]
+    return((np.abs(ddec) <= half) & (np.abs(dra) * cosdec <= half))
+
+def overlap_boxes(ra_min, ra_max, dec_min, dec_max, bra, bdec, size):
+    """Return (boxes, footprints) boolean array, True where footprint
+    RA_MIN..RA_MAX, DEC_MIN..DEC_MAX overlaps the box of SIZE (degrees)
+    centered at BRA, BDEC.  Footprints are assumed narrower than 180
+    degrees (see helpers.footprint.ra_interval)."""
+    from helpers.footprint import ra_interval
+    lo, width = (v[None, :] for v in ra_interval(ra_min, ra_max))
+    half = np.asarray(size, dtype=float)[:, None] / 2
+    bdec = np.asarray(bdec, dtype=float)[:, None]
+    cosdec = np.cos(np.radians(bdec))
+    bhalf = np.minimum(half / np.maximum(cosdec, 1e-9), 180)
+    blo = (np.asarray(bra, dtype=float)[:, None] - bhalf) % 360
+    return((np.asarray(dec_min)[None, :] <= bdec + half)
+           & (bdec - half <= np.asarray(dec_max)[None, :])
+           & ((np.mod(lo - blo, 360) <= 2 * bhalf)
+              | (np.mod(blo - lo, 360) <= width)))
+
+def row_values(rows, fields):
+    """Return (len(fields), len(rows)) float array of the FIELDS of
+    ROWS or None if some row lacks one."""
+    try:
+        values = np.array([[row[k] for k in fields] for row in rows],
+                          dtype=float).reshape(len(rows), len(fields)).T
+    except (KeyError, TypeError, ValueError):
+        return(None)
+    return(None if np.isnan(values).any() else values)
+
+def match_rows(rows, ra, dec, size, radec_fields=('ra_center', 'dec_center'),
+               margin=0):
+    """Return list of (box, row) indices of ROWS whose footprint (given
+    by BBOX_FIELDS) overlaps the box of SIZE centered at RA[box],
+    DEC[box].  Rows without a footprint match if their position (given
+    by RADEC_FIELDS) is in the box widened by MARGIN.  Return None if
+    some row has neither."""
+    size = np.broadcast_to(size, np.shape(ra))
+    bbox = row_values(rows, BBOX_FIELDS)
+    if bbox is not None:
+        inside = overlap_boxes(*bbox, ra, dec, size)
+    else:
+        radec = row_values(rows, radec_fields)
+        if radec is None:
+            return(None)
+        inside = in_boxes(*radec, ra, dec, size + 2 * margin)
+    boxes, indices = np.nonzero(inside)
+    return(list(zip(boxes.tolist(), indices.tolist())))
@@ -9,64 +9,77 @@
 # curl -X POST "https://astroarchive.noao.edu/api/adv_search/fasearch/?limit=1000" -H  "accept: application/json" -H  "Content-Type: application/json" -H  "X-CSRFToken: gFHNwAns1RjX5JnVOC4p8TaltxnzdLShRsDBvPVUQ50wUNasbYu0rjBwAL59SRdR" -d "{  \"outfields\": [    \"md5sum\",    \"release_date\",    \"EXPNUM\"  ],  \"search\": [    [\"release_date\", \"2019-11-28\", \"2020-11-15\"],    [\"instrument\", \"decam\"],    [\"proc_type\",\"raw\"]  ]}"
 
 import argparse
-from pathlib import Path, PosixPath
-import argparse
-from pprint import pformat
+from pathlib import Path
 # Local
 import helpers.api
+from helpers.download import BulkDownloader
+from helpers.resolve import resolve_keys
+
 
+def expnum_rows(expnum_list, fapi, verbose=False):
+    """Return search rows (md5sum, outfile) for raw DECam files with EXPNUMs.
+    All EXPNUMs are resolved with as few searches as possible."""
+    if verbose:
+        print(f'Searching for raw DECam files with {len(set(expnum_list))} '
+              f'EXPNUMs')
+    found, missing = resolve_keys(
+        fapi, 'EXPNUM', expnum_list, ['md5sum'],
+        search=[["instrument", "decam"],  ["proc_type", "raw"]],
+        verbose=verbose)
+    if missing:
+        print(f'WARNING: No raw DECam files found for EXPNUMs: '
+              f'{sorted(missing)}')
+    # we only expect ONE file to match each expnum
+    return([dict(md5sum=rows[0]['md5sum'],
+                 outfile=f'DECam_{str(expnum).zfill(8)}.fits.fz')
+            for expnum, rows in sorted(found.items())])
 
-def get_files(expnum_list, outdir, fapi, verbose=False):
-    gotfiles = set()
-    for expnum in expnum_list:
-        outfilepath = Path(PosixPath(outdir).expanduser(),
-                           f'DECam_{str(expnum).zfill(8)}.fits.fz')
-        jj = {"outfields": ["md5sum",],
-              "search": [ ["instrument", "decam"],  ["proc_type", "raw"],
-                          ["EXPNUM", expnum, expnum]]}
-        if verbose:
-            print(f'Searching for raw DECam files with EXPNUM={expnum}')
-        info,rows = fapi.search(jj, limit=1)
-        if verbose:
-            print(f'Found {len(rows)} files. Info={pformat(info)}')
-        
-        for row in rows:  # we only expect ONE expnum to match
-            try:
-                fid = row['md5sum']
-                if verbose:
-                    print(f'Downloading file {fid} to {outfilepath}')
-                open(outfilepath, 'wb').write(fapi.retrieve(fid))
-                #!print(f'Wrote file {fid} to {outfilepath}')
-                gotfiles.add(str(outfilepath))
-            except Exception as err:
-                print(f'ERROR: {str(err)}; Record={row}')
-                print(f'Could not retrieve file ({fid}) '
-                      f'and write it to {outfilepath}')
-    return(gotfiles)
+def get_files(expnum_list, outdir, fapi, verbose=False,
+              max_workers=4, max_bytes_per_sec=None, retries=3):
+    dl = BulkDownloader(fapi, outdir, max_workers=max_workers,
+                        max_bytes_per_sec=max_bytes_per_sec,
+                        retries=retries, verbose=verbose)
+    report = dl.download(expnum_rows(expnum_list, fapi, verbose=verbose))
+    for fid, err in report.failed.items():
+        print(f'ERROR: {err}; Could not retrieve file ({fid}) '
+              f'into {dl.outdir}')
+    if verbose:
+        print(report)
+    return(set(str(path) for path in report.paths))
 
 ##############################################################################
 
 
 def main():
     parser = argparse.ArgumentParser(
-        version='1.0.0',
+        #version='1.0.0',
         description='Download DECAM files given EXPNUMs',
-        epilog='EXAMPLE: %(prog)s a b"'
+        epilog='EXAMPLE: %(prog)s -e 938946 -e 938950 --outdir ~/decam'
         )
     parser.add_argument('-e', '--expnum', type=int,
                         action='append',
                         help='EXPNUM of DECam file to retrieve' )
     parser.add_argument('--outdir', type=Path,
-                        help='Directory to download files into. (must exist)' )
+                        help='Directory to download files into.' )
     parser.add_argument('--username',
                         help='Username (email) of an authenticated user' )
     parser.add_argument('--password',
                         help='Password of an authenticated user' )
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of files to download concurrently' )
+    parser.add_argument('--bandwidth', type=float,
+                        help='Max total download rate (MB/sec)' )
+    parser.add_argument('--retries', type=int, default=3,
+                        help='Times to retry a failed download' )
     args = parser.parse_args()
 
     fapi =  helpers.api.FitsFile(verbose=True,
-                                 username=args.username, password=args.password)
-    get_files(args.expnum, args.outdir, fapi)
+                                 username=args.username, password=args.password,
+                                 pool_size=args.workers)
+    get_files(args.expnum, args.outdir, fapi, verbose=True,
+              max_workers=args.workers, retries=args.retries,
+              max_bytes_per_sec=(None if args.bandwidth is None
+                                 else args.bandwidth * 1e6))
 
 if __name__ == '__main__':
     main()
@@ -4,7 +4,10 @@
 
 # Python library
 import sys
+import os
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import copy
 from pprint import pprint as pp  # pretty print
 import pandas as pd
@@ -19,6 +22,7 @@ import requests
 import healpy as hp
 # Local Packages
 import helpers.api
+from helpers.cache import SearchCache
 
 ##############################################################################
 # functions to order the vertices of HDU corners in counter-clockwise
@@ -78,12 +82,504 @@ def sort_radec(ra,dec):
         dec1s.append(p.y)
     return np.array(ra1s),np.array(dec1s)
 
+def sort_radec_batch(ra, dec):
+    """Order the corners of many HDUs at once.  RA and DEC are (N,4)
+    arrays (one row of corners per HDU).  Return (ra, dec) as (N,4)
+    arrays with each row in the same order as sort_radec() gives.
+    HDUs that straddle RA=0/360 are ordered as if unwrapped (the RA
+    values themselves are not changed)."""
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    # Corners spread over more than 180 degrees of RA straddle 0/360.
+    wrap = (ra.max(axis=1) - ra.min(axis=1)) > 180
+    ura = np.where(wrap[:,None] & (ra < 180), ra + 360, ra)
+    # Angle of the direction from each corner to the center, as angle()
+    angles = np.mod(-np.arctan2(dec.mean(axis=1, keepdims=True) - dec,
+                                ura.mean(axis=1, keepdims=True) - ura),
+                    2 * np.pi)
+    order = np.argsort(-angles, axis=1, kind='stable')
+    return(np.take_along_axis(ra, order, axis=1),
+           np.take_along_axis(dec, order, axis=1))
+
 
 ##############################################################################
+# Rasterize HDU polygons into HEALPix pixels
+
+# Highest NSIDE of the (dense) maps plotted from a SparseMap
+PLOT_NSIDE = 2048
+
+def rasterize_chunk(nside, vecs, weights):
+    """Return (pixels, sums) for the HDU polygons VECS ((N,4,3) array of
+    corner vectors) each adding its row of WEIGHTS ((N,K) array) to the
+    pixels it covers.  PIXELS is a sorted array of the (unique) covered
+    pixels and SUMS a (K,len(pixels)) array of the summed weights."""
+    weights = np.asarray(weights, dtype=float).reshape(len(vecs), -1)
+    pixlist = []
+    hdus = []
+    for idx, vec in enumerate(vecs):
+        try:
+            ipix = hp.query_polygon(nside, vec)
+        except Exception:
+            continue # degenerate polygon
+        pixlist.append(ipix)
+        hdus.append(np.full(len(ipix), idx))
+    if not pixlist:
+        return(np.array([], dtype=np.int64),
+               np.zeros((weights.shape[1], 0)))
+    pixels, inverse = np.unique(np.concatenate(pixlist), return_inverse=True)
+    hdus = np.concatenate(hdus)
+    sums = np.array([np.bincount(inverse, weights=weights[hdus, k],
+                                 minlength=len(pixels))
+                     for k in range(weights.shape[1])])
+    return(pixels, sums)
+
+def rasterize(nside, vecs, weights, processes=1, chunk_size=2000,
+              pool=None):
+    """Yield (pixels, sums) (see rasterize_chunk) for successive chunks
+    of CHUNK_SIZE HDUs.  With PROCESSES > 1 (None: one per CPU) chunks
+    are rasterized in parallel by a pool of worker processes, each
+    returning only its sparse partial sums.  POOL (a
+    ProcessPoolExecutor) is used instead of a new pool if given."""
+    starts = range(0, len(vecs), chunk_size)
+    args = ([nside] * len(starts),
+            [vecs[i:i+chunk_size] for i in starts],
+            [weights[i:i+chunk_size] for i in starts])
+    if pool is not None:
+        yield from pool.map(rasterize_chunk, *args)
+    elif processes == 1:
+        yield from map(rasterize_chunk, *args)
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            yield from pool.map(rasterize_chunk, *args)
+
+@lru_cache(maxsize=4)
+def ring_table(nside):
+    """Return (dec, startpix, ringpix, shift) arrays describing the
+    4*NSIDE-1 rings of (RING ordered) pixels, from north to south: the
+    Dec (degrees) of the ring, its first pixel, number of pixels and
+    the offset (0 or 0.5 pixel) of its first pixel center from RA=0.
+    The center of pixel j of a ring is at RA (j+shift)*360/ringpix."""
+    startpix, ringpix, costheta, sintheta, shifted = hp.ringinfo(
+        nside, np.arange(1, 4*nside))
+    return(np.degrees(np.arcsin(costheta)), startpix.astype(np.int64),
+           ringpix.astype(np.int64), np.where(shifted, 0.5, 0.0))
+
+def expand_ranges(counts):
+    """Return (owner, index) arrays enumerating COUNTS[i] items of each
+    owner i: owner is i repeated COUNTS[i] times and index 0..COUNTS[i]-1."""
+    owner = np.repeat(np.arange(len(counts)), counts)
+    first = np.cumsum(counts) - counts
+    return(owner, np.arange(len(owner)) - first[owner])
+
+def rasterize_bbox_chunk(nside, ra, dec, weights):
+    """Like rasterize_chunk, but for HDUs given by their corners RA and
+    DEC ((N,4) arrays, in any order) and covering the pixels whose
+    centers are inside the RA/Dec bounding box of the corners.
+
+    All HDUs are done at once with NumPy using ring_table(): the rings
+    within the Dec range of each box, then the pixels of each such ring
+    within its RA range.  This is much faster than query_polygon() but
+    the box includes the sky between a rotated HDU and its box, so an
+    HDU rotated by angle A (relative to the RA/Dec axes) covers up to
+    (W*cos(A)+H*sin(A))*(W*sin(A)+H*cos(A))/(W*H) times its area (W by
+    H).  For 0.30 by 0.15 degree CCDs at nside 4096 that is about 1%
+    more exposure at 0.5 degree rotation and 4% at 2 degrees, while
+    RA/Dec aligned ones match polygon mode to 0.1% of pixels (see
+    benchmarks/bench_bbox.py).  Boxes around a pole are not supported.
+    """
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    weights = np.asarray(weights, dtype=float).reshape(len(ra), -1)
+    # Unwrap boxes that straddle RA=0/360 (as sort_radec_batch)
+    wrap = (ra.max(axis=1) - ra.min(axis=1)) > 180
+    ura = np.where(wrap[:,None] & (ra < 180), ra + 360, ra)
+    ra_min, ra_max = ura.min(axis=1), ura.max(axis=1)
+
+    rdec, startpix, ringpix, shift = ring_table(nside)
+    # Rings (north to south, so Dec decreasing) inside each box
+    first = np.searchsorted(-rdec, -dec.max(axis=1), side='left')
+    last = np.searchsorted(-rdec, -dec.min(axis=1), side='right')
+    hdu, k = expand_ranges(np.maximum(last - first, 0))
+    ring = first[hdu] + k
+    # Pixels of each ring inside each box
+    npix = ringpix[ring]
+    j0 = np.ceil(ra_min[hdu] * npix / 360 - shift[ring]).astype(np.int64)
+    j1 = np.floor(ra_max[hdu] * npix / 360 - shift[ring]).astype(np.int64)
+    pair, j = expand_ranges(np.clip(j1 - j0 + 1, 0, npix))
+    ipix = startpix[ring[pair]] + np.mod(j0[pair] + j, npix[pair])
+    hdus = hdu[pair]
+    pixels, inverse = np.unique(ipix, return_inverse=True)
+    sums = np.array([np.bincount(inverse, weights=weights[hdus, k],
+                                 minlength=len(pixels))
+                     for k in range(weights.shape[1])]).reshape(
+                             weights.shape[1], -1)
+    return(pixels, sums)
+
+def accumulate(maps, pixels, sums):
+    """Add SUMS (see rasterize_chunk) into the (dense) MAPS."""
+    for map, values in zip(maps, sums):
+        map[pixels] += values # PIXELS are unique, so no need for np.add.at
+
+
+class SparseMap():
+    """HEALPix maps (RING ordering) of NSIDE that only hold the pixels
+    that have been covered: PIXELS (sorted) and VALUES, an array with
+    one row of values per layer in NAMES (e.g. exposure and teff).
+    Memory and file size depend on the area covered, not the sky, so
+    high NSIDE (8192+) maps of a survey fit on ordinary nodes.
+    """
+
+    def __init__(self, nside, names=('exposure', 'teff')):
+        self.nside = nside
+        self.names = list(names)
+        self._pixels = np.array([], dtype=np.int64)
+        self._values = np.zeros((len(self.names), 0))
+        self.parts = []    # (pixels, sums) added but not merged yet
+        self.nparts = 0    # number of pixels in parts
+
+    def add(self, pixels, sums):
+        """Add SUMS (one row per layer) to PIXELS (see rasterize_chunk)."""
+        sums = np.asarray(sums, dtype=float).reshape(len(self.names), -1)
+        self.parts.append((np.asarray(pixels, dtype=np.int64), sums))
+        self.nparts += len(pixels)
+        if self.nparts > max(len(self._pixels), 2**22):
+            self.merge()
+
+    def merge(self):
+        """Merge the added parts into PIXELS and VALUES."""
+        if not self.parts:
+            return
+        pixels = np.concatenate([self._pixels] + [p for p,v in self.parts])
+        values = np.concatenate([self._values] + [v for p,v in self.parts],
+                                axis=1)
+        self._pixels, inverse = np.unique(pixels, return_inverse=True)
+        self._values = np.array([np.bincount(inverse, weights=row,
+                                             minlength=len(self._pixels))
+                                 for row in values]).reshape(
+                                         len(self.names), -1)
+        self.parts = []
+        self.nparts = 0
+
+    @property
+    def pixels(self):
+        self.merge()
+        return(self._pixels)
+
+    @property
+    def values(self):
+        self.merge()
+        return(self._values)
+
+    def __len__(self):
+        return(len(self.pixels))
+
+    def layer(self, name):
+        """Return values of layer NAME (one per pixel in PIXELS)."""
+        return(self.values[self.names.index(name)])
+
+    def to_dense(self, name='teff', nside=None):
+        """Return layer NAME as a full-sky (RING) map of NSIDE (default:
+        the map's own).  A lower NSIDE averages the values of the pixels
+        within each lower resolution pixel (as hp.ud_grade does)."""
+        values = self.layer(name)
+        nside = nside or self.nside
+        if nside == self.nside:
+            dense = np.zeros(hp.nside2npix(nside))
+            dense[self.pixels] = values
+            return(dense)
+        if nside > self.nside:
+            raise Exception(f'Cannot make map of nside={nside} from map of '
+                            f'nside={self.nside}')
+        ratio = (self.nside // nside)**2
+        parents = hp.ring2nest(self.nside, self.pixels) // ratio
+        nested = np.bincount(parents, weights=values,
+                             minlength=hp.nside2npix(nside)) / ratio
+        return(hp.reorder(nested, n2r=True))
+
+    def save(self, filename, **arrays):
+        """Write the covered pixels (only) to FILENAME (a .npz file),
+        along with any other named ARRAYS."""
+        np.savez_compressed(filename, nside=self.nside,
+                            names=np.array(self.names),
+                            pixels=self.pixels, values=self.values, **arrays)
+
+    def save_pyramid(self, filename, nside_min=64):
+        """Write all layers as a resolution pyramid (see save_pyramid)."""
+        save_pyramid(filename, self.nside, self.pixels, self.values,
+                     names=self.names, nside_min=nside_min)
+
+    @classmethod
+    def load(cls, filename):
+        """Return SparseMap written by save()."""
+        with np.load(filename) as npz:
+            smap = cls(int(npz['nside']), [str(n) for n in npz['names']])
+            smap._pixels = npz['pixels']
+            smap._values = npz['values']
+        return(smap)
+
+
+##############################################################################
+# Multi-resolution pyramid of a map
+
+def map_pyramid(nside, pixels, values, nside_min=64):
+    """Yield (nside, pixels, values) for a map of NSIDE with VALUES (one
+    row per layer) at (RING) PIXELS, and for each lower resolution down
+    to NSIDE_MIN, where each pixel has the mean of its 4 (nested)
+    sub-pixels.  Only pixels with values are given, sorted."""
+    values = np.asarray(values, dtype=float).reshape(-1, len(pixels))
+    nest = hp.ring2nest(nside, np.asarray(pixels, dtype=np.int64))
+    order = np.argsort(nest)
+    nest, values = nest[order], values[:, order]
+    while True:
+        ring = hp.nest2ring(nside, nest)
+        order = np.argsort(ring)
+        yield(nside, ring[order], values[:, order])
+        if nside <= nside_min:
+            break
+        parents, inverse = np.unique(nest >> 2, return_inverse=True)
+        values = np.array([np.bincount(inverse, weights=row,
+                                       minlength=len(parents))
+                           for row in values]).reshape(len(values), -1) / 4
+        nest = parents
+        nside //= 2
+
+def save_pyramid(filename, nside, pixels, values, names=('teff',),
+                 nside_min=64):
+    """Write the map_pyramid() of a map (see there) with layers NAMES to
+    FILENAME (a .npz file).  Each resolution is stored separately (as
+    covered pixels only), so load_pyramid() reads just the one asked for."""
+    levels = dict()
+    nsides = []
+    for lnside, lpixels, lvalues in map_pyramid(nside, pixels, values,
+                                                nside_min=nside_min):
+        nsides.append(lnside)
+        levels[f'pixels_{lnside}'] = lpixels
+        levels[f'values_{lnside}'] = lvalues
+    np.savez_compressed(filename, nsides=nsides, names=np.array(names),
+                        **levels)
+
+def load_pyramid(filename, nside=None, name='teff'):
+    """Return layer NAME at NSIDE (default: the highest) of the pyramid
+    in FILENAME, as a full-sky (RING) map."""
+    with np.load(filename) as npz:
+        nside = nside or int(max(npz['nsides']))
+        if nside not in npz['nsides']:
+            raise Exception(f'No nside={nside} in {filename}; '
+                            f'possible: {list(npz["nsides"])}')
+        names = [str(n) for n in npz['names']]
+        map = np.zeros(hp.nside2npix(nside))
+        map[npz[f'pixels_{nside}']] = npz[f'values_{nside}'][names.index(name)]
+    return(map)
+
+
+##############################################################################
+# State of an exposure map that is updated incrementally
+
+def hdu_keys(fitsfile, hdu_idx):
+    """Return array of keys (bytes "<fitsfile>:<hdu_idx>") of HDUs."""
+    fitsfile = np.asarray(fitsfile).astype('S')
+    hdu_idx = np.asarray(hdu_idx).astype(np.int64).astype('S')
+    return(np.char.add(np.char.add(fitsfile, b':'), hdu_idx))
+
+def load_state(filename, nside):
+    """Return (smap, manifest, last_caldat) saved by save_state() in
+    FILENAME, or a new (empty) state if there is no such file.
+    MANIFEST is the sorted array of hdu_keys() already in the map."""
+    try:
+        smap = SparseMap.load(filename)
+    except FileNotFoundError:
+        return(SparseMap(nside), np.array([], dtype='S'), None)
+    if smap.nside != nside:
+        raise Exception(f'Map in {filename} has nside={smap.nside}, '
+                        f'not {nside}')
+    with np.load(filename) as npz:
+        return(smap, npz['manifest'], str(npz['last_caldat']) or None)
+
+def save_state(filename, smap, manifest, last_caldat):
+    """Write SMAP, MANIFEST and LAST_CALDAT to FILENAME (see load_state)."""
+    tmp = f'{filename}.tmp.npz'
+    smap.save(tmp, manifest=manifest, last_caldat=last_caldat or '')
+    os.replace(tmp, filename)
+
+
+##############################################################################
+# Memory-mapped maps with checkpoints (so long runs can resume)
+
+class CheckpointedMaps():
+    """Exposure and teff maps of NSIDE kept in "exposure.npy" and
+    "teff.npy" in DIRECTORY and accessed as np.memmap (so they need not
+    fit in memory, and other programs can open them lazily with
+    np.load(..., mmap_mode='r')).
+
+    Contributions (see add) are buffered in a SparseMap and only written
+    to the maps by checkpoint(OFFSET), which also records OFFSET (the
+    number of HDU search results processed so far) in
+    "checkpoint.json".  The new pixel values are first written to a
+    journal, so a run stopped at any point resumes from the last
+    checkpoint without adding any HDU twice.  PARAMS (e.g. the search
+    range) must match those of the run being resumed.
+    """
+    names = ('exposure', 'teff')
+
+    def __init__(self, directory, nside, params=None):
+        self.directory = directory
+        self.nside = nside
+        self.params = dict(params or {}, nside=nside)
+        os.makedirs(directory, exist_ok=True)
+        checkpoint = self.path('checkpoint.json')
+        if os.path.exists(checkpoint):
+            with open(checkpoint) as fileobj:
+                saved = json.load(fileobj)
+            if saved['params'] != json.loads(json.dumps(self.params)):
+                raise Exception(f'Maps in {directory} were made with '
+                                f'{saved["params"]}, not {self.params}; '
+                                f'use another directory')
+            self.offset = saved['offset']
+            mode = 'r+'
+        else:
+            self.offset = 0
+            mode = 'w+'
+        self.maps = [np.lib.format.open_memmap(
+            self.path(f'{name}.npy'), mode=mode, dtype=np.float64,
+            shape=(hp.nside2npix(nside),)) for name in self.names]
+        self.pending = SparseMap(nside, self.names)
+        self.recover()
+
+    def path(self, name):
+        return(os.path.join(self.directory, name))
+
+    def add(self, pixels, sums):
+        """Add SUMS to PIXELS (see rasterize_chunk) at next checkpoint."""
+        self.pending.add(pixels, sums)
+
+    def checkpoint(self, offset):
+        """Write added contributions to the maps and record OFFSET."""
+        self.write_journal(offset)
+        self.recover()
+
+    def write_journal(self, offset):
+        pixels = self.pending.pixels
+        values = [map[pixels] + sums
+                  for map, sums in zip(self.maps, self.pending.values)]
+        tmp = self.path('journal.tmp.npz')
+        np.savez(tmp, pixels=pixels, values=values, offset=offset)
+        os.replace(tmp, self.path('journal.npz'))
+        self.pending = SparseMap(self.nside, self.names)
+
+    def recover(self):
+        """Apply the journal (if any) left by checkpoint()."""
+        journal = self.path('journal.npz')
+        if not os.path.exists(journal):
+            return
+        with np.load(journal) as npz:
+            for map, values in zip(self.maps, npz['values']):
+                map[npz['pixels']] = values # same result if done twice
+            offset = int(npz['offset'])
+        for map in self.maps:
+            map.flush()
+        tmp = self.path('checkpoint.tmp.json')
+        with open(tmp, 'w') as fileobj:
+            json.dump(dict(offset=offset, params=self.params), fileobj)
+        os.replace(tmp, self.path('checkpoint.json'))
+        os.remove(journal)
+        self.offset = offset
+
 
-def gen_exposure_map(fapi,hapi, verbose=False):
+##############################################################################
+# Join pages of HDU columns with the (much smaller) table of files
+
+def index_files(cols):
+    """Return file columns COLS (dict(field) = array, with md5sum)
+    sorted by md5sum, for lookup_files()."""
+    md5sum = np.asarray(cols['md5sum'], dtype=str)
+    order = np.argsort(md5sum)
+    index = {k: np.asarray(v)[order] for k,v in cols.items()}
+    index['md5sum'] = md5sum[order]
+    return(index)
+
+def lookup_files(index, md5sum):
+    """Return (found, positions) of files MD5SUM (array) in INDEX."""
+    md5sum = np.asarray(md5sum, dtype=str)
+    if len(index['md5sum']) == 0:
+        return(np.zeros(len(md5sum), dtype=bool),
+               np.zeros(len(md5sum), dtype=int))
+    pos = np.searchsorted(index['md5sum'], md5sum)
+    pos = np.minimum(pos, len(index['md5sum']) - 1)
+    return(index['md5sum'][pos] == md5sum, pos)
+
+def join_files(cols, index):
+    """Return HDU columns COLS with the file columns of INDEX added, for
+    the HDUs whose file is in INDEX and that have no missing values."""
+    found, pos = lookup_files(index, cols['fitsfile'])
+    pos = pos[found] # none if INDEX is empty
+    cols = {k: np.asarray(v)[found] for k,v in cols.items()}
+    cols.update({k: v[pos] for k,v in index.items() if k != 'md5sum'})
+    keep = ~np.any([pd.isna(v) for v in cols.values()], axis=0)
+    return({k: v[keep] for k,v in cols.items()})
+
+def hdu_tau(cols):
+    """Return tau (effective exposure time factor) of HDUs in COLS."""
+    col = lambda name: np.asarray(cols[name], dtype=float)
+    apix = 0.263 # arcsec/pixel
+    sky = col('AVSKY') / col('fitsfile__exposure') # sky rate
+    return(col('G-TRANSP')**2 / (col('FWHM')*apix/0.9)**2 / (sky/3.))
+
+def hdu_corners(cols):
+    """Return (ra, dec) as (N,4) arrays of corners of HDUs in COLS."""
+    ratab = np.column_stack([cols[f'COR{k}RA1'] for k in range(1,5)])
+    dectab = np.column_stack([cols[f'COR{k}DEC1'] for k in range(1,5)])
+    return(ratab.astype(float), dectab.astype(float))
+
+def hdu_vectors(cols):
+    """Return (N,4,3) array of ordered corner vectors of HDUs in COLS."""
+    ra_s, dec_s = sort_radec_batch(*hdu_corners(cols))
+    return(hp.ang2vec(ra_s.ravel(), dec_s.ravel(),
+                      lonlat=True).reshape(len(ra_s), 4, 3))
+
+
+##############################################################################
+
+def gen_exposure_map(fapi,hapi, verbose=False, processes=1, nside=4096,
+                     sparse=False, start='2018-09-01', end='2020-09-01',
+                     state=None, page_size=200000, memmap=None,
+                     checkpoint_every=10, mode='polygon'):
+    """Return teff map (full-sky numpy array of NSIDE) of survey
+    observed from START to END (caldat).  If SPARSE, return a SparseMap
+    with exposure and teff layers instead.
+
+    If STATE (the name of a .npz file) is given, the map is updated
+    incrementally: the map in STATE, along with the HDUs already added
+    to it, is loaded and only HDUs observed since the latest one of
+    the previous run (and not already added) are searched for and
+    added.  The updated map is written back to STATE.  Implies SPARSE.
+
+    HDUs are processed a page (of PAGE_SIZE) at a time as they arrive,
+    so memory use does not depend on the number of HDUs.
+
+    If MEMMAP (a directory) is given, the (dense) maps are memory-mapped
+    files in it, and progress is checkpointed every CHECKPOINT_EVERY
+    pages; running again with the same MEMMAP resumes after the last
+    checkpoint (see CheckpointedMaps).
+
+    MODE is how HDUs are rasterized: 'polygon' (the pixels inside the
+    HDU corners) or 'bbox' (much faster; the pixels inside the RA/Dec
+    bounding box of the corners, see rasterize_bbox_chunk).
+    """
+    if mode not in ('polygon', 'bbox'):
+        raise Exception(f'Unknown MODE={mode}; possible: polygon, bbox')
+    if memmap is not None and (sparse or state is not None):
+        raise Exception('MEMMAP cannot be combined with SPARSE or STATE')
+    if state is not None:
+        sparse = True
+        smap, manifest, last_caldat = load_state(state, nside)
+        if last_caldat is not None:
+            start = max(start, last_caldat)
+        if verbose:
+            print(f'Loaded map of {len(manifest):,} HDUs from {state}; '
+                  f'adding HDUs from caldat={start}')
     jj = {"outfields" : ["md5sum", "AIRMASS", "G-TRANSP"],
           "search" : [
+              ["caldat", start, end],
               ["instrument", "decam"],
               ["proc_type", "instcal"],
               ["prod_type", "image"],
@@ -93,8 +589,9 @@ def gen_exposure_map(fapi,hapi, verbose=False):
           ]}
     if verbose:
         print('Get AIRMASS and G-TRANSP for DECam files with selected filter.')
-    info, rows = fapi.search(jj, limit=500000)
-    dff = pd.DataFrame(rows)
+    info, fcols = fapi.search_columns(jj, limit=500000)
+    file_jspec = jj
+    files = index_files(fcols) # only this (small) table is held entirely
     if verbose:
         print(f"Found {info['RESULTS']['COUNT']} files")
         
@@ -118,9 +615,10 @@ def gen_exposure_map(fapi,hapi, verbose=False):
                          "COR3DEC1",
                          "COR4DEC1",
                          "FWHM",
-                         "AVSKY", ],
+                         "AVSKY",
+                         "fitsfile__caldat", ],
           "search" : [
-              ["fitsfile__caldat", "2018-09-01", "2020-09-01"] ,
+              ["fitsfile__caldat", start, end] ,
               ["fitsfile__instrument", "decam"],
               ["fitsfile__proc_type", "instcal"],
               ["fitsfile__prod_type", "image"],
@@ -129,27 +627,6 @@ def gen_exposure_map(fapi,hapi, verbose=False):
               ["fitsfile__ifilter", "r DECam", "contains"]
           ]}
     
-    if verbose:
-        print('Get corner coordinates, FWHM, and AVSKY of HDUs.')
-    info, rows = hapi.search(jj, limit=5000000)
-    df2 = pd.DataFrame(rows)
-    if verbose:
-        print(f"Found {info['RESULTS']['COUNT']} HDUs")
-    
-    dfm = pd.merge(dff,df2,left_on='md5sum',right_on='fitsfile')
-    dfmc = dfm.dropna()
-
-    apix = 0.263 # arcsec/pixel
-    sky = dfmc['AVSKY']/dfmc['fitsfile__exposure'] # sky rate
-    tau = dfmc['G-TRANSP']**2/(dfmc['FWHM']*apix/0.9)**2/(sky/3.)
-
-    if verbose:
-        print(f"Plot tau histogram")
-    a = plt.hist(tau,bins=200,range=(0,1))
-    plt.xlabel('tau')
-
-    tau_trim = np.clip(tau,0,1) # tau should be between 0 and 1
-
     ########################
     # Making the depth map
     #
@@ -164,37 +641,99 @@ def gen_exposure_map(fapi,hapi, verbose=False):
     #     Because the corners of the HDUs aren't guaranteed to go clockwise, or counter-clockwise, around the HDU, we might not be defining convex polygons when we do the healpixel mapping. We'll need to order the corners so that they go in one direction, and don't jump an HDU along its diagonal
     #     We'll need to loop over all of the HDUs one at a time, which can be slow. Parallel processing might help here.
     
-    # Pull out the HDU corners
-    
-    ratab = [np.array([row[0],row[1],row[2],row[3]])
-             for row in dfmc[['COR1RA1','COR2RA1','COR3RA1','COR4RA1']].values]
-    dectab = [np.array([row[0],row[1],row[2],row[3]])
-              for row in dfmc[['COR1DEC1','COR2DEC1','COR3DEC1','COR4DEC1']].values]
-
-    radectab_s = [sort_radec(ra1,dec1) for ra1,dec1 in zip(ratab,dectab)]
-    vectab = [hp.ang2vec(ra1,dec1,lonlat=True) for ra1, dec1 in radectab_s]    
-
-
     # Define the Healpix map
-    nside = 4096
     if verbose:
         print(f'Resolution is {hp.nside2resol(nside,arcmin=True):5.2f} arcmin.')
-    map = np.zeros(hp.nside2npix(nside)) # raw exposure map
-    tmap = map.copy() # teff map
+    if state is not None:
+        pass # loaded above
+    elif sparse:
+        smap = SparseMap(nside, names=('exposure', 'teff'))
+    elif memmap is not None:
+        # Resuming is only right for the same HDUs rasterized the same way
+        cmaps = CheckpointedMaps(memmap, nside,
+                                 params=dict(mode=mode, files=file_jspec,
+                                             hdus=jj))
+        map, tmap = cmaps.maps
+        if verbose and cmaps.offset:
+            print(f'Resuming after {cmaps.offset:,} HDUs in {memmap}')
+    else:
+        map = np.zeros(hp.nside2npix(nside)) # raw exposure map
+        tmap = map.copy() # teff map
 
-    # Loop over HDUs (slow!)
-    for vec,exptime,tau1 in zip(vectab,dfmc['fitsfile__exposure'],tau_trim):
-        try:
-            ipix = hp.query_polygon(nside,vec)
-            map[ipix] += exptime
-            tmap[ipix] += tau1 * exptime
-        except:
-            pass
+    # Stream pages of HDUs (the next one is fetched while this one is
+    # processed) through: join with files, tau, corners, rasterize
+    # (in PROCESSES worker processes).
+    if verbose:
+        print('Get corner coordinates, FWHM, and AVSKY of HDUs.')
+    edges = np.linspace(0, 1, 201)
+    counts = np.zeros(len(edges) - 1) # tau histogram
+    nhdus = 0
+    new_keys = []
+    offset = 0 if memmap is None else cmaps.offset
+    pool = (None if processes == 1
+            else ProcessPoolExecutor(max_workers=processes))
+    try:
+        for page, (info, cols) in enumerate(hapi.iter_columns(
+                jj, page_size=page_size, prefetch=True, offset=offset)):
+            nhdus += len(cols['fitsfile'])
+            offset += len(cols['fitsfile'])
+            cols = join_files(cols, files)
+            if state is not None:
+                keys = hdu_keys(cols['fitsfile'], cols['hdu_idx'])
+                new = ~np.isin(keys, manifest)
+                cols = {k: v[new] for k,v in cols.items()}
+                new_keys.append(keys[new])
+                if len(keys[new]) > 0:
+                    last_caldat = max(last_caldat or '',
+                                      str(max(cols['fitsfile__caldat'])))
+            tau = hdu_tau(cols)
+            counts += np.histogram(tau, bins=edges)[0]
+            tau_trim = np.clip(tau,0,1) # tau should be between 0 and 1
+            exptime = np.asarray(cols['fitsfile__exposure'], dtype=float)
+            weights = np.column_stack([exptime, tau_trim * exptime])
+            if mode == 'bbox':
+                parts = [rasterize_bbox_chunk(nside, *hdu_corners(cols),
+                                              weights)]
+            else:
+                parts = rasterize(nside, hdu_vectors(cols), weights,
+                                  processes=processes, pool=pool)
+            for pixels, sums in parts:
+                if sparse:
+                    smap.add(pixels, sums)
+                elif memmap is not None:
+                    cmaps.add(pixels, sums)
+                else:
+                    accumulate((map, tmap), pixels, sums)
+            if memmap is not None and (page + 1) % checkpoint_every == 0:
+                cmaps.checkpoint(offset)
+        if memmap is not None:
+            cmaps.checkpoint(offset)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    if verbose:
+        print(f"Found {nhdus} HDUs")
+
+    if verbose:
+        print(f"Plot tau histogram")
+    a = plt.hist(edges[:-1], bins=edges, weights=counts)
+    plt.xlabel('tau')
+
+    if state is not None:
+        added = np.concatenate(new_keys) if new_keys else manifest[:0]
+        manifest = np.union1d(manifest, added)
+        save_state(state, smap, manifest, last_caldat)
+        if verbose:
+            print(f'Added {len(added):,} new HDUs; '
+                  f'wrote map of {len(manifest):,} HDUs to {state}')
+    if sparse:
+        # Only plot at a resolution whose full-sky map is affordable
+        tmap = smap.to_dense('teff', nside=min(nside, PLOT_NSIDE))
 
     # Show the map
     if verbose:
         print(f"Show exposure map in Orthographic view")
-    cmap = copy.copy(matplotlib.cm.get_cmap("inferno"))
+    cmap = copy.copy(plt.get_cmap("inferno"))
     fig = plt.figure(figsize=(15,15))
     hp.orthview(tmap,rot=(20,-30),fig=1,cmap=cmap,half_sky=True,min=0,max=1000)
 
@@ -203,7 +742,7 @@ def gen_exposure_map(fapi,hapi, verbose=False):
         print(f"Show exposure map in Gnomonic view")
     hp.gnomview(tmap,reso=0.75,cmap=cmap,rot=(8,-44),min=0,max=1000)
     
-    return tmap 
+    return smap if sparse else tmap
 
 
 ##############################################################################
@@ -217,31 +756,98 @@ def main():
         )
     parser.add_argument('--save',
                         help=('Name of file in which to save exposure map'
-                              ' (numpy array)'))
+                              ' (numpy array, or .npz of covered pixels'
+                              ' if --sparse)'))
+    parser.add_argument('--pyramid',
+                        help=('Name of .npz file in which to save the map at '
+                              'its NSIDE and each lower one (see '
+                              '--pyramid_nside)'))
+    parser.add_argument('--pyramid_nside', type=int, default=64,
+                        help='Lowest NSIDE of the pyramid')
     parser.add_argument('--apiurl',  help='URL of Archive API service',
                         default='https://astroarchive.noao.edu/')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help=('Tell what is going on.'))
     parser.add_argument('--no_plot', action='store_true',
                         help=('Suppress display of plots.'))
+    parser.add_argument('--nside', type=int, default=4096,
+                        help='HEALPix NSIDE (resolution) of the map')
+    parser.add_argument('--sparse', action='store_true',
+                        help=('Only keep covered pixels in memory '
+                              '(allows high NSIDE)'))
+    parser.add_argument('--start', default='2018-09-01',
+                        help='Earliest caldat of HDUs in the map')
+    parser.add_argument('--end', default='2020-09-01',
+                        help='Latest caldat of HDUs in the map')
+    parser.add_argument('--update',
+                        help=('Incrementally update the map (and list of '
+                              'HDUs in it) kept in this .npz file; '
+                              'implies --sparse'))
+    parser.add_argument('--memmap',
+                        help=('Directory of memory-mapped map files '
+                              '(exposure.npy, teff.npy); an interrupted '
+                              'run using it resumes from its last checkpoint'))
+    parser.add_argument('--checkpoint_every', type=int, default=10,
+                        help=('Number of HDU pages between checkpoints '
+                              '(with --memmap)'))
+    parser.add_argument('--mode', choices=['polygon', 'bbox'],
+                        default='polygon',
+                        help=('Rasterize the polygon of HDU corners, or '
+                              '(faster, less accurate) their bounding box'))
+    parser.add_argument('--processes', type=int, default=1,
+                        help=('Number of processes rasterizing HDUs '
+                              '(0: one per CPU)'))
+    parser.add_argument('--cache',
+                        help=('Directory in which to keep search results '
+                              'between runs'))
+    parser.add_argument('--cache_ttl', type=float, default=86400,
+                        help=('Seconds before cached search results are '
+                              'searched for again'))
 
     args = parser.parse_args()
 
-    fapi =  helpers.api.FitsFile(args.apiurl)
-    hapi =  helpers.api.FitsHdu(args.apiurl)
+    cache = (None if args.cache is None
+             else SearchCache(args.cache, ttl=args.cache_ttl))
+    fapi =  helpers.api.FitsFile(args.apiurl, cache=cache)
+    hapi =  helpers.api.FitsHdu(args.apiurl, cache=cache)
 
     warnings.filterwarnings('ignore') # suppress ALL warnings (dangerous)
 
     if args.verbose:
         print(f'Using API server at {args.apiurl}')
         
-    map = gen_exposure_map(fapi,hapi, verbose=args.verbose)
+    map = gen_exposure_map(fapi,hapi, verbose=args.verbose,
+                           processes=args.processes or None,
+                           nside=args.nside, sparse=args.sparse,
+                           start=args.start, end=args.end,
+                           state=args.update, memmap=args.memmap,
+                           checkpoint_every=args.checkpoint_every,
+                           mode=args.mode)
     
-    if args.verbose:
-        print(f'Non-zeros: {np.count_nonzero(map):,} of {np.size(map):,}')
-    if args.save:
-        np.save(args.save, map)
-        print(f'Wrote exposure map (numpy array) to {args.save}')
+    if args.sparse or args.update:
+        if args.verbose:
+            print(f'Non-zeros: {np.count_nonzero(map.layer("teff")):,} of '
+                  f'{hp.nside2npix(args.nside):,}')
+        if args.save:
+            map.save(args.save)
+            print(f'Wrote exposure map ({len(map):,} covered pixels) '
+                  f'to {args.save}')
+    else:
+        if args.verbose:
+            print(f'Non-zeros: {np.count_nonzero(map):,} of {np.size(map):,}')
+        if args.save:
+            np.save(args.save, map)
+            print(f'Wrote exposure map (numpy array) to {args.save}')
+
+    if args.pyramid:
+        if args.sparse or args.update:
+            map.save_pyramid(args.pyramid, nside_min=args.pyramid_nside)
+        else:
+            pixels = np.flatnonzero(map)
+            save_pyramid(args.pyramid, args.nside, pixels, map[pixels],
+                         nside_min=args.pyramid_nside)
+        print(f'Wrote exposure map pyramid (nside {args.nside} to '
+              f'{args.pyramid_nside}) to {args.pyramid}')
 
     if not args.no_plot:
         plt.show()
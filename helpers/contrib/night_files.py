@@ -1,10 +1,13 @@
 #! /usr/bin/env python
-"""Get list of all files for specific telescope,instrument,night."""
+"""Get list of all files for specific telescope,instrument,night
+(or range of nights)."""
 
 # EXAMPLES:
 #
 # python -m helpers.contrib.night_files --telescope ct4m --instrument decam --night 2017-08-15 -f archive_filename -f md5sum
 #
+# python -m helpers.contrib.night_files --telescope ct4m --instrument decam --start 2017-08-01 --end 2017-08-31 --output aug.csv
+#
 # python3
 # from helpers.contrib.night_files import get_night_list
 # fapi = helpers.api.FitsFile()
@@ -12,24 +15,54 @@
 
 # Python Standard Library
 import argparse
-from pathlib import Path
-import argparse
-from pprint import pformat as pf
+import csv
+import datetime
+import math
+import sys
 # Local Packages
 import helpers.api
 
 
-
-def get_night_list(telescope, instrument, night, outfields, fapi):
-    jdata = dict(outfields=outfields,
+def iter_night_rows(telescope, instrument, start, end, outfields, fapi,
+                    nights_per_query=1, workers=4, page_size=10000):
+    """Yield rows of all files for TELESCOPE, INSTRUMENT observed on the
+    nights START to END (YYYY-MM-DD, inclusive) as the searches return
+    them.  There is one search per NIGHTS_PER_QUERY nights, up to WORKERS
+    at a time; results beyond PAGE_SIZE are fetched by more searches
+    (see AdaApi.sharded_search), so none are lost."""
+    # md5sum tells files apart even if OUTFIELDS cannot
+    jdata = dict(outfields=list(dict.fromkeys(list(outfields) + ['md5sum'])),
                  search=[
                      ["telescope", telescope],
                      ["instrument", instrument],
-                     ["caldat", night, night]
+                     ["caldat", start, end]
                  ])
-    info,rows = fapi.search(jdata, limit=10000)
-    #!print(f'Search INFO={info}')
-    return rows
+    nights = (datetime.date.fromisoformat(end)
+              - datetime.date.fromisoformat(start)).days + 1
+    rows = fapi.sharded_search(
+        jdata, 'caldat', shards=math.ceil(nights / nights_per_query),
+        workers=workers, shard_limit=page_size, key=['md5sum'])
+    if 'md5sum' in outfields:
+        yield from rows
+    else:
+        for row in rows:
+            row.pop('md5sum', None)
+            yield row
+
+def get_night_list(telescope, instrument, night, outfields, fapi):
+    return(list(iter_night_rows(telescope, instrument, night, night,
+                                outfields, fapi)))
+
+def write_csv(rows, outfields, fileobj):
+    """Write ROWS (dicts) as CSV with a header of OUTFIELDS to FILEOBJ,
+    a row at a time.  Return number of rows written."""
+    writer = csv.writer(fileobj)
+    writer.writerow(outfields)
+    count = 0
+    for row in rows:
+        writer.writerow([row.get(k) for k in outfields])
+        count += 1
+    return(count)
 
 ##############################################################################
 
@@ -37,8 +70,10 @@ def get_night_list(telescope, instrument, night, outfields, fapi):
 def main():
     parser = argparse.ArgumentParser(
         #version='1.0.0',
-        description='Download DECAM files given EXPNUMs',
-        epilog='EXAMPLE: %(prog)s a b"'
+        description=('List all files for a telescope and instrument '
+                     'observed on a night (or range of nights) as CSV'),
+        epilog=('EXAMPLE: %(prog)s --telescope ct4m --instrument decam '
+                '--night 2017-08-15 -f archive_filename -f md5sum')
         )
     dflt_outfields = ["md5sum", "filesize", "proposal",
                       "original_filename", "archive_filename",
@@ -49,7 +84,7 @@ def main():
                       "obs_mode", "obs_type", "proc_type", "prod_type",
                       "url"]
 
-    parser.add_argument('-f', '--outfield', 
+    parser.add_argument('-f', '--outfield',
                         action='append',
                         help=(f'Name of field to include in output (multi allowed). '
                               f'Default = {dflt_outfields}' ))
@@ -59,18 +94,41 @@ def main():
                         help='Name of instrument that created the FITS file.' )
     parser.add_argument('--night',
                         help='Night (YYYY-MM-DD) of observation.' )
+    parser.add_argument('--start',
+                        help='First night (YYYY-MM-DD) of a range of nights.' )
+    parser.add_argument('--end',
+                        help='Last night (YYYY-MM-DD) of a range of nights.' )
+    parser.add_argument('--nights_per_query', type=int, default=1,
+                        help='Number of nights to get with each search.' )
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of searches to run concurrently.' )
+    parser.add_argument('-o', '--output',
+                        help='CSV file to write (default: stdout).' )
+    parser.add_argument('--apiurl',  help='URL of Archive API service',
+                        default='https://astroarchive.noao.edu')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Report number of files found (on stderr).' )
     args = parser.parse_args()
-    
-    
-    outfields = dflt_outfields if 'outfield' in args else args.outfield
 
-    print(f'DBG outfields={outfields}')
-    fapi =  helpers.api.FitsFile(verbose=True)
+    outfields = args.outfield or dflt_outfields
+    start = args.start or args.night
+    end = args.end or args.night or start
+    if start is None:
+        parser.error('Give --night or --start (and --end)')
 
-    nf = get_night_list(args.telescope, args.instrument, args.night, outfields,
-                        fapi)
-    print(','.join([str(k) for k in nf[1].keys()]))
-    print('\n'.join([','.join([str(v) for v in d.values()]) for d in nf[1:]]))
+    fapi =  helpers.api.FitsFile(args.apiurl, pool_size=args.workers)
+    rows = iter_night_rows(args.telescope, args.instrument, start, end,
+                           outfields, fapi,
+                           nights_per_query=args.nights_per_query,
+                           workers=args.workers)
+    if args.output is None:
+        count = write_csv(rows, outfields, sys.stdout)
+    else:
+        with open(args.output, 'w', newline='') as fileobj:
+            count = write_csv(rows, outfields, fileobj)
+    if args.verbose:
+        print(f'Found {count} files for nights {start} to {end}',
+              file=sys.stderr)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,252 @@
+#! /usr/bin/env python
+"""Mirror the files of a telescope/instrument for a range of nights into
+a local directory, downloading only files that are new or changed."""
+
+# EXAMPLES:
+#
+# python -m helpers.contrib.night_sync --telescope ct4m --instrument decam --start 2017-08-15 --end 2017-08-16 --outdir ~/decam --dry_run
+#
+# python3
+# from helpers.contrib.night_sync import sync_nights
+# fapi = helpers.api.FitsFile()
+# report = sync_nights(fapi, 'ct4m', 'decam', '2017-08-15', '2017-08-15',
+#                      '~/decam')
+# print(report)
+
+# Python Standard Library
+import argparse
+from pathlib import Path, PosixPath
+import sqlite3
+import time
+# Local Packages
+import helpers.api
+from helpers.download import BulkDownloader
+
+
+MANIFEST_FIELDS = ["md5sum", "filesize", "archive_filename", "caldat"]
+
+def night_manifest(fapi, telescope, instrument, start, end, page_size=10000):
+    """Yield rows (MANIFEST_FIELDS) of all files of TELESCOPE and
+    INSTRUMENT observed from night START to END (inclusive), searched
+    PAGE_SIZE rows at a time."""
+    jspec = dict(outfields=MANIFEST_FIELDS,
+                 search=[
+                     ["telescope", telescope],
+                     ["instrument", instrument],
+                     ["caldat", start, end]
+                 ])
+    yield from fapi.iter_search(jspec, page_size=page_size)
+
+def local_path(row):
+    """Return path (relative to the mirror directory) of file ROW."""
+    name = (Path(row['archive_filename']).name if row.get('archive_filename')
+            else row['md5sum'])
+    return(f'{row["caldat"]}/{name}')
+
+
+class SyncState():
+    """Files already mirrored, kept in sqlite database FILENAME as
+    (path, md5sum, filesize, caldat, synced) where path is relative to
+    the mirror directory and synced is the (unix) time it was written."""
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(str(filename))
+        self.db.execute('CREATE TABLE IF NOT EXISTS files ('
+                        'path TEXT PRIMARY KEY, md5sum TEXT, '
+                        'filesize INTEGER, caldat TEXT, synced REAL)')
+        self.db.commit()
+
+    def get(self, path):
+        """Return (md5sum, filesize) recorded for PATH or None."""
+        return(self.db.execute('SELECT md5sum, filesize FROM files '
+                               'WHERE path = ?', (path,)).fetchone())
+
+    def put(self, path, md5sum, filesize, caldat):
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?)',
+                        (path, md5sum, filesize, caldat, time.time()))
+        self.db.commit()
+
+    def __len__(self):
+        return(self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0])
+
+    def close(self):
+        self.db.close()
+
+
+class SyncReport():
+    """Outcome of sync_nights()."""
+
+    def __init__(self):
+        self.new = []        # paths not (or no longer) in the mirror
+        self.changed = []    # paths whose file changed in the Archive
+        self.unchanged = []  # paths already mirrored
+        self.failed = dict() # dict(path) = error message
+        self.bytes_transferred = 0
+        self.bytes_skipped = 0
+        self.bytes_planned = 0 # of new and changed files
+        self.seconds = 0.0
+        self.dry_run = False
+
+    def __str__(self):
+        if self.dry_run:
+            return(f'Would download {len(self.new)} new and '
+                   f'{len(self.changed)} changed files '
+                   f'({self.bytes_planned/1e6:,.1f} MB); '
+                   f'{len(self.unchanged)} unchanged '
+                   f'({self.bytes_skipped/1e6:,.1f} MB)')
+        return(f'Downloaded {len(self.new)} new and {len(self.changed)} '
+               f'changed files ({self.bytes_transferred/1e6:,.1f} MB in '
+               f'{self.seconds:,.1f} sec); skipped {len(self.unchanged)} '
+               f'unchanged ({self.bytes_skipped/1e6:,.1f} MB); '
+               f'failed {len(self.failed)}')
+
+
+def plan_sync(rows, outdir, state):
+    """Return (todo, unchanged) for manifest ROWS, where todo is a list
+    of (status, path, row) with status "new" or "changed" and unchanged
+    is a list of (path, row).  A file is unchanged if STATE has the
+    same md5sum for it and it is in OUTDIR with the right size."""
+    todo, unchanged = [], []
+    for row in rows:
+        path = local_path(row)
+        known = state.get(path)
+        local = Path(outdir) / path
+        if (known is not None and known[0] == row['md5sum']
+            and local.exists()
+            and (row.get('filesize') is None
+                 or local.stat().st_size == row['filesize'])):
+            unchanged.append((path, row))
+        else:
+            changed = known is not None and known[0] != row['md5sum']
+            todo.append(('changed' if changed else 'new', path, row))
+    return(todo, unchanged)
+
+def sync_nights(fapi, telescope, instrument, start, end, outdir,
+                state=None, dry_run=False, max_workers=4,
+                max_bytes_per_sec=None, retries=3, page_size=10000,
+                verbose=False):
+    """Mirror files of TELESCOPE and INSTRUMENT for nights START to END
+    into OUTDIR/<caldat>/ and return a SyncReport.  Only files that are
+    not in STATE (sqlite file, default: OUTDIR/.night_sync.sqlite) or
+    have changed since are downloaded.  If DRY_RUN, only report what
+    would be downloaded.  The manifest is searched PAGE_SIZE rows at a
+    time."""
+    outdir = Path(PosixPath(outdir).expanduser())
+    outdir.mkdir(parents=True, exist_ok=True)
+    state = SyncState(state or outdir / '.night_sync.sqlite')
+    report = SyncReport()
+    report.dry_run = dry_run
+    try:
+        todo, unchanged = plan_sync(
+            night_manifest(fapi, telescope, instrument, start, end,
+                           page_size=page_size),
+            outdir, state)
+        report.unchanged = [path for path, row in unchanged]
+        report.bytes_skipped = sum(row.get('filesize') or 0
+                                   for path, row in unchanged)
+        report.bytes_planned = sum(row.get('filesize') or 0
+                                   for status, path, row in todo)
+        if verbose:
+            print(f'{len(todo)} files to download, '
+                  f'{len(unchanged)} unchanged')
+        if dry_run:
+            for status, path, row in todo:
+                if status == 'new':
+                    report.new.append(path)
+                else:
+                    report.changed.append(path)
+                if verbose:
+                    print(f'{status:>8} {path} ({row.get("filesize")} bytes)')
+            return(report)
+
+        items = dict() # dict(md5sum) = (status, path, row)
+        for status, path, row in todo:
+            (outdir / path).parent.mkdir(parents=True, exist_ok=True)
+            items[row['md5sum']] = (status, path, row)
+
+        def progress(dlreport, md5sum, dlstatus):
+            status, path, row = items[md5sum]
+            if dlstatus == 'failed':
+                report.failed[path] = dlreport.failed[md5sum]
+                return
+            state.put(path, md5sum, row.get('filesize'), row['caldat'])
+            if dlstatus == 'skipped':
+                # Already on disk (e.g. state was lost)
+                report.unchanged.append(path)
+                report.bytes_skipped += row.get('filesize') or 0
+            elif status == 'new':
+                report.new.append(path)
+            else:
+                report.changed.append(path)
+
+        dl = BulkDownloader(fapi, outdir, max_workers=max_workers,
+                            max_bytes_per_sec=max_bytes_per_sec,
+                            retries=retries, progress=progress,
+                            verbose=verbose)
+        dlreport = dl.download([dict(md5sum=md5sum, outfile=path)
+                                for md5sum, (status, path, row)
+                                in items.items()])
+        report.bytes_transferred = dlreport.nbytes
+        report.seconds = dlreport.seconds
+    finally:
+        state.close()
+    return(report)
+
+##############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=('Mirror the files of a telescope/instrument for a '
+                     'range of nights, downloading only new or changed files'),
+        epilog=('EXAMPLE: %(prog)s --telescope ct4m --instrument decam '
+                '--start 2017-08-15 --end 2017-08-16 --outdir ~/decam')
+        )
+    parser.add_argument('--telescope', required=True,
+                        help='Name of telescope that created the FITS files.' )
+    parser.add_argument('--instrument', required=True,
+                        help='Name of instrument that created the FITS files.' )
+    parser.add_argument('--start', required=True,
+                        help='First night (YYYY-MM-DD) to mirror.' )
+    parser.add_argument('--end',
+                        help='Last night (YYYY-MM-DD) to mirror (default: START).' )
+    parser.add_argument('--outdir', type=Path, required=True,
+                        help='Directory to mirror files into.' )
+    parser.add_argument('--state',
+                        help=('sqlite file of mirrored files '
+                              '(default: OUTDIR/.night_sync.sqlite)') )
+    parser.add_argument('--dry_run', action='store_true',
+                        help='Only list files that would be downloaded.' )
+    parser.add_argument('--username',
+                        help='Username (email) of an authenticated user' )
+    parser.add_argument('--password',
+                        help='Password of an authenticated user' )
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of files to download concurrently' )
+    parser.add_argument('--bandwidth', type=float,
+                        help='Max total download rate (MB/sec)' )
+    parser.add_argument('--retries', type=int, default=3,
+                        help='Times to retry a failed download' )
+    parser.add_argument('--page_size', type=int, default=10000,
+                        help='Number of files to get with each search' )
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show progress of each file.' )
+    args = parser.parse_args()
+
+    fapi =  helpers.api.FitsFile(username=args.username,
+                                 password=args.password,
+                                 pool_size=args.workers)
+    report = sync_nights(fapi, args.telescope, args.instrument,
+                         args.start, args.end or args.start, args.outdir,
+                         state=args.state, dry_run=args.dry_run,
+                         max_workers=args.workers,
+                         max_bytes_per_sec=(args.bandwidth and
+                                            args.bandwidth * 1e6),
+                         retries=args.retries, page_size=args.page_size,
+                         verbose=args.verbose)
+    for path, err in report.failed.items():
+        print(f'ERROR: {err}; Could not retrieve {path}')
+    print(report)
+
+if __name__ == '__main__':
+    main()
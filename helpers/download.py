@@ -0,0 +1,197 @@
+"""Download many files from the Astro Data Archive concurrently."""
+
+# EXAMPLE:
+#   fapi = helpers.api.FitsFile()
+#   dl = BulkDownloader(fapi, '~/Downloads/noirlab', max_workers=8,
+#                       max_bytes_per_sec=50e6)
+#   report = dl.download(['0000298c7e0b3ce96b3fff51515a6100', ...])
+#   print(report)
+
+# Python Standard Library
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path, PosixPath
+from urllib.parse import urlparse
+import threading
+import time
+# Local Packages
+from helpers.api import CHUNK_SIZE
+
+
+class RateLimiter():
+    """Token bucket allowing RATE units per second on average, and
+    bursts of up to BURST units (default: one second worth).
+    Thread safe."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """Block until AMOUNT units may be used."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            # Go into debt (and wait it off) so AMOUNT > BURST still works.
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class DownloadReport():
+    """Outcome of BulkDownloader.download()."""
+
+    def __init__(self):
+        self.downloaded = dict()  # dict(md5sum) = path
+        self.skipped = dict()     # dict(md5sum) = path (already on disk)
+        self.failed = dict()      # dict(md5sum) = error message
+        self.nbytes = 0
+        self.seconds = 0.0
+
+    @property
+    def paths(self):
+        """Paths of all files that are now on disk."""
+        return(list(self.downloaded.values()) + list(self.skipped.values()))
+
+    @property
+    def rate(self):
+        return(self.nbytes / self.seconds if self.seconds > 0 else 0.0)
+
+    def __str__(self):
+        return(f'Downloaded {len(self.downloaded)} files '
+               f'({self.nbytes/1e6:,.1f} MB in {self.seconds:,.1f} sec, '
+               f'{self.rate/1e6:,.2f} MB/sec), '
+               f'skipped {len(self.skipped)}, failed {len(self.failed)}')
+
+
+class BulkDownloader():
+    """Retrieve files with FAPI (a helpers.api.FitsFile) into OUTDIR
+    using up to MAX_WORKERS concurrent downloads.
+
+    MAX_REQUESTS_PER_SEC limits how often new retrievals are started
+    against each host; MAX_BYTES_PER_SEC caps the total bandwidth of
+    all workers.  A failed download is retried up to RETRIES times
+    (sleeping BACKOFF*(2**n) seconds) and resumes from its partial file.
+    PROGRESS (if given) is called as PROGRESS(report, md5sum, status)
+    after each file completes, with status in ('downloaded', 'skipped',
+    'failed').
+    """
+
+    def __init__(self, fapi, outdir, max_workers=4,
+                 max_requests_per_sec=None, max_bytes_per_sec=None,
+                 retries=3, backoff=1.0, chunk_size=CHUNK_SIZE,
+                 progress=None, verbose=False):
+        self.fapi = fapi
+        self.outdir = Path(PosixPath(outdir).expanduser())
+        self.max_workers = max_workers
+        self.max_requests_per_sec = max_requests_per_sec
+        self.retries = retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.verbose = verbose
+        self.host_limiters = dict() # dict(host) = RateLimiter
+        self.lock = threading.Lock()
+        self.bandwidth = (None if max_bytes_per_sec is None
+                          else RateLimiter(max_bytes_per_sec))
+
+    def host_limiter(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_limiters:
+                self.host_limiters[host] = RateLimiter(
+                    self.max_requests_per_sec)
+            return(self.host_limiters[host])
+
+    def target(self, item):
+        """Return (md5sum, local path) for one ITEM to download.
+
+        ITEM is an md5sum, or a search row (dict) containing "md5sum"
+        and optionally "outfile" (path relative to OUTDIR) or
+        "archive_filename" (whose basename is used)."""
+        if isinstance(item, str):
+            return(item, self.outdir / item)
+        fileid = item['md5sum']
+        if item.get('outfile'):
+            name = item['outfile']
+        elif item.get('archive_filename'):
+            name = Path(item['archive_filename']).name
+        else:
+            name = fileid
+        return(fileid, self.outdir / name)
+
+    def throttle(self):
+        """Return a retrieve_to() callback enforcing the bandwidth cap."""
+        if self.bandwidth is None:
+            return(None)
+        last = [0]
+        def callback(nbytes, rate):
+            self.bandwidth.acquire(nbytes - last[0])
+            last[0] = nbytes
+        return(callback)
+
+    def fetch(self, fileid, path):
+        """Download one file (with retries). Return bytes downloaded."""
+        for attempt in range(self.retries + 1):
+            if self.max_requests_per_sec is not None:
+                self.host_limiter(self.fapi.apiurl).acquire()
+            try:
+                return(self.fapi.retrieve_to(fileid, path,
+                                             chunk_size=self.chunk_size,
+                                             callback=self.throttle()))
+            except Exception as err:
+                if attempt == self.retries:
+                    raise
+                if self.verbose:
+                    print(f'Retry {attempt+1} of {fileid} after: {err}')
+                time.sleep(self.backoff * 2**attempt)
+
+    def download(self, items):
+        """Download all ITEMS (see target()). Return a DownloadReport.
+        Items repeating the md5sum and path of an earlier one are
+        ignored (so no two threads write the same file); items of other
+        md5sums with the same path are an error."""
+        report = DownloadReport()
+        start = time.monotonic()
+        targets = list(dict.fromkeys(self.target(item) for item in items))
+        owners = dict() # dict(path) = md5sum
+        for fileid, path in targets:
+            if owners.setdefault(path, fileid) != fileid:
+                raise Exception(f'Files {owners[path]} and {fileid} would '
+                                f'both be downloaded to {path}')
+        self.outdir.mkdir(parents=True, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = dict()
+            for fileid, path in targets:
+                futures[pool.submit(self.fetch, fileid, path)] = (fileid,
+                                                                  path)
+            for future in as_completed(futures):
+                fileid, path = futures[future]
+                try:
+                    nbytes = future.result()
+                except Exception as err:
+                    report.failed[fileid] = str(err)
+                    status = 'failed'
+                else:
+                    if nbytes == 0 and path.exists():
+                        report.skipped[fileid] = path
+                        status = 'skipped'
+                    else:
+                        report.downloaded[fileid] = path
+                        report.nbytes += nbytes
+                        status = 'downloaded'
+                report.seconds = time.monotonic() - start
+                if self.verbose:
+                    done = (len(report.downloaded) + len(report.skipped)
+                            + len(report.failed))
+                    print(f'[{done}/{len(futures)}] {status} {fileid} '
+                          f'-> {path}')
+                if self.progress is not None:
+                    self.progress(report, fileid, status)
+        report.seconds = time.monotonic() - start
+        return(report)
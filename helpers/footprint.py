@@ -0,0 +1,255 @@
+"""Local index of the footprints (RA, DEC bounding boxes) of Archive
+files or HDUs, for answering "what covers this position" without the
+server."""
+
+# EXAMPLE:
+#   fapi = helpers.api.FitsFile()
+#   fp = FootprintIndex.harvest(fapi, 'decam', 'instcal',
+#                               fields=['archive_filename'])
+#   fp.save('decam_instcal.npz')
+#   fp = FootprintIndex.load('decam_instcal.npz')
+#   fp.refresh(fapi)                 # add files archived since
+#   idx = fp.query_point(10.5, -30.1)
+#   fp.rows(idx)['archive_filename']
+#   idx = fp.query_box(10, 11, -31, -30)
+
+# Python Standard Library
+import json
+import os
+# External Packages
+import numpy as np
+# Local Packages
+from helpers.api import Rec
+
+
+BBOX_FIELDS = ['ra_min', 'ra_max', 'dec_min', 'dec_max']
+# Rows fetched per search when harvesting (API.limit is far smaller)
+PAGE_SIZE = 100000
+
+def ra_interval(ra_min, ra_max):
+    """Return (lo, width) of the RA intervals from RA_MIN to RA_MAX
+    (degrees).  Footprints are assumed narrower than 180 degrees, so
+    intervals straddling RA=0/360 are recognized whichever way round
+    their limits are given."""
+    ra_min = np.asarray(ra_min, dtype=float)
+    ra_max = np.asarray(ra_max, dtype=float)
+    width = np.mod(ra_max - ra_min, 360)
+    wrapped = width > 180
+    lo = np.where(wrapped, ra_max, ra_min) % 360
+    return(lo, np.where(wrapped, 360 - width, width))
+
+
+class FootprintIndex():
+    """Footprints of records (files or HDUs) indexed by the cells (of
+    CELL degrees in RA and DEC) they touch.
+
+    COLUMNS is dict(field) = numpy array with (at least) BBOX_FIELDS
+    and the KEY fields that identify a record.  For each cell, the
+    records touching it are RECORDS[OFFSETS[cell]:OFFSETS[cell+1]].
+    META describes the harvest (see harvest(), refresh()).
+    """
+
+    def __init__(self, columns, key=('md5sum',), cell=1.0, meta=None,
+                 records=None, offsets=None):
+        self.columns = {k: np.asarray(v) for k, v in columns.items()}
+        self.key = list(key)
+        self.cell = float(cell)
+        self.meta = dict(meta or {})
+        self.nra = int(round(360 / self.cell))
+        self.ndec = int(round(180 / self.cell))
+        self.ra_lo, self.ra_width = ra_interval(self.columns['ra_min'],
+                                                self.columns['ra_max'])
+        self.dec_min = self.columns['dec_min'].astype(float)
+        self.dec_max = self.columns['dec_max'].astype(float)
+        if records is None:
+            self.build()
+        else:
+            self.records, self.offsets = records, offsets
+
+    def __len__(self):
+        return(len(self.dec_min))
+
+    def cell_row(self, dec):
+        return(np.clip(((np.asarray(dec) + 90) // self.cell).astype(int),
+                       0, self.ndec - 1))
+
+    def cell_col(self, ra):
+        return((np.asarray(ra) // self.cell).astype(int) % self.nra)
+
+    def box_cells(self, lo, width, dec_min, dec_max):
+        """Return (box, cell) of the cells touched by each box."""
+        r0, r1 = self.cell_row(dec_min), self.cell_row(dec_max)
+        c0 = (np.asarray(lo) // self.cell).astype(int)
+        ncols = np.minimum((np.asarray(lo) + width) // self.cell
+                           - c0 + 1, self.nra).astype(int)
+        nrows = r1 - r0 + 1
+        counts = nrows * ncols
+        box = np.repeat(np.arange(len(counts)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                counts)
+        row = r0[box] + k // ncols[box]
+        col = (c0[box] + k % ncols[box]) % self.nra
+        return(box, row * self.nra + col)
+
+    def build(self):
+        """(Re)make the cell index from the footprints."""
+        records, cells = self.box_cells(self.ra_lo, self.ra_width,
+                                        self.dec_min, self.dec_max)
+        order = np.argsort(cells, kind='stable')
+        self.records = records[order]
+        self.offsets = np.zeros(self.nra * self.ndec + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=self.nra * self.ndec),
+                  out=self.offsets[1:])
+
+    def candidates(self, cells):
+        """Return (cell_idx, record) for all records in CELLS."""
+        cells = np.asarray(cells)
+        starts, stops = self.offsets[cells], self.offsets[cells + 1]
+        counts = stops - starts
+        which = np.repeat(np.arange(len(cells)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                counts)
+        return(which, self.records[starts[which] + k])
+
+    def covers(self, records, ra, dec):
+        return((self.dec_min[records] <= dec) & (dec <= self.dec_max[records])
+               & (np.mod(ra - self.ra_lo[records], 360)
+                  <= self.ra_width[records]))
+
+    def query_point(self, ra, dec):
+        """Return indices of the records whose footprint holds RA, DEC."""
+        cell = self.cell_row(dec) * self.nra + self.cell_col(ra)
+        records = self.records[self.offsets[cell]:self.offsets[cell + 1]]
+        return(records[self.covers(records, ra, dec)])
+
+    def query_points(self, ra, dec):
+        """Return (point, record) index arrays of all the records whose
+        footprint holds one of the positions RA, DEC (arrays)."""
+        ra, dec = np.asarray(ra, dtype=float), np.asarray(dec, dtype=float)
+        cells = self.cell_row(dec) * self.nra + self.cell_col(ra)
+        point, records = self.candidates(cells)
+        keep = self.covers(records, ra[point], dec[point])
+        return(point[keep], records[keep])
+
+    def query_box(self, ra_min, ra_max, dec_min, dec_max):
+        """Return indices of the records whose footprint overlaps the
+        box RA_MIN..RA_MAX, DEC_MIN..DEC_MAX.  The box runs east from
+        RA_MIN to RA_MAX, across RA=0/360 if RA_MIN > RA_MAX (so boxes
+        may be wider than 180 degrees, unlike footprints), and spans all
+        RA if RA_MAX - RA_MIN >= 360."""
+        lo = np.array([ra_min % 360])
+        width = np.array([360.0 if ra_max - ra_min >= 360
+                          else (ra_max - ra_min) % 360])
+        box, cells = self.box_cells(lo, width, [dec_min], [dec_max])
+        records = np.unique(self.candidates(cells)[1])
+        overlap = ((self.dec_min[records] <= dec_max)
+                   & (dec_min <= self.dec_max[records])
+                   & ((np.mod(lo - self.ra_lo[records], 360)
+                       <= self.ra_width[records])
+                      | (np.mod(self.ra_lo[records] - lo, 360) <= width)))
+        return(records[overlap])
+
+    def rows(self, indices):
+        """Return dict(field) = values of the records at INDICES."""
+        return({k: v[indices] for k, v in self.columns.items()})
+
+    ##########################################################################
+    # Harvesting from the Archive
+
+    @staticmethod
+    def harvest_spec(rectype, instrument, proc_type, fields=(), start=None,
+                     end=None):
+        """Return (jspec, key, caldat_field) to harvest footprints."""
+        prefix = 'fitsfile__' if rectype == Rec.Hdu else ''
+        key = ['fitsfile', 'hdu_idx'] if rectype == Rec.Hdu else ['md5sum']
+        caldat = f'{prefix}caldat'
+        search = [[f'{prefix}instrument', instrument],
+                  [f'{prefix}proc_type', proc_type]]
+        if start is not None or end is not None:
+            search.append([caldat, start or '1900-01-01', end or '2999-12-31'])
+        outfields = list(dict.fromkeys(key + BBOX_FIELDS + [caldat]
+                                       + list(fields)))
+        return(dict(outfields=outfields, search=search), key, caldat)
+
+    @staticmethod
+    def fetch(api, jspec, page_size=PAGE_SIZE):
+        """Return dict(field) = numpy array of all results of JSPEC with
+        a footprint, searched PAGE_SIZE rows at a time."""
+        pages = [cols for info, cols in api.iter_columns(
+            jspec, page_size=page_size, prefetch=True)]
+        columns = {k: np.concatenate([page[k] for page in pages])
+                   for k in jspec['outfields']}
+        bbox = np.column_stack([np.asarray(columns[k], dtype=float)
+                                for k in BBOX_FIELDS])
+        good = ~np.isnan(bbox).any(axis=1)
+        return({k: v[good] for k, v in columns.items()})
+
+    @classmethod
+    def harvest(cls, api, instrument, proc_type, fields=(), cell=1.0,
+                start=None, end=None, page_size=PAGE_SIZE):
+        """Return index of the footprints of the records (files or HDUs,
+        per the type of API) of INSTRUMENT and PROC_TYPE with caldat
+        from START to END (default: all).  FIELDS are kept along with
+        the footprints (and key) of each record.  Searches get PAGE_SIZE
+        rows at a time."""
+        jspec, key, caldat = cls.harvest_spec(api.type, instrument,
+                                              proc_type, fields, start, end)
+        columns = cls.fetch(api, jspec, page_size=page_size)
+        meta = dict(rectype=api.type.name, instrument=instrument,
+                    proc_type=proc_type, fields=list(fields),
+                    last_caldat=max(map(str, columns[caldat]), default=start))
+        if api.verbose:
+            print(f'Harvested {len(columns[caldat]):,} footprints')
+        return(cls(columns, key=key, cell=cell, meta=meta))
+
+    def refresh(self, api, page_size=PAGE_SIZE):
+        """Add records with a caldat no earlier than the latest one
+        harvested so far (replacing those harvested before, so files
+        archived later for that night are included).  Return number of
+        records added."""
+        if api.type.name != self.meta['rectype']:
+            raise Exception(f'Index is of {self.meta["rectype"]} records, '
+                            f'not {api.type.name}')
+        jspec, key, caldat = self.harvest_spec(
+            api.type, self.meta['instrument'], self.meta['proc_type'],
+            self.meta['fields'], start=self.meta['last_caldat'])
+        new = self.fetch(api, jspec, page_size=page_size)
+        if len(new[caldat]) == 0:
+            return(0)
+        newkeys = set(zip(*[new[k].tolist() for k in key]))
+        old = np.array([k not in newkeys for k in
+                        zip(*[self.columns[k].tolist() for k in key])],
+                       dtype=bool)
+        columns = {k: np.concatenate([v[old], new[k]])
+                   for k, v in self.columns.items()}
+        added = len(new[caldat]) - np.count_nonzero(~old)
+        self.__init__(columns, key=self.key, cell=self.cell,
+                      meta=dict(self.meta, last_caldat=max(
+                          self.meta['last_caldat'] or '',
+                          max(map(str, new[caldat])))))
+        return(added)
+
+    ##########################################################################
+    # On disk
+
+    def save(self, filename):
+        """Write index to FILENAME (a .npz file) atomically."""
+        tmp = f'{filename}.tmp.npz'
+        columns = {f'col_{k}': (v.astype(str) if v.dtype == object else v)
+                   for k, v in self.columns.items()}
+        np.savez(tmp, records=self.records, offsets=self.offsets,
+                 meta=json.dumps(dict(self.meta, key=self.key,
+                                      cell=self.cell)),
+                 **columns)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Return index written by save()."""
+        with np.load(filename) as npz:
+            meta = json.loads(str(npz['meta']))
+            columns = {k[4:]: npz[k] for k in npz.files
+                       if k.startswith('col_')}
+            return(cls(columns, key=meta.pop('key'), cell=meta.pop('cell'),
+                       meta=meta, records=npz['records'],
+                       offsets=npz['offsets']))
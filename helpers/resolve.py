@@ -0,0 +1,69 @@
+"""Resolve many values of a numeric field with few range searches."""
+
+# EXAMPLE:
+#   fapi = helpers.api.FitsFile()
+#   found, missing = resolve_keys(
+#       fapi, 'EXPNUM', [938946, 938947, 938950],
+#       outfields=['md5sum'],
+#       search=[["instrument", "decam"], ["proc_type", "raw"]])
+#   # found = dict(938946=[row], ...);  missing = set of EXPNUMs not found
+
+
+def coalesce_ranges(keys, max_span=None, max_gap=0):
+    """Return list of (lo, hi) inclusive ranges covering integer KEYS.
+
+    Keys that are contiguous (or separated by at most MAX_GAP values
+    that were not asked for) share one range.  No range covers more
+    than MAX_SPAN values (if given).
+    """
+    ranges = []
+    for key in sorted(set(keys)):
+        if ranges:
+            lo, hi = ranges[-1]
+            if (key - hi - 1 <= max_gap
+                and (max_span is None or key - lo + 1 <= max_span)):
+                ranges[-1] = (lo, key)
+                continue
+        ranges.append((key, key))
+    return(ranges)
+
+def resolve_keys(api, field, keys, outfields, search=(), limit=10000,
+                 max_span=None, max_gap=0, verbose=False):
+    """Search API (an AdaApi) for records whose numeric FIELD is one of KEYS.
+
+    KEYS are coalesced into as few ["FIELD", lo, hi] range searches as
+    possible (see coalesce_ranges), each combined with the other SEARCH
+    terms and asking for up to LIMIT rows.  MAX_SPAN defaults to LIMIT.
+    A range whose result was truncated by LIMIT has its keys split in
+    two halves which are searched again.
+
+    Return (found, missing) where found is dict(key) = [row, ...] and
+    missing is the set of KEYS with no matching record.
+    """
+    keys = set(int(k) for k in keys)
+    outfields = list(outfields)
+    if field not in outfields:
+        outfields.append(field)
+    todo = coalesce_ranges(keys, max_span=max_span or limit, max_gap=max_gap)
+    found = dict()
+    while todo:
+        lo, hi = todo.pop(0)
+        jspec = dict(outfields=outfields,
+                     search=list(search) + [[field, lo, hi]])
+        info, rows = api.search(jspec, limit=limit)
+        if info['RESULTS']['MORE']:
+            inside = sorted(k for k in keys if lo <= k <= hi)
+            if len(inside) == 1:
+                raise Exception(f'More than {limit} records have '
+                                f'{field}={inside[0]}; increase LIMIT')
+            half = len(inside) // 2
+            todo[:0] = (coalesce_ranges(inside[:half], max_gap=max_gap)
+                        + coalesce_ranges(inside[half:], max_gap=max_gap))
+            continue
+        if verbose:
+            print(f'Found {len(rows)} records with {field} in [{lo},{hi}]')
+        for row in rows:
+            key = int(row[field])
+            if key in keys:
+                found.setdefault(key, []).append(row)
+    return(found, keys - set(found))
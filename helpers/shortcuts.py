@@ -1,15 +1,22 @@
+# Local Packages
+from helpers.api import AdaApi, Rec
+
+
 
 class ShortcutApi(AdaApi):
 
-    def __init__(self, url='https://astroarchive.noao.edu'):
-        self.adsurl = f'{url}/api/adv_search'
+    def __init__(self, url='https://astroarchive.noao.edu', limit=10000,
+                 verbose=False, session=None, **kwargs):
+        super().__init__(url=url.rstrip('/'), verbose=verbose,
+                         session=session, **kwargs)
+        self.type = Rec.File
+        self.limit = limit
         #!self.shorturl = f'{url}/short'
     
     
-    def night_files​(self, telescope, instrument, caldat):
+    def night_files(self, telescope, instrument, caldat):
         """Get list of all files for specific telescope,instrument,night."""
         # @@@ VALIDATE args
-        self.type = 'file'
         jspec = dict(
             outfields = [
                 "md5sum",
@@ -44,6 +51,6 @@ class ShortcutApi(AdaApi):
                 ["caldat", caldat, caldat]
             ])
 
-        res = self.search(jspec)
-        return(res.json())
+        info, rows = self.search(jspec)
+        return(rows)
 
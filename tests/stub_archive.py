@@ -0,0 +1,239 @@
+# A tiny local stand-in for the Astro Data Archive web-service API.
+# Used by the tests and benchmarks so they do not need the real server.
+#
+# EXAMPLE:
+#   with StubArchive(rows=[dict(md5sum='abc')]) as stub:
+#       fapi = helpers.api.FitsFile(stub.url)
+#       info, rows = fapi.search({"outfields": ["md5sum"], "search": []})
+
+# Python Standard Library
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import csv
+import io
+import json
+import math
+import threading
+import time
+
+
+def matches(row, term):
+    """True if ROW satisfies one search TERM of a jspec."""
+    field, *args = term
+    value = row.get(field)
+    if len(args) == 2 and args[1] == 'contains':
+        return(value is not None and args[0] in value)
+    if len(args) == 2:
+        return(value is not None and args[0] <= value <= args[1])
+    return(value == args[0])
+
+def query_limit(qs):
+    """Return the limit of a query QS (limit=None: no limit)."""
+    limit = qs.get('limit', ['100'])[0]
+    return(10**9 if limit == 'None' else int(limit))
+
+def in_box(row, qs):
+    """True if the footprint (ra_min, ra_max, dec_min, dec_max) of ROW
+    overlaps the box of a vosearch query QS.  Rows without a footprint
+    are in the box if their ra_center, dec_center is (or if they have
+    no position either)."""
+    ra, dec = map(float, qs['POS'][0].split(','))
+    half = float(qs['SIZE'][0]) / 2
+    if all(row.get(k) is not None
+           for k in ('ra_min', 'ra_max', 'dec_min', 'dec_max')):
+        rhalf = min(half / max(math.cos(math.radians(dec)), 1e-9), 180)
+        lo = (ra - rhalf) % 360
+        width = (row['ra_max'] - row['ra_min']) % 360
+        return(row['dec_min'] <= dec + half and dec - half <= row['dec_max']
+               and ((row['ra_min'] - lo) % 360 <= 2 * rhalf
+                    or (lo - row['ra_min']) % 360 <= width))
+    if 'ra_center' not in row or 'dec_center' not in row:
+        return(True)
+    dra = (row['ra_center'] - ra + 180) % 360 - 180
+    return(abs(row['dec_center'] - dec) <= half
+           and abs(dra) * math.cos(math.radians(dec)) <= half)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True  # else ~40ms delayed-ACK stalls
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def send_body(self, body, status=200, ctype='application/json',
+                  headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, content):
+        status, headers, start = 200, {}, 0
+        rng = self.headers.get('Range')
+        if rng and self.server.ranges:
+            start = int(rng.split('=')[1].split('-')[0])
+            if start >= len(content):
+                return(self.send_body(b'', status=416, headers={
+                    'Content-Range': f'bytes */{len(content)}'}))
+            status = 206
+            headers['Content-Range'] = (f'bytes {start}-{len(content)-1}'
+                                        f'/{len(content)}')
+        body = content[start:]
+        with self.server.lock:
+            cut, self.server.cut_after = self.server.cut_after, None
+        if cut is None:
+            return(self.send_body(body, status=status,
+                                  ctype='application/fits', headers=headers))
+        # Simulate a dropped connection after CUT bytes of BODY.
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body[:cut])
+        self.close_connection = True
+
+    def injected_fault(self):
+        with self.server.lock:
+            self.server.requests += 1
+            if self.server.faults:
+                return(self.server.faults.pop(0))
+        return(None)
+
+    def do_GET(self):
+        fault = self.injected_fault()
+        if fault is not None:
+            return(self.send_body(dict(error='injected'), status=fault))
+        path = urlparse(self.path).path
+        if path.endswith('/version/'):
+            return(self.send_body(self.server.version))
+        if path.startswith('/api/adv_search/'):
+            name = path[len('/api/adv_search/'):].strip('/')
+            with self.server.lock:
+                self.server.metadata_requests.append(name)
+            if name in self.server.metadata:
+                return(self.send_body(self.server.metadata[name]))
+        if path.startswith('/api/sia/vo'):
+            qs = parse_qs(urlparse(self.path).query)
+            limit = query_limit(qs)
+            rows = [r for r in self.server.rows if in_box(r, qs)]
+            with self.server.lock:
+                self.server.vosearches.append(qs)
+            info = dict(HEADER=dict(POS=qs['POS'][0], SIZE=qs['SIZE'][0]),
+                        RESULTS=dict(COUNT=min(limit, len(rows)),
+                                     MORE=len(rows) > limit))
+            return(self.send_body([info] + rows[:limit]))
+        if path.startswith('/api/retrieve/'):
+            fileid = path.split('/')[3]
+            if fileid not in self.server.files:
+                return(self.send_body(dict(error='no such file'), status=404))
+            return(self.send_file(self.server.files[fileid]))
+        return(self.send_body(dict(error='not found'), status=404))
+
+    def do_POST(self):
+        fault = self.injected_fault()
+        length = int(self.headers.get('Content-Length', 0))
+        jspec = json.loads(self.rfile.read(length) or b'{}')
+        if fault is not None:
+            return(self.send_body(dict(error='injected'), status=fault))
+        url = urlparse(self.path)
+        qs = parse_qs(url.query)
+        if url.path.endswith('asearch/'):
+            with self.server.lock:
+                self.server.searches.append((url.path, qs, jspec))
+                stall, self.server.stall = self.server.stall, None
+            if stall is not None:
+                time.sleep(stall)
+            limit = query_limit(qs)
+            offset = int(qs.get('offset', ['0'])[0])
+            outfields = jspec.get('outfields')
+            rows = (self.server.hdu_rows if url.path.endswith('hasearch/')
+                    else self.server.rows)
+            rows = [r for r in rows
+                    if all(matches(r, t) for t in jspec.get('search', []))]
+            page = [{k: r.get(k) for k in outfields} if outfields else r
+                    for r in rows[offset:offset+limit]]
+            if qs.get('format', ['json'])[0] == 'csv':
+                out = io.StringIO()
+                writer = csv.writer(out)
+                writer.writerow(outfields)
+                writer.writerows([['' if r[k] is None else r[k]
+                                   for k in outfields] for r in page])
+                return(self.send_body(out.getvalue().encode(),
+                                      ctype='text/csv'))
+            info = dict(HEADER=dict(outfields=outfields),
+                        RESULTS=dict(COUNT=len(page),
+                                     MORE=len(rows) > offset+limit))
+            return(self.send_body([info] + page))
+        return(self.send_body(dict(error='not found'), status=404))
+
+
+class StubArchive():
+    """Run a StubHandler server on a free localhost port in a thread.
+
+    ROWS matching the jspec search terms are returned (projected onto
+    outfields) by fasearch/hasearch; hasearch uses HDU_ROWS instead
+    when given.  vohdu/voimg return the ROWS whose ra_center,
+    dec_center (if any) are in the box searched.
+    METADATA is dict(name) = response of /api/adv_search/<name>/
+    (e.g. name="cat_lists" or "aux_file_fields/decam/raw").
+    FILES is a dict(fileid) = bytes served by retrieve.  HTTP Range
+    requests are honored unless RANGES is False.  If CUT_AFTER is set,
+    the next retrieve drops the connection after that many bytes.
+    FAULTS is a list of HTTP status codes returned by the next requests.
+    If STALL is set, the next search waits that many seconds to answer.
+    """
+
+    def __init__(self, rows=None, files=None, faults=None, version=5.0,
+                 ranges=True, cut_after=None, metadata=None, hdu_rows=None,
+                 stall=None):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.rows = list(rows or [])
+        self.server.hdu_rows = (self.server.rows if hdu_rows is None
+                                else list(hdu_rows))
+        self.server.files = dict(files or {})
+        self.server.metadata = dict(metadata or {})
+        self.server.metadata_requests = []
+        self.server.ranges = ranges
+        self.server.cut_after = cut_after
+        self.server.stall = stall
+        self.server.faults = list(faults or [])
+        self.server.version = version
+        self.server.connections = 0
+        self.server.requests = 0
+        self.server.searches = []
+        self.server.vosearches = []
+        host, port = self.server.server_address
+        self.url = f'http://{host}:{port}'
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    def __getattr__(self, name):
+        return(getattr(self.server, name))
+
+    def start(self):
+        self.thread.start()
+        return(self)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return(self.start())
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -4,11 +4,14 @@
 
 # Python Standard Library
 from pprint import pformat
+import hashlib
 from pathlib import Path, PosixPath
 # Local Packages
 import helpers.api
+from stub_archive import StubArchive
 # External Packages
 import pytest
+import requests
 
 
 #rooturl = 'https://astroarchive.noao.edu/' #@@@
@@ -24,7 +27,6 @@ def test_search():
     info,rows = fapi.search({"outfields": ["archive_filename"], "search":[]})
     assert len(rows) == 5
 
-@pytest.mark.skip(reason="CSV and XML return itertools.chain in response")    
 def test_search_csv():
     info,rows = fapi.search({"outfields": ["md5sum","caldat"], "search":[]},
                            format='csv')
@@ -46,3 +48,620 @@ def test_retrieve_public():
                            f'fits{publicFileId}')
     with open(local_file_path,'wb') as fits:
         fits.write(fapi.retrieve(publicFileId))
+
+
+##############################################################################
+# Tests against a local stub archive (no network needed)
+
+def test_session_keepalive():
+    with StubArchive(rows=[dict(md5sum=str(i)) for i in range(3)]) as stub:
+        api = helpers.api.FitsFile(stub.url, limit=2)
+        for i in range(5):
+            info,rows = api.search({"outfields": ["md5sum"], "search":[]})
+        assert len(rows) == 2
+        assert stub.connections == 1
+
+def test_session_shared():
+    with StubArchive() as stub:
+        api = helpers.api.FitsFile(stub.url)
+        hapi = helpers.api.FitsHdu(stub.url, session=api.session)
+        assert hapi.session is api.session
+        api.search({"outfields": ["md5sum"], "search":[]})
+        hapi.search({"outfields": ["hdu_idx"], "search":[]})
+        assert stub.connections == 1
+
+def test_session_retry():
+    with StubArchive(faults=[503, 429]) as stub:
+        api = helpers.api.FitsFile(stub.url, backoff=0)
+        info,rows = api.search({"outfields": ["md5sum"], "search":[]})
+        assert stub.requests == 3
+    with StubArchive(faults=[503, 503]) as stub:
+        api = helpers.api.FitsFile(stub.url, retries=1, backoff=0)
+        with pytest.raises(Exception):
+            api.search({"outfields": ["md5sum"], "search":[]})
+
+def test_search_not_reposted():
+    # A search the server is slow to answer is not sent again
+    with StubArchive(stall=1.0) as stub:
+        api = helpers.api.FitsFile(stub.url, backoff=0,
+                                   search_timeout=(5, 0.2))
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            api.search({"outfields": ["md5sum"], "search":[]})
+        assert len(stub.searches) == 1
+    assert helpers.api.FitsFile().search_timeout == (5, 600)
+
+def test_retrieve_to(tmp_path):
+    content = bytes(range(256)) * 1000
+    fileid = hashlib.md5(content).hexdigest()
+    with StubArchive(files={fileid: content}) as stub:
+        api = helpers.api.FitsFile(stub.url)
+        chunks = list(api.iter_retrieve(fileid, chunk_size=1000))
+        assert len(chunks) == 256
+        assert b''.join(chunks) == content
+
+        progress = []
+        path = tmp_path / 'abc.fits'
+        nbytes = api.retrieve_to(fileid, path, chunk_size=10000,
+                                 callback=lambda n,rate: progress.append(n))
+        assert nbytes == len(content) == progress[-1]
+        assert path.read_bytes() == content
+        assert not path.with_name('abc.fits.part').exists()
+
+        with pytest.raises(Exception):
+            api.retrieve_to('nosuchfile', tmp_path / 'x.fits')
+        assert list(tmp_path.iterdir()) == [path]
+
+def test_retrieve_resume(tmp_path):
+    content = bytes(range(256)) * 4000
+    fileid = hashlib.md5(content).hexdigest()
+    path = tmp_path / 'resume.fits'
+    part = tmp_path / 'resume.fits.part'
+    for ranges in [True, False]:
+        with StubArchive(files={fileid: content}, ranges=ranges,
+                         cut_after=300000) as stub:
+            api = helpers.api.FitsFile(stub.url)
+            with pytest.raises(Exception):
+                api.retrieve_to(fileid, path, chunk_size=1000)
+            assert part.stat().st_size == 300000
+            nbytes = api.retrieve_to(fileid, path)
+            assert nbytes == len(content) - (300000 if ranges else 0)
+            assert path.read_bytes() == content
+            assert not part.exists()
+            assert api.retrieve_to(fileid, path) == 0 # already there
+            path.unlink()
+
+def test_retrieve_corrupt(tmp_path):
+    content = b'SIMPLE  =' * 1000
+    fileid = hashlib.md5(b'something else').hexdigest()
+    with StubArchive(files={fileid: content}) as stub:
+        api = helpers.api.FitsFile(stub.url)
+        with pytest.raises(Exception, match='corrupt'):
+            api.retrieve_to(fileid, tmp_path / 'bad.fits')
+        assert list(tmp_path.iterdir()) == []
+        assert api.retrieve_to(fileid, tmp_path / 'bad.fits', verify=False)
+
+def test_bulk_download(tmp_path):
+    from helpers.download import BulkDownloader
+    files = {hashlib.md5(bytes([i])*5000).hexdigest(): bytes([i])*5000
+             for i in range(6)}
+    ids = list(files)
+    with StubArchive(files=files) as stub:
+        api = helpers.api.FitsFile(stub.url)
+        dl = BulkDownloader(api, tmp_path, max_workers=3, retries=1,
+                            backoff=0, max_requests_per_sec=1000)
+        items = ids[:5] + [dict(md5sum=ids[5], outfile='six.fits'),
+                           'f'*32]
+        report = dl.download(items)
+        assert len(report.downloaded) == 6
+        assert report.nbytes == 6 * 5000
+        assert list(report.failed) == ['f'*32]
+        assert (tmp_path / 'six.fits').read_bytes() == files[ids[5]]
+
+        report = dl.download(items)
+        assert len(report.skipped) == 6
+        assert report.nbytes == 0
+
+    # Repeated items are downloaded once
+    with StubArchive(files=files) as stub:
+        api = helpers.api.FitsFile(stub.url)
+        dl = BulkDownloader(api, tmp_path / 'again', max_workers=3)
+        report = dl.download([ids[0], ids[0], dict(md5sum=ids[0])])
+        assert len(report.downloaded) == 1 and report.nbytes == 5000
+        assert stub.requests == 1
+
+        # Other files are not written to the same path
+        with pytest.raises(Exception, match='both be downloaded'):
+            dl.download([dict(md5sum=ids[1], outfile='same.fits'),
+                         dict(md5sum=ids[2], outfile='same.fits')])
+        assert stub.requests == 1
+
+def test_rate_limiter():
+    import time
+    from helpers.download import RateLimiter
+    limiter = RateLimiter(1000, burst=100)
+    start = time.monotonic()
+    for i in range(5):
+        limiter.acquire(100)
+    assert time.monotonic() - start >= 0.35
+
+def test_coalesce_ranges():
+    from helpers.resolve import coalesce_ranges
+    keys = [5, 1, 2, 3, 9, 10, 3, 20]
+    assert coalesce_ranges(keys) == [(1,3), (5,5), (9,10), (20,20)]
+    assert coalesce_ranges(keys, max_gap=1) == [(1,5), (9,10), (20,20)]
+    assert coalesce_ranges(keys, max_span=2) == [(1,2), (3,3), (5,5),
+                                                 (9,10), (20,20)]
+
+def test_resolve_keys():
+    from helpers.resolve import resolve_keys
+    rows = [dict(md5sum=f'{n:032x}', EXPNUM=n) for n in range(100, 200)]
+    rows += [dict(md5sum='dup', EXPNUM=150)]
+    with StubArchive(rows=rows) as stub:
+        api = helpers.api.FitsFile(stub.url)
+        keys = [100, 101, 102, 103, 150, 151, 300]
+        found, missing = resolve_keys(api, 'EXPNUM', keys, ['md5sum'],
+                                      limit=2)
+        assert missing == {300}
+        assert [r['md5sum'] for r in found[150]] == [f'{150:032x}', 'dup']
+        assert set(found) == set(keys) - {300}
+        # [100,101], [102,103], [300] and [150,151] which has 3 rows
+        # so is split into [150] and [151]
+        assert len(stub.searches) == 6
+
+def test_iter_search():
+    rows = [dict(md5sum=f'{n:032x}', EXPNUM=n) for n in range(25)]
+    jspec = {"outfields": ["md5sum", "EXPNUM"], "search":[]}
+    for prefetch in [False, True]:
+        with StubArchive(rows=rows) as stub:
+            api = helpers.api.FitsFile(stub.url)
+            pages = list(api.iter_pages(jspec, page_size=10,
+                                        prefetch=prefetch))
+            assert [len(rows) for info,rows in pages] == [10, 10, 5]
+            assert list(api.iter_search(jspec, page_size=7,
+                                        prefetch=prefetch)) == rows
+            assert list(api.iter_search(jspec, page_size=25)) == rows
+
+def test_vosearch_batch(tmp_path):
+    import numpy as np
+    from helpers.cache import SearchCache
+    from helpers.cone import in_boxes
+    rng = np.random.default_rng(5)
+    rra, rdec = rng.uniform(9, 11, 2000), rng.uniform(-31, -29, 2000)
+    hra = 0.1 / np.cos(np.radians(rdec))
+    rows = [dict(md5sum=f'{n:032x}', ra_center=ra, dec_center=dec,
+                 ra_min=ra - h, ra_max=ra + h, dec_min=dec - 0.1,
+                 dec_max=dec + 0.1)
+            for n, (ra, dec, h) in enumerate(zip(rra, rdec, hra))]
+    # Three tight clumps of targets and a few loners
+    ra = np.concatenate([c + rng.normal(0, 0.05, 10) for c in (9.5, 10, 10.5)]
+                        + [rng.uniform(9, 11, 5)])
+    dec = np.concatenate([c + rng.normal(0, 0.05, 10) for c in (-30.5, -30, -29.5)]
+                         + [rng.uniform(-31, -29, 5)])
+    # Footprints overlapping the target boxes, as vosearch() gives
+    tra = 0.05 / np.cos(np.radians(dec))
+    overlap = ((np.abs(rdec[None, :] - dec[:, None]) <= 0.15)
+               & (rra[None, :] - hra[None, :] <= (ra + tra)[:, None])
+               & ((ra - tra)[:, None] <= rra[None, :] + hra[None, :]))
+    expected = sorted((t, rows[r]['md5sum'])
+                      for t, r in zip(*np.nonzero(overlap)))
+    centered = in_boxes(rra, rdec, ra, dec, np.full(len(ra), 0.1))
+    assert (overlap & ~centered).any()
+
+    with StubArchive(rows=rows) as stub:
+        api = helpers.api.FitsFile(stub.url,
+                                   cache=SearchCache(tmp_path, ttl=None))
+        found = api.vosearch_batch(ra, dec, 0.1, limit=1000, cell_size=0.4)
+        assert sorted((r['target_idx'], r['md5sum']) for r in found) == expected
+        nsearches = len(stub.vosearches)
+        assert nsearches < len(ra)
+
+        # From the cache
+        again = api.vosearch_batch(ra, dec, 0.1, limit=1000, cell_size=0.4)
+        assert again == found and len(stub.vosearches) == nsearches
+
+        # Full cells fall back to one search per target
+        api.cache = None
+        del stub.vosearches[:]
+        found = api.vosearch_batch(ra, dec, 0.1, limit=100, cell_size=0.4)
+        assert sorted((r['target_idx'], r['md5sum']) for r in found) == expected
+        assert len(stub.vosearches) > len(ra)
+
+        # Without footprints, rows are matched by their centers
+        for row in rows:
+            del row['ra_min'], row['ra_max'], row['dec_min'], row['dec_max']
+        expected = sorted((t, rows[r]['md5sum'])
+                          for t, r in zip(*np.nonzero(centered)))
+        found = api.vosearch_batch(ra, dec, 0.1, limit=1000, cell_size=0.4,
+                                   margin=0)
+        assert sorted((r['target_idx'], r['md5sum']) for r in found) == expected
+        found = api.vosearch_batch(ra, dec, 0.1, limit=1000, cell_size=0.4)
+        assert set(expected) < set((r['target_idx'], r['md5sum'])
+                                   for r in found)
+
+def test_footprint_index(tmp_path):
+    import numpy as np
+    from helpers.footprint import FootprintIndex, ra_interval
+    rng = np.random.default_rng(6)
+    ra, dec = rng.uniform(0, 360, 3000), rng.uniform(-80, 30, 3000)
+    ra[:50] = rng.uniform(359.5, 360, 50) # straddle RA=0/360
+    def footprint_rows(n0, n, caldat):
+        return([dict(md5sum=f'{n:032x}', caldat=caldat, instrument='decam',
+                     proc_type='instcal', archive_filename=f'/f{n}.fits',
+                     ra_min=ra[n] % 360,
+                     ra_max=(ra[n] + 0.3 / np.cos(np.radians(dec[n]))) % 360,
+                     dec_min=dec[n], dec_max=dec[n] + 0.3)
+                for n in range(n0, n0 + n)])
+    rows = footprint_rows(0, 2000, '2019-01-01')
+    with StubArchive(rows=rows) as stub:
+        fapi = helpers.api.FitsFile(stub.url)
+        fp = FootprintIndex.harvest(fapi, 'decam', 'instcal', cell=0.5,
+                                    fields=['archive_filename'])
+        assert len(fp) == 2000
+        assert len(stub.searches) == 1 # not api.limit rows at a time
+
+        lo, width = ra_interval([r['ra_min'] for r in rows],
+                                [r['ra_max'] for r in rows])
+        dmin = np.array([r['dec_min'] for r in rows])
+        dmax = dmin + 0.3
+        pra = np.concatenate([rng.uniform(0, 360, 200), [0.05, 359.99]])
+        pdec = np.concatenate([rng.uniform(-80, 30, 200), dec[:2] + 0.1])
+        pra[:100], pdec[:100] = ra[:100] + 0.01, dec[:100] + 0.1
+        for p, (pr, pd) in enumerate(zip(pra, pdec)):
+            brute = np.flatnonzero((dmin <= pd) & (pd <= dmax)
+                                   & (np.mod(pr - lo, 360) <= width))
+            assert sorted(fp.query_point(pr, pd)) == list(brute)
+        point, record = fp.query_points(pra, pdec)
+        assert sum(len(fp.query_point(pr, pd))
+                   for pr, pd in zip(pra, pdec)) == len(point)
+        assert all(i in fp.query_point(pra[p], pdec[p])
+                   for p, i in zip(point, record))
+        found = fp.query_box(359.8, 0.2, -80, 30)
+        assert set(range(50)) <= set(found)
+        # Boxes run east from RA_MIN, however wide
+        for bra_min, bra_max in [(10, 200), (0, 359), (300, 100), (0, 360)]:
+            blo, bwidth = bra_min % 360, min((bra_max - bra_min) % 360
+                                             or 360, 360)
+            brute = np.flatnonzero((dmin <= 5) & (-5 <= dmax)
+                                   & ((np.mod(lo - blo, 360) <= bwidth)
+                                      | (np.mod(blo - lo, 360) <= width)))
+            assert sorted(fp.query_box(bra_min, bra_max, -5, 5)) \
+                == list(brute)
+        assert len(fp.query_box(0, 359, -80, 30)) > 1900
+        assert len(fp.query_box(0, 360, -80, 30)) == len(fp)
+        assert fp.rows(fp.query_point(pra[0], pdec[0]))['archive_filename'][0] \
+            == '/f0.fits'
+
+        fp.save(tmp_path / 'fp.npz')
+        fp = FootprintIndex.load(tmp_path / 'fp.npz')
+        assert list(fp.query_point(pra[0], pdec[0])) == [0]
+
+        # Refresh adds the files of later nights (and updates changed ones)
+        stub.server.rows.extend(footprint_rows(2000, 500, '2019-01-05'))
+        assert fp.refresh(fapi) == 500
+        assert len(fp) == 2500
+        assert fp.meta['last_caldat'] == '2019-01-05'
+        assert 2100 in fp.query_point(ra[2100] + 0.01, dec[2100] + 0.1)
+        assert fp.refresh(fapi) == 0 and len(fp) == 2500
+        assert stub.searches[-1][2]['search'][-1] == [
+            'caldat', '2019-01-05', '2999-12-31']
+
+def test_split_range():
+    import datetime
+    split = helpers.api.split_range
+    assert split(0, 9, 3) == [(0, 2), (3, 5), (6, 9)]
+    assert split(5, 5, 4) == [(5, 5)]
+    assert split(0.0, 1.0, 2) == [(0.0, 0.5), (0.5, 1.0)]
+    assert split('2019-01-01', '2019-01-04', 2) == [
+        ('2019-01-01', '2019-01-02'), ('2019-01-03', '2019-01-04')]
+    assert split(datetime.date(2019, 1, 1), datetime.date(2019, 1, 1), 2) == [
+        (datetime.date(2019, 1, 1), datetime.date(2019, 1, 1))]
+    assert split('2019-01-01T00:00:00', '2019-01-01T12:00:00', 2) == [
+        ('2019-01-01T00:00:00', '2019-01-01T06:00:00'),
+        ('2019-01-01T06:00:00', '2019-01-01T12:00:00')]
+    assert split(10, 20, 4, continuous=True) == [
+        (10, 12.5), (12.5, 15.0), (15.0, 17.5), (17.5, 20)]
+    assert split('2019-01-01', '2019-01-03', 2, continuous=True) == [
+        ('2019-01-01T00:00:00', '2019-01-02T00:00:00'),
+        ('2019-01-02T00:00:00', '2019-01-03T00:00:00')]
+    parse = helpers.api.parse_datetime
+    assert (parse('2019-01-01T06:00:00Z') == parse('2019-01-01T07:00:00+01:00')
+            == parse('2019-01-01T06:00:00') == datetime.datetime(2019, 1, 1, 6))
+
+def test_sharded_search():
+    rows = [dict(md5sum=f'{n:032x}', caldat=f'2019-01-{1 + n % 28:02d}',
+                 ra_center=n / 4) for n in range(200)]
+    jspec = {"outfields": ["md5sum", "caldat", "ra_center"],
+             "search": [["caldat", "2019-01-01", "2019-01-28"]]}
+    with StubArchive(rows=rows) as stub:
+        api = helpers.api.FitsFile(stub.url)
+        found = list(api.sharded_search(jspec, 'caldat', shards=4,
+                                        shard_limit=20))
+        assert sorted(found, key=lambda r: r['md5sum']) == rows
+        assert len(stub.searches) > 4 # full shards were split
+        ranges = [qs_jspec['search'][0] for path, qs, qs_jspec
+                  in stub.searches]
+        assert all(term[0] == 'caldat' for term in ranges)
+
+        # Float shards share their boundaries
+        jspec['search'] = [["ra_center", 0.0, 50.0]]
+        found = list(api.sharded_search(jspec, 'ra_center', shards=8,
+                                        key=['md5sum']))
+        assert sorted(found, key=lambda r: r['md5sum']) == rows
+
+        # Int bounds on a (not int) field still give continuous shards
+        jspec['search'] = [["ra_center", 0, 50]]
+        found = list(api.sharded_search(jspec, 'ra_center', shards=4,
+                                        key=['md5sum']))
+        assert sorted(found, key=lambda r: r['md5sum']) == rows
+
+        with pytest.raises(Exception):
+            next(api.sharded_search(jspec, 'caldat'))
+        with pytest.raises(Exception, match='KEY'):
+            next(api.sharded_search(jspec, 'ra_center'))
+
+    # Int fields (per their type) give disjoint shards
+    rows = [dict(md5sum=f'{n:032x}', EXPNUM=n // 2) for n in range(40)]
+    metadata = {'core_file_fields': [dict(Field='md5sum', Type='str'),
+                                     dict(Field='EXPNUM', Type='int')]}
+    jspec = {"outfields": ["EXPNUM"], "search": [["EXPNUM", 0, 19]]}
+    with StubArchive(rows=rows, metadata=metadata) as stub:
+        api = helpers.api.FitsFile(stub.url)
+        found = list(api.sharded_search(jspec, 'EXPNUM', shards=4))
+        assert sorted(r['EXPNUM'] for r in found) == [n // 2
+                                                      for n in range(40)]
+
+    # Dates bounding a datetime field
+    rows = [dict(md5sum=f'{n:032x}',
+                 dateobs=f'2019-01-{1 + n // 24:02d}T{n % 24:02d}:00:00')
+            for n in range(96)]
+    jspec = {"outfields": ["md5sum", "dateobs"],
+             "search": [["dateobs", "2019-01-01", "2019-01-05"]]}
+    with StubArchive(rows=rows) as stub:
+        api = helpers.api.FitsFile(stub.url)
+        found = list(api.sharded_search(jspec, 'dateobs', shards=4,
+                                        key=['md5sum'], continuous=True))
+        assert sorted(found, key=lambda r: r['md5sum']) == rows
+
+    # Rows need not be unique in disjoint (date) shards
+    rows = [dict(caldat=f'2019-01-0{1 + n % 2}', ifilter='gr'[n // 20 % 2])
+            for n in range(40)]
+    jspec = {"outfields": ["caldat", "ifilter"],
+             "search": [["caldat", "2019-01-01", "2019-01-02"]]}
+    with StubArchive(rows=rows) as stub:
+        api = helpers.api.FitsFile(stub.url)
+        found = list(api.sharded_search(jspec, 'caldat', shards=2))
+        assert len(found) == 40
+
+def test_iter_json_array():
+    import json
+    data = [dict(RESULTS=dict(MORE=False))]
+    data += [dict(md5sum=f'{n:032x}', EXPNUM=n, SEEING=n/3, OBJECT='Δ x',
+                  FLAG=None) for n in range(200)]
+    text = json.dumps(data, indent=1, ensure_ascii=False).encode()
+    for size in [1, 3, 1000, len(text)]:
+        chunks = [text[i:i+size] for i in range(0, len(text), size)]
+        assert list(helpers.api.iter_json_array(chunks)) == data
+    assert list(helpers.api.iter_json_array([b'[1', b'0, 2', b'.5e1 ]'])) \
+        == [10, 25.0]
+    with pytest.raises(ValueError):
+        list(helpers.api.iter_json_array([b'[1, 2']))
+
+def test_search_stream():
+    rows = [dict(md5sum=f'{n:032x}', EXPNUM=n) for n in range(1000)]
+    jspec = {"outfields": ["md5sum", "EXPNUM"], "search":[]}
+    with StubArchive(rows=rows) as stub:
+        api = helpers.api.FitsFile(stub.url)
+        info, srows = api.search(jspec, limit=2000, stream=True)
+        assert info['RESULTS']['COUNT'] == 1000
+        assert not isinstance(srows, list)
+        assert list(srows) == rows
+        info, srows = api.vosearch(10, 20, 0.5, limit=3, stream=True)
+        assert info['RESULTS']['MORE']
+        assert list(srows) == rows[:3]
+        assert stub.connections == 1
+
+def test_search_columns():
+    import numpy as np
+    rows = [dict(md5sum=f'{n:032x}', EXPNUM=n, AIRMASS=1+n/100,
+                 caldat='2020-01-01', instrument='decam', proc_type='raw')
+            for n in range(30)]
+    rows[3]['AIRMASS'] = None
+    rows[4]['EXPNUM'] = None
+    metadata = {
+        'core_file_fields': [dict(Field='md5sum', Type='str'),
+                             dict(Field='caldat', Type='datetime64')],
+        'aux_file_fields/decam/raw': [dict(Field='EXPNUM', Type='int'),
+                                      dict(Field='AIRMASS', Type='float')]}
+    jspec = {"outfields": ["md5sum", "EXPNUM", "AIRMASS", "caldat"],
+             "search":[["instrument", "decam"], ["proc_type", "raw"]]}
+    with StubArchive(rows=rows, metadata=metadata) as stub:
+        api = helpers.api.FitsFile(stub.url)
+        info, cols = api.search_columns(jspec, limit=100)
+        assert info['RESULTS']['COUNT'] == 30
+        assert list(cols) == jspec['outfields']
+        assert cols['AIRMASS'].dtype == np.float64
+        assert np.isnan(cols['AIRMASS'][3])
+        assert cols['EXPNUM'].dtype == np.float64 # because of None
+        assert list(cols['md5sum']) == [r['md5sum'] for r in rows]
+
+        pages = list(api.iter_columns(jspec, page_size=12, frame=True))
+        assert [len(df) for info,df in pages] == [12, 12, 6]
+        assert pages[2][1]['EXPNUM'].dtype == np.int64
+        assert list(pages[0][1]['AIRMASS'][:3]) == [1.0, 1.01, 1.02]
+        ahead = list(api.iter_columns(jspec, page_size=12, frame=True,
+                                      prefetch=True))
+        assert [len(df) for info,df in ahead] == [12, 12, 6]
+
+def test_search_csv_local():
+    import numpy as np
+    rows = [dict(md5sum=f'{n:032x}', EXPNUM=n, AIRMASS=1+n/100,
+                 OBJECT=f'field, "{n}"', instrument='decam', proc_type='raw')
+            for n in range(30)]
+    rows[3]['AIRMASS'] = None
+    rows[5]['OBJECT'] = 'Δ field'
+    metadata = {
+        'aux_file_fields/decam/raw': [dict(Field='EXPNUM', Type='int'),
+                                      dict(Field='AIRMASS', Type='float')]}
+    jspec = {"outfields": ["md5sum", "EXPNUM", "AIRMASS", "OBJECT"],
+             "search":[["instrument", "decam"], ["proc_type", "raw"]]}
+    with StubArchive(rows=rows, metadata=metadata) as stub:
+        api = helpers.api.FitsFile(stub.url)
+        info,crows = api.search(jspec, limit=20, format='csv')
+        assert info['HEADER']['outfields'] == jspec['outfields']
+        assert info['RESULTS'] == dict(COUNT=20, MORE=True)
+        assert crows[3] == (rows[3]['md5sum'], 3, None, 'field, "3"')
+        assert crows[5] == tuple(rows[5][k] for k in jspec['outfields'])
+        # No limit sent, so never MORE (30 rows are past api.limit)
+        info,crows = api.search(jspec, limit=None, format='csv')
+        assert info['RESULTS'] == dict(COUNT=30, MORE=False)
+
+        info, jcols = api.search_columns(jspec, limit=100)
+        info, ccols = api.search_columns(jspec, limit=100, format='csv')
+        assert info['RESULTS'] == dict(COUNT=30, MORE=False)
+        assert ccols['EXPNUM'].dtype == np.int64
+        for k in jspec['outfields']:
+            assert ccols[k].dtype == jcols[k].dtype
+            assert jcols[k][4] == ccols[k][4]
+        assert np.isnan(ccols['AIRMASS'][3])
+
+        pages = list(api.iter_columns(jspec, page_size=12, format='csv'))
+        assert [len(c['md5sum']) for i,c in pages] == [12, 12, 6]
+
+def test_search_cache(tmp_path):
+    import time
+    import numpy as np
+    from helpers.cache import SearchCache
+    rows = [dict(md5sum=f'{n:032x}', EXPNUM=n, AIRMASS=1+n/100,
+                 instrument='decam', proc_type='raw')
+            for n in range(30)]
+    rows[3]['AIRMASS'] = None
+    jspec = {"outfields": ["md5sum", "EXPNUM", "AIRMASS"],
+             "search":[["instrument", "decam"], ["proc_type", "raw"]]}
+    same = {"outfields": ["md5sum", "EXPNUM", "AIRMASS"],
+            "search":[["proc_type", "raw"], ["instrument", "decam"]]}
+    cache = SearchCache(tmp_path, ttl=60)
+    with StubArchive(rows=rows) as stub:
+        api = helpers.api.FitsFile(stub.url, cache=cache)
+        info, found = api.search(jspec, limit=20)
+        assert api.search(same, limit=20) == (info, found)
+        assert api.search(jspec, limit=20, format='csv')[1][3] == (
+            rows[3]['md5sum'], 3, None)
+        info, cols = api.search_columns(jspec, limit=100)
+        info, cached = api.search_columns(same, limit=100)
+        assert cached['AIRMASS'].dtype == cols['AIRMASS'].dtype
+        assert np.array_equal(cached['EXPNUM'], cols['EXPNUM'])
+        assert len(stub.searches) == 3
+        assert cache.stats == dict(hits=2, misses=3, puts=3, evictions=0)
+
+        cache.ttl = 0
+        api.search(jspec, limit=20)
+        assert len(stub.searches) == 4
+        cache.max_bytes = 0
+        api.search(jspec, limit=20)
+        assert list(tmp_path.iterdir()) == []
+
+    # Hits keep an entry from eviction, not from expiring
+    cache = SearchCache(tmp_path, ttl=0.6)
+    cache.put('k', {}, [(1,)])
+    hits = 0
+    for n in range(10):
+        hits += cache.get('k') is not None
+        time.sleep(0.15)
+    assert 0 < hits < 10 and cache.get('k') is None
+
+def test_metadata_cache(tmp_path):
+    from helpers.cache import MetadataCache
+    metadata = {
+        'cat_lists': dict(instruments=['decam', 'mosaic3'],
+                          proctypes=['raw', 'instcal']),
+        'core_file_fields': [dict(Field=f, Type='str') for f in
+                             ('md5sum', 'instrument', 'proc_type')],
+        'aux_file_fields/decam/raw': [dict(Field='EXPNUM', Type='int')]}
+    rows = [dict(md5sum=f'{n:032x}', EXPNUM=n, instrument='decam',
+                 proc_type='raw') for n in range(5)]
+    with StubArchive(rows=rows, metadata=metadata) as stub:
+        meta = MetadataCache(tmp_path)
+        api = helpers.api.FitsFile(stub.url, metadata_cache=meta,
+                                   validate=True)
+        jspec = {"outfields": ["md5sum", "EXPNUM"],
+                 "search":[["instrument", "decam"], ["proc_type", "raw"]]}
+        assert len(api.search(jspec)[1]) == 5
+        assert len(api.search(jspec)[1]) == 5
+        assert api.check_version()
+        assert sorted(stub.metadata_requests) == [
+            'aux_file_fields/decam/raw', 'cat_lists', 'core_file_fields']
+
+        with pytest.raises(Exception, match="possible: \\['decam'"):
+            api.search(dict(jspec, search=[["instrument", "decom"]]))
+        with pytest.raises(Exception, match="Unknown fields: \\['EXPNUM'\\]"):
+            api.search(dict(jspec, search=[["instrument", "decam"]]))
+        assert len(stub.searches) == 2
+
+        # From disk, by another instance
+        other = helpers.api.FitsFile(stub.url,
+                                     metadata_cache=MetadataCache(tmp_path))
+        assert other.get_categoricals() == metadata['cat_lists']
+        assert len(stub.metadata_requests) == 3
+        meta.ttl = 0
+        api.get_categoricals()
+        assert len(stub.metadata_requests) == 4
+
+def test_async_api(tmp_path):
+    pytest.importorskip('aiohttp')
+    import asyncio
+    from helpers.aioapi import AsyncFitsFile, AsyncFitsHdu
+    files = {hashlib.md5(bytes([n])*1000).hexdigest(): bytes([n])*1000
+             for n in range(10)}
+    rows = [dict(md5sum=md5, EXPNUM=n) for n, md5 in enumerate(files)]
+    jspec = {"outfields": ["md5sum", "EXPNUM"], "search": []}
+
+    async def run(url):
+        async with AsyncFitsFile(url, max_concurrency=3) as fapi:
+            hapi = AsyncFitsHdu(url, session=fapi.session,
+                                semaphore=fapi.semaphore)
+            info, found = await fapi.search(jspec, limit=100)
+            assert found == rows
+            assert (await hapi.search(jspec, limit=4))[0]['RESULTS']['MORE']
+            pages = [len(rows) async for info, rows
+                     in fapi.iter_pages(jspec, page_size=4)]
+            assert pages == [4, 4, 2]
+            assert await fapi.check_version()
+            sizes = await asyncio.gather(*[
+                fapi.retrieve_to(md5, tmp_path / f'{n}.fits')
+                for n, md5 in enumerate(files)])
+            assert sizes == [1000] * 10
+            md5 = rows[7]['md5sum']
+            chunks = [c async for c in fapi.iter_retrieve(md5,
+                                                          chunk_size=300)]
+            assert b''.join(chunks) == files[md5]
+
+            # Checking a big file already on disk does not block the loop
+            big = bytes(64 * 2**20)
+            (tmp_path / 'big.fits').write_bytes(big)
+            ticks = []
+            async def tick():
+                for n in range(1000):
+                    ticks.append(n)
+                    await asyncio.sleep(0.005)
+            ticker = asyncio.ensure_future(tick())
+            await asyncio.sleep(0)
+            assert await fapi.retrieve_to(hashlib.md5(big).hexdigest(),
+                                          tmp_path / 'big.fits') == 0
+            ticker.cancel()
+            assert len(ticks) > 3
+        assert fapi.session is None
+
+    async def slow(url):
+        async with AsyncFitsFile(url, backoff=0,
+                                 search_timeout=(5, 0.2)) as fapi:
+            with pytest.raises(asyncio.TimeoutError):
+                await fapi.search(jspec)
+
+    with StubArchive(stall=1.0) as stub:
+        asyncio.run(slow(stub.url))
+        assert len(stub.searches) == 1 # not sent again
+
+    with StubArchive(rows=rows, files=files) as stub:
+        asyncio.run(run(stub.url))
+        assert (tmp_path / '7.fits').read_bytes() == files[rows[7]['md5sum']]
+        assert stub.connections <= 3 + 1
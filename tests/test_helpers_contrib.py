@@ -51,3 +51,370 @@ def test_exposure_map():
     #print(f'test_exposure_map: count_nonzero(map)={np.count_nonzero(map)}')
     assert np.count_nonzero(map) >= 106052
 
+
+def test_get_files_local(tmp_path):
+    import hashlib
+    from stub_archive import StubArchive
+    from helpers.contrib.download_decam_expnum import get_files
+
+    files = {hashlib.md5(bytes([n])*100).hexdigest(): bytes([n])*100
+             for n in range(10)}
+    rows = [dict(md5sum=fid, EXPNUM=800000+n, instrument='decam',
+                 proc_type='raw') for n,fid in enumerate(files)]
+    with StubArchive(rows=rows, files=files) as stub:
+        api = helpers.api.FitsFile(stub.url)
+        got = get_files([800001, 800002, 800003, 800007, 123], tmp_path, api)
+        assert len(stub.searches) == 3
+    assert sorted(got) == [str(tmp_path / f'DECam_{n:08}.fits.fz')
+                           for n in [800001, 800002, 800003, 800007]]
+
+def test_sort_radec_batch():
+    import healpy as hp
+    import helpers.contrib.exposure_map as em
+
+    rng = np.random.default_rng(1)
+    ra = rng.uniform(10, 11, (50, 4))
+    dec = rng.uniform(-30, -29, (50, 4))
+    bra, bdec = em.sort_radec_batch(ra, dec)
+    for n in range(len(ra)):
+        sra, sdec = em.sort_radec(ra[n], dec[n])
+        assert list(sra) == list(bra[n]) and list(sdec) == list(bdec[n])
+
+    # Straddling RA=0/360: diagonal corners must not be adjacent
+    bra, bdec = em.sort_radec_batch([[0.1, 359.9, 0.1, 359.9]],
+                                    [[-1.0, 1.0, 1.0, -1.0]])
+    for k in range(4):
+        assert ((bra[0][k] == bra[0][k-1]) + (bdec[0][k] == bdec[0][k-1])
+                == 1)
+    vec = hp.ang2vec(bra[0], bdec[0], lonlat=True)
+    assert len(hp.query_polygon(64, vec)) > 0
+
+def test_rasterize():
+    import healpy as hp
+    import helpers.contrib.exposure_map as em
+
+    nside = 256
+    rng = np.random.default_rng(2)
+    cra = rng.uniform(0, 20, 40)
+    cdec = rng.uniform(-30, -20, 40)
+    ra = cra[:,None] + np.array([-0.5, 0.5, 0.5, -0.5])
+    dec = cdec[:,None] + np.array([-0.5, -0.5, 0.5, 0.5])
+    vecs = hp.ang2vec(ra.ravel(), dec.ravel(), lonlat=True).reshape(-1, 4, 3)
+    weights = np.column_stack([np.full(40, 90.0), rng.uniform(0, 90, 40)])
+
+    expected = np.zeros((2, hp.nside2npix(nside)))
+    for vec, (w0, w1) in zip(vecs, weights):
+        ipix = hp.query_polygon(nside, vec)
+        expected[0][ipix] += w0
+        expected[1][ipix] += w1
+    for processes in (1, 2):
+        maps = np.zeros_like(expected)
+        for pixels, sums in em.rasterize(nside, vecs, weights,
+                                         processes=processes, chunk_size=7):
+            em.accumulate(maps, pixels, sums)
+        assert np.allclose(maps, expected)
+
+def test_sparse_map(tmp_path):
+    import healpy as hp
+    import helpers.contrib.exposure_map as em
+
+    nside = 64
+    rng = np.random.default_rng(3)
+    smap = em.SparseMap(nside)
+    dense = np.zeros((2, hp.nside2npix(nside)))
+    for n in range(5):
+        pixels = np.unique(rng.integers(0, 2000, 300))
+        sums = rng.uniform(0, 10, (2, len(pixels)))
+        smap.add(pixels, sums)
+        dense[:, pixels] += sums
+    assert len(smap) == np.count_nonzero(dense[0])
+    assert np.allclose(smap.to_dense('exposure'), dense[0])
+    assert np.allclose(smap.to_dense('teff', nside=16),
+                       hp.ud_grade(dense[1], 16))
+
+    smap.save(tmp_path / 'map.npz')
+    loaded = em.SparseMap.load(tmp_path / 'map.npz')
+    assert loaded.nside == nside and loaded.names == ['exposure', 'teff']
+    assert np.array_equal(loaded.pixels, smap.pixels)
+    assert np.array_equal(loaded.values, smap.values)
+
+def test_map_pyramid(tmp_path):
+    import healpy as hp
+    import helpers.contrib.exposure_map as em
+
+    nside = 64
+    rng = np.random.default_rng(4)
+    smap = em.SparseMap(nside)
+    pixels = np.unique(rng.integers(0, hp.nside2npix(nside), 5000))
+    smap.add(pixels, rng.uniform(0, 10, (2, len(pixels))))
+    filename = tmp_path / 'pyramid.npz'
+    smap.save_pyramid(filename, nside_min=8)
+
+    for lnside in (64, 32, 16, 8):
+        for name in smap.names:
+            assert np.allclose(em.load_pyramid(filename, lnside, name=name),
+                               hp.ud_grade(smap.to_dense(name), lnside))
+    assert np.array_equal(em.load_pyramid(filename), smap.to_dense('teff'))
+    with pytest.raises(Exception):
+        em.load_pyramid(filename, 4)
+
+def survey_rows(nfiles, nhdus=4, seed=0, caldat='2019-01-01'):
+    """Return (file_rows, hdu_rows) of a synthetic DECam survey."""
+    rng = np.random.default_rng(seed)
+    file_rows, hdu_rows = [], []
+    for n in range(nfiles):
+        md5 = f'{seed:08x}{n:024x}'
+        file_rows.append({'md5sum': md5, 'AIRMASS': 1.2,
+                          'G-TRANSP': rng.uniform(0.8, 1.0),
+                          'instrument': 'decam', 'proc_type': 'instcal',
+                          'prod_type': 'image', 'obs_type': 'object',
+                          'proposal': '2012B-0001', 'ifilter': 'r DECam',
+                          'caldat': caldat})
+        cra, cdec = rng.uniform(5, 15), rng.uniform(-35, -25)
+        for h in range(nhdus):
+            ra = cra + 0.3*h + np.array([0, 0.25, 0.25, 0])
+            dec = cdec + np.array([0, 0, 0.5, 0.5])
+            hdu = {'fitsfile': md5, 'hdu_idx': h,
+                   'fitsfile__archive_filename': f'/{md5}.fits.fz',
+                   'fitsfile__exposure': 90.0,
+                   'CENRA1': ra.mean(), 'CENDEC1': dec.mean(),
+                   'FWHM': rng.uniform(3, 5), 'AVSKY': rng.uniform(50, 150)}
+            for k in range(4):
+                hdu[f'COR{k+1}RA1'] = ra[k]
+                hdu[f'COR{k+1}DEC1'] = dec[k]
+            hdu.update({f'fitsfile__{k}': v for k,v in file_rows[-1].items()
+                        if k not in ('md5sum', 'AIRMASS', 'G-TRANSP')})
+            hdu_rows.append(hdu)
+    return(file_rows, hdu_rows)
+
+def test_exposure_map_local():
+    import matplotlib.pyplot as plt
+    import helpers.contrib.exposure_map as em
+    from stub_archive import StubArchive
+    warnings.filterwarnings('ignore')
+
+    file_rows, hdu_rows = survey_rows(30)
+    with StubArchive(rows=file_rows, hdu_rows=hdu_rows) as stub:
+        fapi = helpers.api.FitsFile(stub.url)
+        hapi = helpers.api.FitsHdu(stub.url)
+        tmap = em.gen_exposure_map(fapi, hapi, nside=256)
+        smap = em.gen_exposure_map(fapi, hapi, nside=256, sparse=True,
+                                   processes=2)
+        bmap = em.gen_exposure_map(fapi, hapi, nside=256, mode='bbox')
+        plt.close('all')
+    assert np.count_nonzero(tmap) > 0
+    assert np.allclose(smap.to_dense('teff'), tmap)
+    # HDUs are aligned with RA/Dec, so their boxes are (nearly) the same
+    assert abs(bmap.sum() / tmap.sum() - 1) < 0.02
+
+def test_exposure_map_update(tmp_path):
+    import matplotlib.pyplot as plt
+    import helpers.contrib.exposure_map as em
+    from stub_archive import StubArchive
+    warnings.filterwarnings('ignore')
+
+    file_rows, hdu_rows = survey_rows(20, caldat='2019-01-01')
+    more_files, more_hdus = survey_rows(10, seed=1, caldat='2019-01-02')
+    state = tmp_path / 'state.npz'
+    with StubArchive(rows=file_rows, hdu_rows=hdu_rows) as stub:
+        fapi = helpers.api.FitsFile(stub.url)
+        hapi = helpers.api.FitsHdu(stub.url)
+        em.gen_exposure_map(fapi, hapi, nside=256, state=state)
+        stub.server.rows.extend(more_files)
+        stub.server.hdu_rows.extend(more_hdus)
+        smap = em.gen_exposure_map(fapi, hapi, nside=256, state=state)
+        search = stub.searches[-1][2]['search']
+        assert ['fitsfile__caldat', '2019-01-01', '2020-09-01'] in search
+        full = em.gen_exposure_map(fapi, hapi, nside=256)
+        # Nothing new: map is unchanged
+        again = em.gen_exposure_map(fapi, hapi, nside=256, state=state)
+        plt.close('all')
+    assert np.allclose(smap.to_dense('teff'), full)
+    assert np.allclose(again.to_dense('teff'), full)
+    smap, manifest, last_caldat = em.load_state(state, 256)
+    assert len(manifest) == len(hdu_rows) + len(more_hdus)
+    assert last_caldat == '2019-01-02'
+
+def test_join_files():
+    import helpers.contrib.exposure_map as em
+
+    files = em.index_files({'md5sum': np.array(['c', 'a', 'b'], dtype=object),
+                            'G-TRANSP': np.array([0.3, 0.1, np.nan])})
+    hdus = {'fitsfile': np.array(['a', 'b', 'x', 'c', 'a'], dtype=object),
+            'hdu_idx': np.array([1, 1, 1, 1, 2]),
+            'FWHM': np.array([4.0, 4.0, 4.0, 4.0, np.nan])}
+    joined = em.join_files(hdus, files)
+    # 'b' has no G-TRANSP, 'x' is not a file, ('a',2) has no FWHM
+    assert list(joined['fitsfile']) == ['a', 'c']
+    assert list(joined['G-TRANSP']) == [0.1, 0.3]
+
+    # No files, no HDUs
+    files = em.index_files({'md5sum': np.array([], dtype=object),
+                            'G-TRANSP': np.array([])})
+    joined = em.join_files(hdus, files)
+    assert set(joined) == {'fitsfile', 'hdu_idx', 'FWHM', 'G-TRANSP'}
+    assert all(len(v) == 0 for v in joined.values())
+
+def test_exposure_map_resume(tmp_path):
+    import json
+    import matplotlib.pyplot as plt
+    import helpers.contrib.exposure_map as em
+    from stub_archive import StubArchive
+    warnings.filterwarnings('ignore')
+
+    class FlakyHdu(helpers.api.FitsHdu):
+        pages = 0
+        def search_columns(self, *args, **kwargs):
+            FlakyHdu.pages += 1
+            if FlakyHdu.pages == 4:
+                raise Exception('Connection lost')
+            return(super().search_columns(*args, **kwargs))
+
+    file_rows, hdu_rows = survey_rows(25)
+    with StubArchive(rows=file_rows, hdu_rows=hdu_rows) as stub:
+        fapi = helpers.api.FitsFile(stub.url)
+        full = em.gen_exposure_map(fapi, helpers.api.FitsHdu(stub.url),
+                                   nside=256)
+        with pytest.raises(Exception, match='Connection lost'):
+            em.gen_exposure_map(fapi, FlakyHdu(stub.url), nside=256,
+                                page_size=20, memmap=tmp_path,
+                                checkpoint_every=2)
+        checkpoint = json.loads((tmp_path / 'checkpoint.json').read_text())
+        assert checkpoint['offset'] == 40
+        # Not resumed with other rasterization or HDUs
+        with pytest.raises(Exception, match='another directory'):
+            em.gen_exposure_map(fapi, helpers.api.FitsHdu(stub.url),
+                                nside=256, memmap=tmp_path, mode='bbox')
+        with pytest.raises(Exception, match='another directory'):
+            em.gen_exposure_map(fapi, helpers.api.FitsHdu(stub.url),
+                                nside=256, memmap=tmp_path, end='2020-01-01')
+        nsearches = len(stub.searches)
+        tmap = em.gen_exposure_map(fapi, FlakyHdu(stub.url), nside=256,
+                                   page_size=20, memmap=tmp_path)
+        plt.close('all')
+        # Resumed at the 3rd page (of 5)
+        assert len(stub.searches) - nsearches == 1 + 3
+    assert np.allclose(tmap, full)
+    teff = np.load(tmp_path / 'teff.npy', mmap_mode='r')
+    assert np.allclose(teff, full)
+
+def test_checkpointed_maps_journal(tmp_path):
+    import helpers.contrib.exposure_map as em
+
+    cmaps = em.CheckpointedMaps(tmp_path, 16)
+    cmaps.add([3, 5], [[1.0, 2.0], [0.5, 1.0]])
+    cmaps.checkpoint(10)
+    cmaps.add([5, 7], [[1.0, 1.0], [1.0, 1.0]])
+    cmaps.write_journal(20) # and stop before applying it
+    del cmaps
+    for n in range(2):
+        cmaps = em.CheckpointedMaps(tmp_path, 16)
+        assert cmaps.offset == 20
+        assert list(cmaps.maps[0][[3, 5, 7]]) == [1.0, 3.0, 1.0]
+        assert list(cmaps.maps[1][[3, 5, 7]]) == [0.5, 2.0, 1.0]
+        del cmaps
+    with pytest.raises(Exception, match='another directory'):
+        em.CheckpointedMaps(tmp_path, 32)
+
+def test_rasterize_bbox():
+    import healpy as hp
+    import helpers.contrib.exposure_map as em
+
+    nside = 512
+    # RA/Dec aligned boxes (one straddling RA=0/360) and a weight each
+    ra = np.array([[10.0, 10.5, 10.5, 10.0], [359.8, 0.2, 0.2, 359.8]])
+    dec = np.array([[-30.0, -30.0, -29.5, -29.5], [1.0, 1.0, 1.4, 1.4]])
+    weights = np.array([[2.0], [3.0]])
+    pixels, sums = em.rasterize_bbox_chunk(nside, ra, dec, weights)
+
+    lon, lat = hp.pix2ang(nside, np.arange(hp.nside2npix(nside)),
+                          lonlat=True)
+    lon = np.where(lon > 180, lon - 360, lon)
+    expected = np.zeros(hp.nside2npix(nside))
+    expected[(lon >= 10) & (lon <= 10.5) & (lat >= -30) & (lat <= -29.5)] = 2
+    expected[(lon >= -0.2) & (lon <= 0.2) & (lat >= 1) & (lat <= 1.4)] = 3
+    assert np.array_equal(pixels, np.flatnonzero(expected))
+    assert np.array_equal(sums[0], expected[pixels])
+
+def test_night_sync(tmp_path):
+    import hashlib
+    from stub_archive import StubArchive
+    from helpers.contrib.night_sync import sync_nights
+
+    def archive_file(n, night, version=0):
+        content = bytes([n, version]) * 3000
+        md5 = hashlib.md5(content).hexdigest()
+        row = dict(md5sum=md5, filesize=len(content), caldat=night,
+                   archive_filename=f'/archive/{night}/c4d_{n:03d}.fits.fz',
+                   telescope='ct4m', instrument='decam')
+        return(row, content)
+
+    made = [archive_file(n, f'2017-08-{15 + n % 2}') for n in range(6)]
+    rows = [row for row, content in made]
+    files = {row['md5sum']: content for row, content in made}
+    with StubArchive(rows=rows, files=files) as stub:
+        api = helpers.api.FitsFile(stub.url)
+        api.limit = 4 # the manifest is still one search (of page_size)
+        sync = lambda **kw: sync_nights(api, 'ct4m', 'decam', '2017-08-15',
+                                        '2017-08-16', tmp_path, **kw)
+        report = sync(dry_run=True)
+        assert len(report.new) == 6 and report.bytes_planned == 6 * 6000
+        assert not (tmp_path / '2017-08-15').exists()
+
+        report = sync()
+        assert len(report.new) == 6 and report.bytes_transferred == 6 * 6000
+        assert (tmp_path / '2017-08-16' / 'c4d_001.fits.fz').read_bytes() \
+            == made[1][1]
+
+        requests = stub.requests
+        report = sync()
+        assert len(report.unchanged) == 6 and report.bytes_skipped == 6 * 6000
+        assert report.bytes_transferred == 0
+        assert stub.requests == requests + 1 # just the manifest search
+
+        # A file reprocessed in the Archive and one deleted locally
+        row, content = archive_file(2, '2017-08-15', version=1)
+        stub.server.rows[2] = row
+        stub.server.files[row['md5sum']] = content
+        (tmp_path / '2017-08-16' / 'c4d_003.fits.fz').unlink()
+        report = sync()
+        assert report.changed == ['2017-08-15/c4d_002.fits.fz']
+        assert report.new == ['2017-08-16/c4d_003.fits.fz']
+        assert len(report.unchanged) == 4
+        assert report.bytes_transferred == 2 * 6000
+        assert (tmp_path / '2017-08-15' / 'c4d_002.fits.fz').read_bytes() \
+            == content
+
+def test_night_files_range(tmp_path, monkeypatch):
+    import csv
+    import sys
+    from stub_archive import StubArchive
+    from helpers.contrib import night_files
+
+    rows = [dict(md5sum=f'{n:032x}', archive_filename=f'/a/{n}.fits.fz',
+                 caldat=f'2017-08-{15 + n % 5:02d}', telescope='ct4m',
+                 instrument='decam')
+            for n in range(120)]
+    with StubArchive(rows=rows) as stub:
+        fapi = helpers.api.FitsFile(stub.url)
+        # Nights with more files than a page are paged, not truncated
+        found = list(night_files.iter_night_rows(
+            'ct4m', 'decam', '2017-08-15', '2017-08-19',
+            ['md5sum', 'caldat'], fapi, page_size=10, workers=3))
+        assert sorted(r['md5sum'] for r in found) == [r['md5sum'] for r in rows]
+        assert len(night_files.get_night_list(
+            'ct4m', 'decam', '2017-08-16', ['md5sum'], fapi)) == 24
+
+        output = tmp_path / 'nights.csv'
+        monkeypatch.setattr(sys, 'argv', [
+            'night_files', '--apiurl', stub.url, '--telescope', 'ct4m',
+            '--instrument', 'decam', '--start', '2017-08-15',
+            '--end', '2017-08-17', '-f', 'archive_filename', '-f', 'caldat',
+            '--output', str(output)])
+        night_files.main()
+    with open(output, newline='') as fileobj:
+        table = list(csv.reader(fileobj))
+    assert table[0] == ['archive_filename', 'caldat']
+    assert sorted(table[1:]) == sorted(
+        [r['archive_filename'], r['caldat']] for r in rows
+        if r['caldat'] <= '2017-08-17')